@@ -27,6 +27,11 @@ indent = '    '  # Indent for structured log output
 
 BUILD_LOG_FILE = 'log/build_log{}.txt'
 
+CASTER_CACHE_DIR = '/code/casters/cache'
+
+# Caster code and its compiled code objects, by caster code key, for the sources processed in this process
+_caster_code_cache = {}
+
 
 def _CaptureException(f, *args, **kwargs):
     """Decorator implementation for capturing exceptions."""
@@ -58,6 +63,71 @@ def CaptureException(f, *args, **kwargs):
     return decorator(_CaptureException, f)  # Preserves signature
 
 
+def _set_from(f, frm):
+    """Mark a function in the exec_context() environment with where it came from"""
+    try:
+        try:
+            f.ambry_from = frm
+        except AttributeError:  # for instance methods
+            f.im_func.ambry_from = frm
+    except (TypeError, AttributeError):  # Builtins, non python code
+        pass
+
+    return f
+
+
+_static_exec_env = None  # Built by _static_exec_context()
+
+
+def _static_exec_context():
+    """Return the part of the Bundle.exec_context() environment that is the same for all bundles. It is built
+    once per process. """
+    global _static_exec_env
+
+    if _static_exec_env is not None:
+        return _static_exec_env
+
+    import dateutil.parser
+    import datetime
+    import random
+    from functools import partial
+    from ambry.valuetype.types import parse_date, parse_time, parse_datetime
+    import ambry.valuetype.types
+    import ambry.valuetype.exceptions
+    import ambry.valuetype.test
+    import ambry.valuetype
+
+    test_env = dict(
+        parse_date=parse_date,
+        parse_time=parse_time,
+        parse_datetime=parse_datetime,
+        partial=partial
+    )
+
+    test_env.update(dateutil.parser.__dict__)
+    test_env.update(datetime.__dict__)
+    test_env.update(random.__dict__)
+    test_env.update(ambry.valuetype.core.__dict__)
+    test_env.update(ambry.valuetype.types.__dict__)
+    test_env.update(ambry.valuetype.exceptions.__dict__)
+    test_env.update(ambry.valuetype.test.__dict__)
+    test_env.update(ambry.valuetype.__dict__)
+
+    localvars = {}
+
+    for f_name, func in test_env.items():
+        if not isinstance(func, (str, tuple)):
+            localvars[f_name] = _set_from(func, 'env')
+
+    # The 'b' parameter of randint is assumed to be a bundle, but
+    # replacing it with a lambda prevents the param assignment
+    localvars['randint'] = lambda a, b: random.randint(a, b)
+
+    _static_exec_env = localvars
+
+    return _static_exec_env
+
+
 class Bundle(object):
     STATES = Constant()
     STATES.NEW = 'new'
@@ -133,6 +203,7 @@ class Bundle(object):
         self.capture_exceptions = False  # If set to true (in CLI), will catch and log exceptions internally.
         self.exit_on_fatal = True
         self.multi = None  # Number of multiprocessing processes
+        self.reuse_builds = False  # Copy the outputs of earlier builds of sources with the same fingerprint
         self.is_subprocess = False  # Externally set in child processes.
         # AMBRY_IS_REMOTE is set in the docker file for the builder container
         self.is_remote_process = os.getenv('AMBRY_IS_REMOTE', False)
@@ -142,6 +213,10 @@ class Bundle(object):
 
         self._progress = None
         self._ps = None  # Progress logger section, created as needed.
+
+        self._exec_context = None  # Bundle functions for exec_context(), created as needed.
+        self._code_version = None  # Hashes of the bundle's code files, from code_version
+
         self.init()
 
     def init(self):
@@ -825,6 +900,14 @@ Pipeline Headers
 ================
 {}
 
+Fused Pipes
+===========
+{}
+
+Read Ahead
+==========
+{}
+
 Caster Code
 ===========
 {}
@@ -832,7 +915,9 @@ Caster Code
 """)
         try:
             v = templ.format(pl.name, str(datetime.now()), pl.phase, pl.source_name, pl.source_table,
-                             pl.dest_table, unicode(pl), pl.headers_report(), caster_code)
+                             pl.dest_table, unicode(pl), pl.headers_report(),
+                             pl.fused_report() if pl.compiled else 'Not compiled', pl.read_ahead_report(),
+                             caster_code)
         except UnicodeError as e:
             v = ''
             self.error('Faled to write pipeline log for pipeline {} '.format(pl.name))
@@ -855,15 +940,17 @@ Caster Code
         return None, None
 
 
-    def pipeline(self, source=None, phase='build', ps=None):
+    def pipeline(self, source=None, phase='build', ps=None, shard=None):
         """
         Construct the ETL pipeline for all phases. Segments that are not used for the current phase
         are filtered out later.
 
         :param source: A source object, or a source string name
+        :param shard: If not None, an ambry.etl.Shard. The pipeline reads only the shard's rows from the
+            source's ingested datafile.
         :return: an etl Pipeline
         """
-        from ambry.etl.pipeline import Pipeline, PartitionWriter
+        from ambry.etl.pipeline import Pipeline, PartitionWriter, DatafileSourcePipe
         from ambry.dbexceptions import ConfigurationError
 
         if source:
@@ -871,10 +958,13 @@ Caster Code
         else:
             source = None
 
-        sf, sp = self.source_pipe(source, ps) if source else (None, None)
-
+        if shard:
+            sp = DatafileSourcePipe(self, source, shard)
+        else:
+            sf, sp = self.source_pipe(source, ps) if source else (None, None)
 
         pl = Pipeline(self, source=sp)
+        pl.shard = shard
 
         # Get the default pipeline, from the config at the head of this file.
         try:
@@ -935,6 +1025,11 @@ Caster Code
 
         self.edit_pipeline(pl)
 
+        if shard:
+            # The shard's row range is only meaningful for the datafile, so don't let the configuration
+            # replace the source pipe
+            pl['source'] = [sp]
+
         try:
 
             pl.dest_table = source.dest_table_name
@@ -1645,6 +1740,7 @@ Caster Code
         self.dataset.sources[:] = []
         self.dataset.source_tables[:] = []
         self.dataset.st_sequence_id = 1
+        self.dataset._database.clear_sequence_ids(self.dataset.vid)
 
     def clean_progress(self):
         self.progress.clean()
@@ -1743,7 +1839,6 @@ Caster Code
         run buy run_stage.
         """
 
-        from itertools import groupby
         from ambry.bundle.events import TAG
         from fs.errors import ResourceNotFoundError
         import zlib
@@ -1790,22 +1885,15 @@ Caster Code
                 except (ResourceNotFoundError, zlib.error, IOError):
                     df.remove()
 
-        for stage, g in groupby(sources, key):
-            sources = [s for s in g if not_final_or_delete(s)]
-
-            if not len(sources):
-                continue
-
-            self._run_events(TAG.BEFORE_INGEST, stage)
-
-            stage_errors = self._ingest_sources(sources, stage, force=force)
-
-            errors += stage_errors
+        # The sources from all of the stages are ingested together. Each source starts as soon as the sources it
+        # depends on are done, and the stage events run when the first source in a stage starts and after the
+        # last one finishes.
+        sources = [s for s in sources if not_final_or_delete(s)]
 
-            count += len(sources) - stage_errors
+        if sources:
+            errors = self._ingest_sources(sources, stage, force=force)
 
-            self._run_events(TAG.AFTER_INGEST, stage)
-            self.record_stage_state(self.STATES.INGESTING, stage)
+            count = len(sources) - errors
 
         self.state = self.STATES.INGESTED
 
@@ -1824,8 +1912,10 @@ Caster Code
                 try:
                     meta = iterable_source.meta
                     if meta:
-                        self.metadata.about.title = meta['title']
-                        self.metadata.about.summary = meta['summary']
+                        metadata = self.metadata
+                        with metadata.deferred_writes():
+                            metadata.about.title = meta['title']
+                            metadata.about.summary = meta['summary']
                         self.build_source_files.bundle_meta.objects_to_record()
 
                 except AttributeError as e:
@@ -1842,8 +1932,11 @@ Caster Code
             return False
 
     def _ingest_sources(self, sources, stage, force=False):
-        """Ingest a set of sources, usually for one stage"""
+        """Ingest a set of sources, which may be from several stages. Sources are scheduled by
+        _schedule_sources(), so a source only waits for the sources that it depends on. """
         from concurrent import ingest_mp
+        from ambry.bundle.events import TAG
+        from .scheduler import DAGScheduler
 
         self.state = self.STATES.INGESTING
 
@@ -1864,16 +1957,31 @@ Caster Code
             for source in sources:
                 _ = source.source_table
 
+            def before_stage(stage):
+                self._run_events(TAG.BEFORE_INGEST, stage)
+
+            def after_stage(stage):
+                self._log_makespan(sched, stage)
+                self._run_events(TAG.AFTER_INGEST, stage)
+                self.record_stage_state(self.STATES.INGESTING, stage)
+
+            sched = DAGScheduler(ps, before_stage=before_stage, after_stage=after_stage)
+
+            costs = self.source_costs(downloadable_sources, ('ingest', 'ingest_mp'))
+            memory = self.source_memory(downloadable_sources, ('ingest_mp',))
+
             if self.multi:
-                args = [(self.identity.vid, stage, source.vid, force) for source in downloadable_sources]
+                def source_task(source, shard):
+                    return ingest_mp, (self.identity.vid, source.stage, source.vid, force)
+
+                self._schedule_sources(sched, downloadable_sources, source_task, costs=costs, memory=memory)
 
                 pool = self.library.process_pool(limited_run=self.limited_run)
 
                 try:
-                    # The '1' for chunksize ensures that the subprocess only gets one
-                    # source to build. Combined with maxchildspertask = 1 in the pool,
-                    # each process will only handle one source before exiting.
-                    result = pool.map_async(ingest_mp, args, 1)
+                    # Each task is sent to the pool by itself. Combined with maxchildspertask = 1 in
+                    # the pool, each process will only handle one source before exiting.
+                    sched.run(pool, raise_errors=False)
 
                     pool.close()
                     pool.join()
@@ -1883,13 +1991,24 @@ Caster Code
                     pool.terminate()
                     raise
             else:
-                for i, source in enumerate(downloadable_sources, 1):
+                def ingest_source(i, s_vid):
+                    source = self.source(s_vid)
                     ps.add(
                         message='Ingesting source #{}, {}'.format(i, source.name),
                         source=source, state='running')
-                    r = self._ingest_source(source, ps, force)
-                    if not r:
-                        errors += 1
+                    return self._ingest_source(source, ps, force)
+
+                numbers = {source.vid: i for i, source in enumerate(downloadable_sources, 1)}
+
+                def source_task(source, shard):
+                    return ingest_source, (numbers[source.vid], source.vid)
+
+                self._schedule_sources(sched, downloadable_sources, source_task, costs=costs, memory=memory)
+
+                sched.run()
+
+            # Failed sources return False. Sources that depend on a source that raised an exception don't run.
+            errors = sum(1 for t in sched.tasks.values() if t.state != 'done' or not t.result)
 
             if errors > 0:
                 from ambry.dbexceptions import IngestionError
@@ -2199,9 +2318,9 @@ Caster Code
         :return:
         """
 
-        from operator import attrgetter
-        from itertools import groupby
-        from .concurrent import build_mp, unify_mp
+        from collections import Counter
+        from .concurrent import build_mp, unify_mp, unify_table_mp
+        from .scheduler import DAGScheduler
         from ambry.bundle.events import TAG
 
         self.log('==== Building ====')
@@ -2245,76 +2364,127 @@ Caster Code
 
             resolved_sources.reload()
 
-            e = [
-                (stage, SourceSet(self, list(stage_sources)))
-                for stage, stage_sources in groupby(sorted(resolved_sources, key=attrgetter('stage')),
-                                                    attrgetter('stage'))
+            for s in resolved_sources:
+                s.state = self.STATES.WAITING
+            self.commit()
 
-                ]
+            resolved_sources.reload()
 
-            for stage, stage_sources in e:
+            # Large, ingested sources are split into row range shards, which are built separately
+            shards = {source.vid: self.source_shards(source) for source in resolved_sources}
+            sharded = [vid for vid, source_shards in iteritems(shards) if source_shards]
 
-                stage_sources.reload()
+            if sharded:
+                self.log('Building {} sources in shards: {}'.format(
+                    len(sharded), ', '.join('{} ({})'.format(vid, len(shards[vid])) for vid in sharded)))
 
-                for s in stage_sources:
-                    s.state = self.STATES.WAITING
-                self.commit()
+            # The shards of a source share the fingerprint of the whole source, so its datafile is hashed once.
+            # Sharded sources read ingested files, so their fingerprints don't depend on the other sources.
+            base_fingerprints = {vid: self._build_fingerprint(self.source(vid)) for vid in sharded}
 
-                stage_sources.reload()
+            stage_sizes = Counter(s.stage or 1 for s in resolved_sources)
 
-                self.log('Processing {} sources, stage {} ; first 10: {}'
-                         .format(len(stage_sources), stage, [x.name for x in stage_sources.sources[:10]]))
+            def before_stage(stage):
+                self.log('Processing {} sources, stage {}'.format(stage_sizes[stage], stage))
                 self._run_events(TAG.BEFORE_BUILD, stage)
 
-                if self.multi:
+            def after_stage(stage):
+                self._log_makespan(sched, stage)
+                self._run_events(TAG.AFTER_BUILD, stage)
 
-                    try:
-                        # The '1' for chunksize ensures that the subprocess only gets one
-                        # source to build. Combined with maxchildspertask = 1 in the pool,
-                        # each process will only handle one source before exiting.
+            # Rather than building the stages one after another, each source starts as soon as the sources
+            # and partitions that it reads are done, and each table is unified as soon as its sources are done.
+            sched = DAGScheduler(ps, before_stage=before_stage, after_stage=after_stage)
+
+            costs = self.source_costs(resolved_sources, ('build', 'build_mp'))
+            memory = self.source_memory(resolved_sources, ('build_mp',))
 
-                        args = [(self.identity.vid, stage, source.vid, force) for source in stage_sources]
-                        pool = self.library.process_pool(limited_run=self.limited_run)
-                        r = pool.map_async(build_mp, args, 1)
-                        completed_sources = r.get()
+            def unified_tables():
+                """Tables that were unified by the scheduler. Segments that are left over for these tables
+                are appended to the unified partitions, rather than replacing them """
+                return {k[1] for k in sched.tasks if isinstance(k, tuple) and len(k) == 2 and k[0] == 'unify'}
 
-                        ps.add('Finished MP building {} sources. Starting MP coalescing'
-                               .format(len(completed_sources)))
+            if self.multi:
+
+                def source_task(source, shard):
+                    return build_mp, (self.identity.vid, source.stage or 1, source.vid, force, shard,
+                                      self.reuse_builds, base_fingerprints.get(source.vid))
+
+                def unify_task(table_name, append=False):
+                    return unify_table_mp, (self.identity.vid, table_name, append)
+
+                self._schedule_sources(sched, resolved_sources, source_task, unify_task=unify_task,
+                                       finish_task=lambda source: (self._finish_shards, ([source.vid],)),
+                                       shards=shards, costs=costs, memory=memory)
+
+                try:
+                    # Each task is sent to the pool by itself. Combined with maxchildspertask = 1 in
+                    # the pool, each process will only handle one source, or one shard of a source, before exiting.
 
-                        partition_names = [(self.identity.vid, k) for k, v
-                                           in self.collect_segment_partitions().items()]
+                    pool = self.library.process_pool(limited_run=self.limited_run)
 
+                    sched.run(pool)
+
+                    unified = unified_tables()
+
+                    ps.add('Finished MP building {} sources'.format(len(resolved_sources)))
+
+                    # The tables were unified as their sources finished, but pipelines can also write to
+                    # partitions of other tables.
+                    partition_names = [(self.identity.vid, k, k.table in unified) for k, v
+                                       in self.collect_segment_partitions().items()]
+
+                    if partition_names:
                         r = pool.map_async(unify_mp, partition_names, 1)
 
                         completed_partitions = r.get()
 
-                        ps.add('Finished MP coalescing {} partitions'.format(len(completed_partitions)))
+                        ps.add('Finished MP coalescing {} remaining partitions'.format(len(completed_partitions)))
+
+                    pool.close()
+                    pool.join()
 
-                        pool.close()
-                        pool.join()
+                except KeyboardInterrupt:
+                    self.log('Got keyboard interrrupt; terminating workers')
+                    pool.terminate()
 
-                    except KeyboardInterrupt:
-                        self.log('Got keyboard interrrupt; terminating workers')
-                        pool.terminate()
+            else:
 
-                else:
+                numbers = {source.vid: i for i, source in enumerate(resolved_sources)}
 
-                    for i, source in enumerate(stage_sources):
-                        id_ = ps.add(message='Running source {}'.format(source.name),
-                                     source=source, item_count=i, state='running')
+                def build_source(s_vid, shard):
+                    source = self.source(s_vid)
 
-                        self.build_source(stage, source, ps, force=force)
+                    id_ = ps.add(message='Running source {}{}'.format(source.name, ', ' + str(shard) if shard else ''),
+                                 source=source, item_count=numbers[s_vid], state='running')
 
-                        ps.update(message='Finished processing source', state='done')
+                    self.build_source(source.stage or 1, source, ps, force=force, shard=shard,
+                                      base_fingerprint=base_fingerprints.get(s_vid))
 
-                        # This bit seems to solve a problem where the records from the ps.add above
-                        # never gets closed out.
-                        ps.get(id_).state = 'done'
-                        self.progress.commit()
+                    ps.update(message='Finished processing source', state='done')
 
-                    self.unify_partitions()
+                    # This bit seems to solve a problem where the records from the ps.add above
+                    # never gets closed out.
+                    ps.get(id_).state = 'done'
+                    self.progress.commit()
 
-                self._run_events(TAG.AFTER_BUILD, stage)
+                def source_task(source, shard):
+                    return build_source, (source.vid, shard)
+
+                def unify_task(table_name, append=False):
+                    return self.unify_partitions, ([table_name], [table_name] if append else None)
+
+                self._schedule_sources(sched, resolved_sources, source_task, unify_task=unify_task,
+                                       finish_task=lambda source: (self._finish_shards, ([source.vid],)),
+                                       shards=shards, costs=costs, memory=memory)
+
+                sched.run()
+
+                unified = unified_tables()
+
+                # Unify the segments of any partitions that aren't in a table the sources were built for
+                if self.collect_segment_partitions():
+                    self.unify_partitions(append=unified)
 
         self.state = self.STATES.BUILT
         self.commit()
@@ -2339,8 +2509,18 @@ Caster Code
 
         self.unify_partitions()
 
-    def build_source(self, stage, source, ps, force=False):
-        """Build a single source"""
+    def build_source(self, stage, source, ps, force=False, shard=None, base_fingerprint=None):
+        """Build a single source
+
+        :param shard: If not None, an ambry.etl.Shard, and only the rows in the shard are built, into
+            the shard's own segment partitions. The source is not marked as built; the caller does that
+            after all of the shards are finished.
+        :param base_fingerprint: The fingerprint of the whole source, from source_fingerprint(), for building a
+            shard with reuse_builds set.
+
+        If reuse_builds is set, and the fingerprint store has the outputs of a build with the same
+        fingerprint, the segment partitions are copied from the store rather than built.
+        """
         from ambry.bundle.process import call_interval
 
         assert source.is_processable, source.name
@@ -2349,7 +2529,17 @@ Caster Code
             ps.update(message='Source {} already built'.format(source.name), state='skipped')
             return
 
-        pl = self.pipeline(source, ps=ps)
+        fingerprint = self._build_fingerprint(source, shard, base=base_fingerprint)
+
+        if fingerprint and self._reuse_build(source, fingerprint, ps):
+            if not shard:
+                source.state = self.STATES.BUILT
+
+            self.commit()
+
+            return source.name
+
+        pl = self.pipeline(source, ps=ps, shard=shard)
 
         source.state = self.STATES.BUILDING
 
@@ -2389,6 +2579,8 @@ Caster Code
 
         self.commit()
 
+        partitions = []
+
         try:
             partitions = list(pl[ambry.etl.PartitionWriter].partitions)
             ps.update(message='Finalizing segment partition',
@@ -2413,12 +2605,535 @@ Caster Code
             self.error("Pipeline didn't have a PartitionWriters, won't try to finalize")
 
         self.log_pipeline(pl)
-        source.state = self.STATES.BUILT
+
+        if fingerprint:
+            self._save_build(source, fingerprint, partitions)
+
+        if not shard:
+            source.state = self.STATES.BUILT
 
         self.commit()
 
         return source.name
 
+    @property
+    def fingerprint_store(self):
+        """The store of build outputs, keyed by the fingerprints of the source builds. The size of the store is
+        limited by the fingerprints_max_mb value of the library config, 10GB by default."""
+        from .fingerprints import FingerprintStore
+
+        max_mb = int((self.library.config.library or {}).get('fingerprints_max_mb') or 10240)
+
+        return FingerprintStore(self.library.filesystem.fingerprints(), max_size=max_mb * 1024 * 1024)
+
+    def source_fingerprint(self, source, shard=None, base=None):
+        """Return a hash of everything that building a source, or a shard of a source, depends on, or None if
+        the inputs can't be determined. Builds with the same fingerprint produce the same segment partitions.
+
+        The hash covers the ingested datafile, or the partitions of the tables that the source reads, the source
+        record, the source table, the destination table's columns and transforms, the bundle metadata, the
+        pipeline configuration, the bundle and library code and the ambry version. Sources that read files
+        aren't fingerprinted until they are ingested. Generator and notebook sources are never fingerprinted,
+        since they could read anything.
+
+        The fingerprint of a shard is a hash of the fingerprint of the whole source and the shard's row range.
+
+        :param shard: If not None, return the fingerprint of this shard of the source
+        :param base: The fingerprint of the whole source, if it has already been computed. All of the shards
+            of a source have the same base, so the source's datafile is only hashed once.
+        """
+        import hashlib
+        import json
+        from ambry._meta import __version__
+        from ambry.orm import Partition
+        from .fingerprints import file_hash, json_default
+
+        def digest(parts):
+            return hashlib.sha1(json.dumps(parts, sort_keys=True, default=json_default).encode('utf8')).hexdigest()
+
+        if shard:
+            base = base or self.source_fingerprint(source)
+            return digest([base, shard.start_row, shard.end_row]) if base else None
+
+        if source.reftype in ('notebook', 'generator'):
+            return None
+
+        parts = [__version__, sys.version_info[:2]]
+
+        parts.append({k: v for k, v in iteritems(source.dict) if k not in ('vid', 'state', 'st_vid')})
+
+        parts.append([[c.position, c.source_header, c.dest_header, c.datatype, c.valuetype, c.start, c.width]
+                      for c in source.source_table.columns])
+
+        parts.append([source.dest_table.name] +
+                     [[c.sequence_id, c.name, c.datatype, c.valuetype, c.transform, c.default, c.illegal_value,
+                       c.is_primary_key, c.start, c.width, c.size] for c in source.dest_table.columns])
+
+        # The metadata includes the pipeline configuration and the build settings. The identity and the version
+        # history change with every version of the bundle, but the rows don't depend on them.
+        parts.append({k: v for k, v in iteritems(self.metadata.dict) if k not in ('identity', 'versions')})
+
+        parts.append(self._find_pipeline(source, 'build'))
+
+        parts += self.code_version
+
+        inputs = self.source_inputs(source)
+
+        if inputs is None:
+            return None
+
+        if source.reftype == 'sql' and not source.ref.strip().lower().startswith('select'):
+            parts.append(self.build_source_files.file_by_path(source.ref.split(':', 1)[0]).unpacked_contents)
+
+        elif source.is_downloadable:
+            # The source's data is hashed as it was ingested, rather than downloading it again
+            if not source.datafile.exists:
+                return None
+
+            with source.datafile.open(mode='rb') as f:
+                parts.append(file_hash(f))
+
+        # Unifying the tables' partitions, before the source starts, is scheduled by _schedule_sources()
+        for p in sorted(self.dataset.partitions, key=lambda p: p.name):
+            if p.type == Partition.TYPE.UNION and p.table_name in inputs:
+                with self.wrap_partition(p).local_datafile.open(mode='rb') as f:
+                    parts.append([p.name, file_hash(f)])
+
+        return digest(parts)
+
+    def _build_fingerprint(self, source, shard=None, base=None):
+        """Return the fingerprint of a source build, or None if builds aren't reused, or the fingerprint can't be
+        computed"""
+
+        if not self.reuse_builds or self.limited_run:
+            return None
+
+        try:
+            return self.source_fingerprint(source, shard, base=base)
+        except Exception as e:
+            self.warn('Failed to compute fingerprint for source {}: {}'.format(source.name, e))
+            return None
+
+    def _reuse_build(self, source, fingerprint, ps):
+        """Copy the segment partitions that an earlier build with the same fingerprint stored. Returns True if the
+        build was reused, or False if the source must be built"""
+        from ambry.identity import PartialPartitionName
+        from ambry.orm import Partition
+
+        store = self.fingerprint_store
+
+        manifest = store.get(fingerprint)
+
+        if manifest is None:
+            return False
+
+        ps.update(message='Reusing build of source {}, fingerprint {}'.format(source.name, fingerprint))
+
+        try:
+            for entry in manifest['partitions']:
+                pname = PartialPartitionName(**entry['name'])
+
+                p = self.partitions.partition(pname)
+
+                if not p:
+                    p = self.partitions.new_partition(pname, type=Partition.TYPE.SEGMENT, title=entry['title'],
+                                                      description=entry['description'], epsg=entry['epsg'])
+                    self.commit()
+
+                with store.open(fingerprint, entry['file']) as f:
+                    self.wrap_partition(p).local_datafile.set_contents(f)
+
+                p.finalize(ps)
+                self.commit()
+
+        except (IOError, OSError, KeyError) as e:
+            self.warn('Failed to reuse build of source {} from {}: {}'
+                      .format(source.name, store.path(fingerprint), e))
+            store.remove(fingerprint)
+            return False
+
+        ps.update(message='Reused build of source {}'.format(source.name), state='done')
+
+        return True
+
+    def _save_build(self, source, fingerprint, partitions):
+        """Save the segment partitions of a source build in the fingerprint store"""
+        from ambry.identity import PartialPartitionName
+
+        manifest = dict(source=source.name, partitions=[])
+        datafiles = {}
+
+        for i, p in enumerate(partitions):
+            file_name = '{}.mpr'.format(i)
+            name = p.identity.name
+
+            manifest['partitions'].append(dict(
+                file=file_name,
+                name={k: getattr(name, k) for k, _, _ in PartialPartitionName._name_parts},
+                title=p.title, description=p.description, epsg=p.epsg))
+
+            datafiles[file_name] = self.wrap_partition(p).local_datafile
+
+        try:
+            self.fingerprint_store.put(fingerprint, manifest, datafiles)
+        except (IOError, OSError) as e:
+            self.warn('Failed to save build of source {} to the fingerprint store: {}'.format(source.name, e))
+
+    def source_shards(self, source):
+        """Return a list of Shards for building a source in row ranges, or None if the source should be built
+        whole.
+
+        A source is sharded when the shard_rows value of the build metadata is set and the source has been
+        ingested, since the shards are row ranges of the ingested datafile. """
+        from ambry.etl import make_shards
+
+        try:
+            shard_rows = int(self.metadata.build['shard_rows'] or 0)
+        except (KeyError, ValueError, TypeError):
+            return None
+
+        if not shard_rows or self.limited_run or not source.is_downloadable or not source.datafile.exists:
+            return None
+
+        with source.datafile.reader as r:
+            n_rows = r.n_rows
+
+        shards = make_shards(n_rows, shard_rows)
+
+        return shards if len(shards) > 1 else None
+
+    default_seconds_per_row = 0.0001  # Cost estimate for sources with rows, before there are any timings
+
+    def source_durations(self, phases):
+        """Return a dict of source vids to the seconds it took to process the source the last time it was run in
+        one of the given progress phases, from the span of the process records for the source."""
+        from sqlalchemy import func
+        from ambry.orm import Process
+
+        q = (self.progress.query
+             .with_entities(Process.s_vid, Process.group, func.min(Process.created), func.max(Process.modified))
+             .filter(Process.s_vid != None)
+             .filter(Process.phase.in_(phases))
+             .group_by(Process.s_vid, Process.group)
+             .order_by(Process.group))
+
+        # Later groups replace earlier ones
+        return {s_vid: end - start for s_vid, group, start, end in q if start and end}
+
+    def source_costs(self, sources, phases):
+        """Return a dict of source vids to estimated processing times, in seconds, for scheduling the
+        longest sources first.
+
+        Sources that were processed before use their last duration. Others are estimated from the number of rows
+        in their ingested datafile, at the average rate of the timed sources, and sources with neither get the
+        median of the other estimates. """
+        from ambry.orm.exc import NotFoundError
+
+        try:
+            durations = self.source_durations(phases)
+        except Exception as e:
+            self.warn('Failed to get source durations: {}'.format(e))
+            durations = {}
+
+        rows = {}
+        for source in sources:
+            try:
+                if source.is_downloadable and source.datafile.exists:
+                    with source.datafile.reader as r:
+                        rows[source.vid] = r.n_rows
+            except (NotFoundError, IOError, OSError):
+                pass
+
+        timed = [vid for vid in rows if vid in durations and rows[vid]]
+
+        if timed:
+            seconds_per_row = sum(durations[vid] for vid in timed) / sum(rows[vid] for vid in timed)
+        else:
+            seconds_per_row = self.default_seconds_per_row
+
+        costs = {}
+        for source in sources:
+            if source.vid in durations:
+                costs[source.vid] = durations[source.vid]
+            elif source.vid in rows:
+                costs[source.vid] = rows[source.vid] * seconds_per_row
+
+        known = sorted(costs.values())
+        default = known[len(known) // 2] if known else 1.0
+
+        return {source.vid: costs.get(source.vid, default) for source in sources}
+
+    def source_memory(self, sources, phases):
+        """Return a dict of source vids to the estimated peak memory, in bytes, that processing the source adds
+        to a worker, from the memory records that the worker wrote the last time the source was processed in one
+        of the given progress phases. Sources without records get the median of the others"""
+        from ambry.orm import Process
+
+        try:
+            q = (self.progress.query
+                 .filter(Process.item_type == 'memory')
+                 .filter(Process.phase.in_(phases))
+                 .filter(Process.s_vid != None)
+                 .order_by(Process.id))
+
+            # Later records replace earlier ones
+            peaks = {r.s_vid: r.data['task_rss'] for r in q if r.data and r.data.get('task_rss')}
+
+        except Exception as e:
+            self.warn('Failed to get source memory estimates: {}'.format(e))
+            peaks = {}
+
+        known = sorted(peaks.values())
+        default = known[len(known) // 2] if known else None
+
+        return {source.vid: peaks.get(source.vid, default) for source in sources}
+
+    def _log_makespan(self, sched, stage):
+        """Log the predicted and actual times to run the tasks in a stage"""
+
+        actual = sched.makespan(stage)
+
+        if actual is not None:
+            self.log('Stage {} took {:0.1f}s, predicted {:0.1f}s with {} processes'.format(
+                stage, actual, sched.predicted_makespan(stage), sched.processes))
+
+    def source_inputs(self, source):
+        """Return the names of the tables in this bundle that a source reads, or None if they can't be determined.
+
+        Partition sources read the partition named in their ref, and SQL sources read the partitions named in
+        their SQL. Generator and notebook sources run code that could read anything. Other sources read files,
+        so they don't read any tables. """
+        import re
+
+        if source.reftype in ('generator', 'notebook'):
+            return None
+
+        elif source.reftype == 'partition':
+            text = source.ref
+
+            # The ref may be the vid, id or versioned name of a partition that already exists
+            for p in self.dataset.partitions:
+                if text in (p.vid, p.id, p.name, p.vname):
+                    return {p.table_name}
+
+        elif source.reftype == 'sql':
+            if source.ref.strip().lower().startswith('select'):
+                text = source.ref
+            else:
+                try:
+                    text = self.build_source_files.file_by_path(source.ref.split(':', 1)[0]).unpacked_contents
+                except Exception:
+                    return None
+        else:
+            return set()
+
+        # Partition names start with the dataset name, followed by the table name
+        tables = set(t.name for t in self.dataset.tables)
+        found = set(re.findall(re.escape(self.identity.sname) + r'-(\w+)', text or ''))
+
+        if found - tables:
+            return None  # Refers to this bundle, but not to a known table
+
+        return found
+
+    def source_outputs(self, source):
+        """Return the names of the tables in this bundle that a source writes, or None if they can't be determined.
+
+        A source writes to its destination table, unless the pipes that select the partitions for its rows are
+        replaced, in the source's pipeline configuration or in the bundle's default pipelines, or the bundle edits
+        the pipelines, since a selection function can write to any table. Replacing them with pipes that
+        only write to the destination table, without arguments, is ok. """
+        from collections import Mapping
+
+        dest_pipes = ('SelectPartition', 'SelectPartitionFromSource', 'WriteToPartition')
+
+        def writes_dest(pipes):
+            if not isinstance(pipes, (list, tuple)):
+                pipes = [pipes]
+
+            return all(str(pipe).strip().split('.')[-1] in dest_pipes for pipe in pipes)
+
+        if source.pipeline:
+            pipe_name = source.pipeline
+        else:
+            pipe_name, _ = self._find_pipeline(source, 'build')
+
+        for name in (pipe_name, 'all'):
+            try:
+                pipe_config = self.metadata.pipelines[name] if name else None
+            except KeyError:
+                continue
+
+            if isinstance(pipe_config, Mapping):
+                for segment in ('select_partition', 'write'):
+                    if segment in pipe_config and not writes_dest(pipe_config[segment]):
+                        return None
+
+            elif pipe_config:
+                # Pipes in a list go into the body, except for partition writers
+                if any('Partition' in str(pipe) and not writes_dest(pipe) for pipe in pipe_config):
+                    return None
+
+        for segment in ('select_partition', 'write'):
+            if self.default_pipelines['build'].get(segment) != Bundle.default_pipelines['build'].get(segment):
+                return None
+
+        if self._pipeline_editor or type(self).edit_pipeline != Bundle.edit_pipeline:
+            return None
+
+        return {source.dest_table_name}
+
+    def _schedule_sources(self, sched, sources, source_task, unify_task=None, finish_task=None, shards=None,
+                          costs=None, memory=None):
+        """Add tasks for processing sources to a DAGScheduler, with dependencies that replace the barriers
+        between stages.
+
+        A source only depends on sources from earlier stages if it reads from them. Partition and SQL sources
+        read the tables that their refs name, so they wait for a task that unifies the table's partitions after
+        the sources in earlier stages that build the table are done. Generator and notebook sources could read
+        anything, so they wait for all of the earlier stages. Sources that read files don't wait at all.
+
+        A table is unified after all of the sources that may write to it, from source_outputs(), are done. Sources
+        whose outputs can't be determined may write to any table.
+
+        :param sched: A DAGScheduler
+        :param sources: Source records
+        :param source_task: Function that takes a source and a Shard, or None, and returns the function and
+            arguments for a task that processes the source or the shard.
+        :param unify_task: Function that takes a table name and an append flag, and returns the function and
+            arguments for a task that unifies the segment partitions of the table. If append is True, the task must
+            add the segments' rows to the partitions that an earlier task unified. If None, tables are not unified
+            between stages, or after the sources that build them are done.
+        :param finish_task: Function that takes a source and returns the function and arguments for a task that
+            runs after all of the source's shards are done. Required if any sources have shards.
+        :param shards: Dict of source vids to lists of Shards, or None
+        :param costs: Dict of source vids to estimated processing times, from source_costs(), or None. The
+            scheduler starts the most costly of the ready sources first.
+        :param memory: Dict of source vids to estimated peak memory, from source_memory(), or None. A source
+            only starts in a pool if its memory fits in the pool's memory budget.
+        """
+        from collections import defaultdict
+
+        shards = shards or {}
+        costs = costs or {}
+        memory = memory or {}
+
+        stage_of = lambda s: s.stage or 1
+
+        start_keys = {}  # Source vids to the keys of the tasks that start processing the source
+        producers = defaultdict(list)  # Table names to the sources that build them
+
+        for source in sources:
+            stage = stage_of(source)
+
+            if shards.get(source.vid):
+                start_keys[source.vid] = []
+
+                cost = costs.get(source.vid)
+
+                for shard in shards[source.vid]:
+                    f, args = source_task(source, shard)
+                    key = (source.vid, shard.n)
+                    sched.add(key, f, args, stage=stage, label='{} {}'.format(source.name, shard),
+                              cost=cost / len(shards[source.vid]) if cost is not None else None,
+                              memory=memory.get(source.vid))
+                    start_keys[source.vid].append(key)
+
+                f, args = finish_task(source)
+                sched.add(source.vid, f, args, deps=start_keys[source.vid], stage=stage,
+                          label='{} shards'.format(source.name), local=True)
+            else:
+                f, args = source_task(source, None)
+                sched.add(source.vid, f, args, stage=stage, label=source.name, cost=costs.get(source.vid),
+                          memory=memory.get(source.vid))
+                start_keys[source.vid] = [source.vid]
+
+            producers[source.dest_table_name].append(source)
+
+        # The sources that may write to each table. Sources whose outputs can't be determined may write to any table.
+        writers = defaultdict(list)
+        unknown = []
+
+        for source in sources:
+            outputs = self.source_outputs(source)
+
+            if outputs is None:
+                unknown.append(source)
+            else:
+                for table in outputs:
+                    writers[table].append(source)
+
+        for table in set(producers) | set(writers):
+            writers[table] += [s for s in unknown if s not in writers[table]]
+
+        unify_deps = defaultdict(set)  # Source vids to the unifications they wait for
+        unify_stages = defaultdict(set)  # Table names to the stages that need the table unified before them
+
+        for source in sources:
+            stage = stage_of(source)
+            earlier = [s for s in sources if stage_of(s) < stage]
+
+            inputs = self.source_inputs(source)
+
+            if inputs is None:
+                deps = set(s.vid for s in earlier)
+                inputs = set(s.dest_table_name for s in earlier)
+            else:
+                deps = set()
+
+            if unify_task:
+                for table in inputs:
+                    if any(stage_of(s) < stage for s in writers.get(table, [])):
+                        unify_stages[table].add(stage)
+                        deps.add(('unify', table, stage))
+
+            for key in start_keys[source.vid]:
+                sched.tasks[key].deps.update(deps)
+
+        # A table can be unified several times, before each stage that reads it and after all of its sources. The
+        # first unification replaces the partitions from earlier builds, and the later ones append to it.
+        for table, stages in iteritems(unify_stages):
+            for i, stage in enumerate(sorted(stages)):
+                f, args = unify_task(table, append=i > 0)
+                sched.add(('unify', table, stage), f, args, deps=[s.vid for s in writers[table] if stage_of(s) < stage],
+                          label='unify {} before stage {}'.format(table, stage))
+
+        # Sources that build a table in the same or later stages than a unification wait for it, so it
+        # doesn't coalesce their segments, and unifications of the same table run in order of stage.
+        unify_keys = [k for k in sched.tasks if isinstance(k, tuple) and k[0] == 'unify']
+
+        for _, table, stage in unify_keys:
+            for _, other_table, other_stage in unify_keys:
+                if other_table == table and other_stage < stage:
+                    sched.add_dependency(('unify', table, stage), ('unify', other_table, other_stage))
+
+            for s in writers[table]:
+                if stage_of(s) >= stage:
+                    for key in start_keys[s.vid]:
+                        sched.add_dependency(key, ('unify', table, stage))
+
+        # Each table is unified as soon as the last source that may write to it is done, so coalescing overlaps
+        # with building the other tables.
+        if unify_task:
+            for table, table_sources in iteritems(writers):
+                if not table:
+                    continue
+
+                f, args = unify_task(table, append=bool(unify_stages.get(table)))
+                sched.add(('unify', table), f, args,
+                          deps=[s.vid for s in table_sources] + [k for k in unify_keys if k[1] == table],
+                          label='unify {}'.format(table))
+
+        return sched
+
+    def _finish_shards(self, source_vids):
+        """Mark sources that were built in shards as built, after all of the shards are finished"""
+
+        for vid in source_vids:
+            self.source(vid).state = self.STATES.BUILT
+
+        self.commit()
+
     def collect_segment_partitions(self):
         """Return a dict of segments partitions, keyed on the name of the parent partition
         """
@@ -2435,9 +3150,14 @@ Caster Code
 
         return partitions
 
-    def unify_partitions(self):
+    def unify_partitions(self, tables=None, append=None):
         """For all of the segments for a partition, create the parent partition, combine the
-        children into the parent, and delete the children. """
+        children into the parent, and delete the children.
+
+        :param tables: If not None, only unify the partitions of these tables
+        :param append: If not None, the names of tables whose partitions were already unified in this build, so
+            the segments are appended to the rows already in the parent partitions.
+        """
 
         partitions = self.collect_segment_partitions()
 
@@ -2447,12 +3167,23 @@ Caster Code
         with self.progress.start('coalesce', 0, message='Coalescing partition segments') as ps:
 
             for name, segments in iteritems(partitions):
+                if tables is not None and name.table not in tables:
+                    continue
+
                 ps.add(item_type='partitions', item_count=len(segments),
                        message='Colescing partition {}'.format(name))
-                self.unify_partition(name, segments, ps)
+                self.unify_partition(name, segments, ps, append=append is not None and name.table in append)
+
+    def unify_partition(self, partition_name, segments, ps, append=False):
+        """Combine the segments of a partition into the parent partition, and delete the segments
 
-    def unify_partition(self, partition_name, segments, ps):
+        :param append: If True, keep the rows already in the parent partition, and add the segments' rows after
+            them. Otherwise, the parent partition is replaced.
+        """
         from ..orm.partition import Partition
+        from ambry_sources import MPRowsFile
+        from itertools import count
+        from ambry.etl import segment_sort_key, is_shard_segment
         from ambry.bundle.process import CallInterval
 
         if segments is None:
@@ -2470,13 +3201,42 @@ Caster Code
 
         parent.state = parent.STATES.COALESCING
 
+        previous = None  # Copy of the rows already in the parent, when appending
+
         if parent.local_datafile.exists:
-            ps.add('Removing existing datafile', partition=parent)
+            if append:
+                ps.add('Appending to existing datafile', partition=parent)
+                previous = MPRowsFile(self.build_fs, parent.cache_key + '-previous')
+
+                with parent.local_datafile.open() as f:
+                    previous.set_contents(f)
+            else:
+                ps.add('Removing existing datafile', partition=parent)
+
             parent.local_datafile.remove()
 
-        if len(segments) == 1:
-            seg = list(segments)[0]
-            # If there is only one segment, just move it over
+        n_previous = 0
+
+        if previous is not None:
+            with previous.reader as reader:
+                n_previous = reader.n_rows
+
+        # The same order as sorting by name, but with the shards of a source together and in order,
+        # so the row ids are the same as when the sources are built whole.
+        ordered = sorted(segments, key=lambda x: segment_sort_key(x.segment))
+
+        # Segments without rows don't contribute anything
+        n_rows = {}
+        for seg in ordered:
+            with self.wrap_partition(seg).local_datafile.reader as reader:
+                n_rows[seg.vid] = reader.n_rows
+
+        non_empty = [seg for seg in ordered if n_rows[seg.vid]] or ordered[:1]
+
+        # If there is only one segment with rows, just move it over, without decoding the rows. The rows of a
+        # shard's segment are numbered from the shard's first row, so they have to be copied to renumber them.
+        if len(non_empty) == 1 and not n_previous and not is_shard_segment(non_empty[0].segment):
+            seg = non_empty[0]
             ps.update('Coalescing single partition {} '.format(seg.identity.name), partition=seg)
 
             with self.wrap_partition(seg).local_datafile.open() as f:
@@ -2489,8 +3249,6 @@ Caster Code
 
         else:
 
-            i = 1  # Row id.
-
             def coalesce_progress_f(i):
                 (desc, n_records, total, rate) = parent.local_datafile.report_progress()
 
@@ -2500,19 +3258,30 @@ Caster Code
             coalesce_progress_f = CallInterval(coalesce_progress_f, 10)  # FIXME Should be a decorator
 
             with parent.local_datafile.writer as w:
-                for seg in sorted(segments, key=lambda x: b(x.name)):
+
+                ids = count(1)  # Row ids.
+                n_copied = 0
+
+                if n_previous:
+                    with previous.reader as reader:
+                        self._copy_segment_rows(reader, w, ids)
+
+                    n_copied += n_previous
+
+                for seg in non_empty:
                     ps.add('Coalescing {} '.format(seg.identity.name), partition=seg)
 
                     if not parent.epsg and seg.epsg:
                         parent.epsg = seg.epsg
 
                     with self.wrap_partition(seg).local_datafile.reader as reader:
-                        for row in reader.rows:
-                            w.insert_row((i,) + row[1:])  # Writes the ID Value
-                            i += 1
+                        self._copy_segment_rows(reader, w, ids)
 
-                            if i % 1000 == 1:
-                                coalesce_progress_f(i)
+                    n_copied += n_rows[seg.vid]
+                    coalesce_progress_f(n_copied)
+
+        if previous is not None:
+            previous.remove()
 
         parent.STATES.COALESCED
         self.commit()
@@ -2531,66 +3300,73 @@ Caster Code
 
         return str(partition_name)
 
-    def exec_context(self, **kwargs):
+    @staticmethod
+    def _copy_segment_rows(reader, writer, ids):
+        """Copy the rows of a segment to the parent partition, replacing the id in the first column with the
+        next value from the ids iterator. """
+        from six.moves import zip
+
+        insert_row = writer.insert_row
+
+        # The rows come first, so an id isn't used up when the rows run out
+        for row, i in zip(reader.rows, ids):
+            insert_row((i,) + row[1:])  # Writes the ID Value
+
+    def exec_context(self, names=None, **kwargs):
         """Base environment for evals, the stuff that is the same for all evals. Primarily used in the
-        Caster pipe"""
+        Caster pipe
+
+        The part of the environment that comes from library modules is built once per process, and the
+        functions from the bundle class are collected once per bundle.
+
+        :param names: If not None, only include these names in the environment. Compiled code only
+            needs the names that it references, which are returned by ambry.etl.codegen.code_names()
+        :param kwargs: Additional entries for the environment.
+        """
         import inspect
-        import dateutil.parser
-        import datetime
-        import random
-        from functools import partial
-        from ambry.valuetype.types import parse_date, parse_time, parse_datetime
-        import ambry.valuetype.types
-        import ambry.valuetype.exceptions
-        import ambry.valuetype.test
-        import ambry.valuetype
-
-
-        def set_from(f, frm):
-            try:
-                try:
-                    f.ambry_from = frm
-                except AttributeError:  # for instance methods
-                    f.im_func.ambry_from = frm
-            except (TypeError, AttributeError):  # Builtins, non python code
-                pass
 
-            return f
-
-        test_env = dict(
-            parse_date=parse_date,
-            parse_time=parse_time,
-            parse_datetime=parse_datetime,
-            partial=partial,
-            bundle=self
-        )
-
-        test_env.update(kwargs)
-        test_env.update(dateutil.parser.__dict__)
-        test_env.update(datetime.__dict__)
-        test_env.update(random.__dict__)
-        test_env.update(ambry.valuetype.core.__dict__)
-        test_env.update(ambry.valuetype.types.__dict__)
-        test_env.update(ambry.valuetype.exceptions.__dict__)
-        test_env.update(ambry.valuetype.test.__dict__)
-        test_env.update(ambry.valuetype.__dict__)
+        if self._exec_context is None:
+            self._exec_context = self._bundle_exec_context()
 
-        localvars = {}
+        # Bundle module functions. These are collected on every call, since the module can be reloaded
+        module_entries = inspect.getmembers(sys.modules['ambry.build'], predicate=inspect.isfunction)
+
+        # Later layers override earlier ones
+        layers = [
+            {'bundle': self},
+            {k: _set_from(v, 'env') for k, v in kwargs.items() if not isinstance(v, (str, tuple))},
+            _static_exec_context(),
+            self._exec_context,
+            {f_name: _set_from(func, 'module') for f_name, func in module_entries}
+        ]
 
-        for f_name, func in test_env.items():
-            if not isinstance(func, (str, tuple)):
-                localvars[f_name] = set_from(func, 'env')
+        env = {}
 
-        # The 'b' parameter of randint is assumed to be a bundle, but
-        # replacing it with a lambda prevents the param assignment
-        localvars['randint'] = lambda a, b: random.randint(a, b)
+        if names is None:
+            for layer in layers:
+                env.update(layer)
+        else:
+            for name in names:
+                for layer in reversed(layers):
+                    if name in layer:
+                        env[name] = layer[name]
+                        break
+
+        return env
+
+    def _bundle_exec_context(self):
+        """Return the part of the exec_context() environment that comes from the bundle class: the functions
+        and bound methods that the bundle adds to Bundle. """
+        import inspect
+
+        localvars = {}
 
-        if self != Bundle:
+        if self.__class__ != Bundle:
             # Functions from the bundle
             base = set(inspect.getmembers(Bundle, predicate=inspect.isfunction))
             mine = set(inspect.getmembers(self.__class__, predicate=inspect.isfunction))
 
-            localvars.update({f_name: set_from(func, 'bundle') for f_name, func in mine - base})
+            localvars.update({f_name: _set_from(func, 'bundle') for f_name, func in mine - base})
 
             # Bound methods. In python 2, these must be called referenced from the bundle, since
             # there is a difference between bound and unbound methods. In Python 3, there is no differnce,
@@ -2599,26 +3375,147 @@ Caster Code
             mine = set(inspect.getmembers(self.__class__, predicate=inspect.ismethod))
 
             # Functions are descriptors, and the __get__ call binds the function to its object to make a bound method
-            localvars.update({f_name: set_from(func.__get__(self), 'bundle') for f_name, func in (mine - base)})
+            localvars.update({f_name: _set_from(func.__get__(self), 'bundle') for f_name, func in (mine - base)})
 
-        # Bundle module functions
+        return localvars
 
-        module_entries = inspect.getmembers(sys.modules['ambry.build'], predicate=inspect.isfunction)
+    @property
+    def code_version(self):
+        """Return the hashes of the bundle's code files, bundle.py and lib.py, with None for missing files"""
+        from ambry.orm.exc import NotFoundError
+
+        if self._code_version is None:
+            # The bundle's classes are loaded once, so the hashes don't need to be re-read for every source
+            self._code_version = []
+            for path in ('bundle.py', 'lib.py'):
+                try:
+                    self._code_version.append(self.dataset.bsfile(path).hash)
+                except NotFoundError:
+                    self._code_version.append(None)
 
+        return self._code_version
 
-        localvars.update({f_name: set_from(func, 'module') for f_name, func in module_entries})
+    def caster_code_key(self, source, source_headers, vectorize=False):
+        """Return a hash of everything that the generated caster code for a source depends on: the
+        destination table's columns, with their datatypes, valuetypes and transforms, the source headers,
+        the bundle and library code, the version of the code generator and the ambry version. Sources with the
+        same key can share compiled caster code. """
+        import hashlib
+        from six import text_type
+        from ambry._meta import __version__
+        from ambry.etl.codegen import CODE_VERSION
 
-        return localvars
+        parts = [__version__, CODE_VERSION, sys.version_info[:2], bool(vectorize), source.dest_table.name,
+                 list(source_headers)]
+
+        for c in source.dest_table.columns:
+            parts += [c.sequence_id, c.name, c.datatype, c.valuetype, c.transform]
+
+        parts += self.code_version
+
+        return hashlib.sha1(u'\0'.join(text_type(p) for p in parts).encode('utf8')).hexdigest()
+
+    def _load_caster_code(self, key):
+        """Return the caster code for a key, as a tuple of the code and the compiled code, from the process
+        cache or the build directory, or None if it isn't cached"""
+        import marshal
+        from fs.errors import FSError
+
+        try:
+            return _caster_code_cache[key]
+        except KeyError:
+            pass
 
-    def build_caster_code(self, source, source_headers, pipe=None):
+        path = '{}/{}.marshal'.format(CASTER_CACHE_DIR, key)
 
-        from ambry.etl.codegen import make_row_processors, make_env
+        try:
+            if not self.build_fs.exists(path):
+                return None
+
+            code, code_obj = marshal.loads(self.build_fs.getcontents(path, 'rb'))
+        except (ValueError, EOFError, TypeError):
+            # Partially written, or from another Python version
+            return None
+        except FSError as e:
+            self.warn("Failed to load caster code cache from '{}': {}".format(path, e))
+            return None
+
+        _caster_code_cache[key] = code, code_obj
+
+        return code, code_obj
+
+    def _save_caster_code(self, key, code, code_obj):
+        """Save caster code and its compiled code to the process cache, and to the build directory, where other
+        processes building the bundle can load it. """
+        import marshal
+        from fs.errors import FSError
+
+        _caster_code_cache[key] = code, code_obj
+
+        path = '{}/{}.marshal'.format(CASTER_CACHE_DIR, key)
+        tmp_path = '{}.{}'.format(path, os.getpid())
+
+        fs = self.build_fs.wrapped_fs if isinstance(self.build_fs, LazyFS) else self.build_fs
+
+        try:
+            fs.makedir(CASTER_CACHE_DIR, allow_recreate=True, recursive=True)
+            # Write and rename, so other processes never load a partial file
+            fs.setcontents(tmp_path, marshal.dumps((code, code_obj)))
+            fs.rename(tmp_path, path)
+        except FSError as e:
+            self.warn("Failed to save caster code cache to '{}': {}".format(path, e))
+
+    def build_caster_code(self, source, source_headers, pipe=None, vectorize=False):
+        """Generate and compile the caster code for a source. Returns the list of row processors, or, if
+        vectorize is True, a tuple of the row processors and the batch processor, which is None if none of
+        the columns could be vectorized.
+
+        The compiled code is cached by caster_code_key(), in memory and in the build directory, so it is
+        only generated and compiled once for all of the sources that share a destination table and source
+        headers, including sources built in other processes. The code is written to /code/casters/<key>.py
+        when it is compiled, so tracebacks and debuggers reference that file. """
+
+        from ambry.etl.codegen import make_row_processors, code_names
+
+        key = self.caster_code_key(source, source_headers, vectorize)
+
+        cached = self._load_caster_code(key)
+
+        if cached is None:
+            code = make_row_processors(pipe.bundle, source_headers, source.dest_table, env=self.exec_context(),
+                                       vectorize=vectorize)
+
+            abs_path = self.write_code('casters', key, code)
+            code_obj = compile(code, abs_path, 'exec')
+
+            self._save_caster_code(key, code, code_obj)
+        else:
+            code, code_obj = cached
+
+        env_dict = self.exec_context(names=code_names(code_obj))
 
-        env_dict = self.exec_context()
+        env_dict['bundle'] = self
+        env_dict['source'] = source
+        env_dict['pipe'] = pipe
 
-        code = make_row_processors(pipe.bundle, source_headers, source.dest_table, env=env_dict)
+        exec (code_obj, env_dict)
+
+        if vectorize:
+            return env_dict['row_processors'], env_dict['batch_processor']
+
+        return env_dict['row_processors']
 
-        path = '/code/casters/{}.py'.format(source.name)
+    def write_code(self, kind, name, code):
+        """Write generated code to the /code directory of the build filesystem, so it can be
+        inspected and debugged.
+
+        :param kind: Subdirectory of /code, such as 'casters'
+        :param name: Name of the file, without the .py extension
+        :param code: The source code
+        :return: The system path to the file, or '<string>' if the build fs has no system paths.
+        """
+
+        path = '/code/{}/{}.py'.format(kind, name)
 
         self.build_fs.makedir(os.path.dirname(path), allow_recreate=True, recursive=True)
         # LazyFS should handled differently because of:
@@ -2630,17 +3527,9 @@ Caster Code
 
         # The abs_path is just for reporting line numbers in debuggers, etc.
         try:
-            abs_path = self.build_fs.getsyspath(path)
+            return self.build_fs.getsyspath(path)
         except:
-            abs_path = '<string>'
-
-        env_dict['bundle'] = self
-        env_dict['source'] = source
-        env_dict['pipe'] = pipe
-
-        exec (compile(code, abs_path, 'exec'), env_dict)
-
-        return env_dict['row_processors']
+            return '<string>'
 
     def finalize_write_bundle_file(self):
 
@@ -2909,8 +3798,17 @@ Caster Code
 
         self.commit()
 
+        with self.progress.start('checkin', 0, message='Package bundle') as ps:
+
+            def copy_cb(message, n):
+                ps.add(message=message, item_type='records', item_count=n)
+
+            if source_only:
+                ds = db.copy_dataset_files(self.dataset, incver=incver, cb=copy_cb, **kwargs)
+            else:
+                ds = db.copy_dataset(self.dataset, incver=incver, cb=copy_cb, **kwargs)
+
         if source_only:
-            ds = db.copy_dataset_files(self.dataset, incver=incver, **kwargs)
             ds.state = Bundle.STATES.SOURCE
 
             # Hack, but I'm tired of fighting with it.
@@ -2932,9 +3830,6 @@ Caster Code
             pl.build.commit()
             db.commit()
 
-        else:
-            ds = db.copy_dataset(self.dataset, incver=incver, **kwargs)
-
         b = Bundle(ds, self.library)
         bfs = b.build_source_files.file(File.BSFILE.META)
         bfs.update_identity()
@@ -7,6 +7,7 @@ the Revised BSD License, included in this distribution as LICENSE.txt
 """
 
 import os
+import threading
 from multiprocessing.pool import debug, MaybeEncodingError, Pool as MPPool, MapResult
 
 #import multiprocessing, logging
@@ -16,6 +17,102 @@ from multiprocessing.pool import debug, MaybeEncodingError, Pool as MPPool, MapR
 
 
 
+class MemoryWatchdog(threading.Thread):
+    """Sample the resident set size of this process while it runs a task, and record the peak of the memory that
+    the task added to the RSS the process had when the task started. A warm worker keeps memory from its earlier
+    tasks, so the task is only charged for its own growth. If the growth exceeds the limit, call
+    on_exceed(growth), which should report the failure of the task and end the process."""
+
+    interval = .5  # Seconds between samples
+
+    def __init__(self, limit=None, on_exceed=None):
+        from ambry.util import process_rss
+
+        super(MemoryWatchdog, self).__init__()
+        self.daemon = True
+
+        self.limit = limit
+        self.base = process_rss() or 0  # RSS at the start of the task
+        self.peak = 0  # Peak growth of the RSS over base
+        self._on_exceed = on_exceed
+        self._stopped = threading.Event()
+
+    def sample(self):
+        from ambry.util import process_rss
+
+        rss = process_rss()
+
+        if rss is None:
+            return False
+
+        growth = max(rss - self.base, 0)
+
+        self.peak = max(self.peak, growth)
+
+        if self.limit and growth > self.limit and self._on_exceed:
+            self._on_exceed(growth)
+            return False
+
+        return True
+
+    def run(self):
+        while self.sample() and not self._stopped.wait(self.interval):
+            pass
+
+    def stop(self):
+        self._stopped.set()
+        self.sample()
+
+
+_watchdog = None  # Watchdog for the task that this process is running
+
+
+def start_watchdog(on_exceed):
+    """Start watching the memory of a task. The limit, in bytes, is from the AMBRY_MEMORY_LIMIT env var, which is
+    set by init_library()"""
+    global _watchdog
+
+    _watchdog = MemoryWatchdog(int(os.getenv('AMBRY_MEMORY_LIMIT', 0)) or None, on_exceed)
+    _watchdog.start()
+
+    return _watchdog
+
+
+def stop_watchdog():
+    global _watchdog
+
+    if _watchdog:
+        _watchdog.stop()
+        _watchdog = None
+
+
+def memory_limit_error(growth):
+    from ambry.dbexceptions import MemoryLimitError
+
+    return MemoryLimitError('Worker {} exceeded the memory limit, with a task using {:0.0f} MB'
+                            .format(os.getpid(), growth / 2.0 ** 20))
+
+
+def _put_exit(put, job, i):
+    """Return an on_exceed function for a MemoryWatchdog that reports the task as failed to the pool,
+    then exits, so the pool will replace the worker"""
+
+    def on_exceed(growth):
+        put((job, i, (False, memory_limit_error(growth))))
+        os._exit(1)
+
+    return on_exceed
+
+
+def record_memory(ps, source):
+    """Record the peak memory that the running task added to the worker in a process record for the source.
+    Bundle.source_memory() uses the records to estimate the memory a source will need"""
+
+    if _watchdog and _watchdog.peak:
+        ps.add(message='Peak memory {:0.0f} MB'.format(_watchdog.peak / 2.0 ** 20), source=source,
+               item_type='memory', data=dict(task_rss=_watchdog.peak, start_rss=_watchdog.base))
+
+
 def worker(inqueue, outqueue, initializer=None, initargs=(), maxtasks=None):
     """ Custom worker for bundle operations
 
@@ -61,6 +158,8 @@ def worker(inqueue, outqueue, initializer=None, initargs=(), maxtasks=None):
     mp_func = args[0][0]
     mp_args = list(args[0][1][0])
 
+    start_watchdog(_put_exit(put, job, i))
+
     library = new_library(get_runconfig())
     library.database.close()  # Maybe it is still open after the fork.
     library.init_debug()
@@ -91,6 +190,8 @@ def worker(inqueue, outqueue, initializer=None, initargs=(), maxtasks=None):
 
     assert result
 
+    stop_watchdog()
+
     b.progress.close()
     library.close()
 
@@ -102,6 +203,132 @@ def worker(inqueue, outqueue, initializer=None, initargs=(), maxtasks=None):
         put((job, i, (False, wrapped)))
 
 
+def _warm_bundle(library, bundles, bundle_vid):
+    """Return the bundle for a vid, cast to its subclass, loading it only on the first task for the bundle"""
+
+    try:
+        return bundles[bundle_vid]
+    except KeyError:
+        pass
+
+    b = library.bundle(bundle_vid)
+    library.logger = b.logger  # So library logs to the same file as the bundle.
+
+    b = b.cast_to_subclass()
+    b.multi = True  # In parent it is a number, in child, just needs to be true to get the right logger template
+    b.is_subprocess = True
+    b.limited_run = bool(int(os.getenv('AMBRY_LIMITED_RUN', 0)))
+
+    bundles[bundle_vid] = b
+
+    return b
+
+
+def _reset_bundle(library, b):
+    """Discard the state of the last task, so the next one starts with a clean session. Objects loaded in the
+    last task are detached, and the bundle reloads its dataset when it is next used. """
+
+    if b is not None and b._progress:
+        b._progress.close()
+        b._progress = None
+        b._ps = None
+
+    try:
+        library.database.session.rollback()
+    finally:
+        library.database.close_session()
+
+
+def warm_worker(inqueue, outqueue, initializer=None, initargs=(), maxtasks=None):
+    """ Worker for bundle operations that runs many tasks in one process.
+
+    Unlike worker(), which builds a new library and loads the bundle code for a single task, this worker keeps
+    the library, and the bundle for each bundle vid, across tasks. Compiled caster code is also cached, in
+    the module caches of ambry.bundle.bundle. The database session is reset after each task.
+
+    :param maxtasks: If not None, exit after this many tasks, and the pool will start a new worker.
+    """
+    from ambry.library import new_library
+    from ambry.run import get_runconfig
+    import traceback
+
+    assert maxtasks is None or (type(maxtasks) == int and maxtasks > 0)
+
+    put = outqueue.put
+    get = inqueue.get
+
+    if hasattr(inqueue, '_writer'):
+        inqueue._writer.close()
+        outqueue._reader.close()
+
+    if initializer is not None:
+        initializer(*initargs)
+
+    library = None
+    bundles = {}
+    completed = 0
+
+    while maxtasks is None or completed < maxtasks:
+        try:
+            task = get()
+        except (EOFError, IOError):
+            debug('worker got EOFError or IOError -- exiting')
+            break
+
+        if task is None:
+            debug('worker got sentinel -- exiting')
+            break
+
+        job, i, func, args, kwds = task
+
+        # Tasks are submitted one at a time, with map_async() and a chunksize of 1
+        mp_func = args[0][0]
+        mp_args = list(args[0][1][0])
+
+        bundle_vid = mp_args[0]
+        b = None
+
+        start_watchdog(_put_exit(put, job, i))
+
+        try:
+            if library is None:
+                library = new_library(get_runconfig())
+                library.database.close()  # Maybe it is still open after the fork.
+                library.init_debug()
+
+            b = _warm_bundle(library, bundles, bundle_vid)
+
+            mp_args[0] = b
+            result = (True, [mp_func(*mp_args)])
+
+        except Exception as e:
+            tb = traceback.format_exc()
+            if b is not None:
+                b.error('Subprocess {} raised an exception: {}'.format(os.getpid(), e.message), False)
+                b.error(tb, False)
+            result = (False, e)
+
+            # Don't trust a bundle that failed part way through a task
+            bundles.pop(bundle_vid, None)
+
+        stop_watchdog()
+
+        if library is not None:
+            _reset_bundle(library, b)
+
+        try:
+            put((job, i, result))
+        except Exception as e:
+            wrapped = MaybeEncodingError(e, result[1])
+            debug("Possible encoding error while sending result: %s" % (wrapped))
+            put((job, i, (False, wrapped)))
+
+        completed += 1
+
+    if library is not None:
+        library.close()
+
+
 def add_bundle_to_args(library, mp_args):
     return mp_args
 
@@ -115,6 +342,16 @@ class Pool(MPPool):
         super(Pool, self).__init__(processes, initializer, initargs, maxtasksperchild)
 
 
+    memory_budget = None  # Bytes of memory that the tasks in the pool may use together, or None for no limit
+
+    def worker_rss(self):
+        """Return the total resident set size of the worker processes, in bytes, or None if it isn't available"""
+        from ambry.util import process_rss
+
+        rss = [r for r in (process_rss(p.pid) for p in self._pool) if r]
+
+        return sum(rss) if rss else None
+
     def _repopulate_pool(self):
         """Bring the number of pool processes up to the specified number,
         for use after reaping workers which have exited.
@@ -134,7 +371,7 @@ def alt_init(l): # For testing
     global library
     library = l
 
-def init_library(database_dsn, accounts_password, limited_run = False):
+def init_library(database_dsn, accounts_password, limited_run = False, memory_limit=None):
     """Child initializer, setup in Library.process_pool"""
 
     import os
@@ -149,29 +386,45 @@ def init_library(database_dsn, accounts_password, limited_run = False):
     if accounts_password:
         os.environ['AMBRY_PASSWORD'] = accounts_password
     os.environ['AMBRY_LIMITED_RUN'] = '1' if limited_run else '0'
+    os.environ['AMBRY_MEMORY_LIMIT'] = str(int(memory_limit or 0))
+    os.environ['AMBRY_WORKER'] = '1'  # Workers may use different database connection settings
 
 
-def build_mp(b, stage, source_name, force):
-    """Ingest a source, using only arguments that can be pickled, for multiprocessing access"""
+def build_mp(b, stage, source_name, force, shard=None, reuse_builds=False, base_fingerprint=None):
+    """Build a source, or one shard of a source, using only arguments that can be pickled, for multiprocessing
+    access"""
+
+    b.reuse_builds = reuse_builds
 
     source = b.source(source_name)
 
     with b.progress.start('build_mp',stage,message="MP build", source=source) as ps:
-        ps.add(message='Running source {}'.format(source.name), source=source, state='running')
-        r = b.build_source(stage, source, ps, force)
+        ps.add(message='Running source {}{}'.format(source.name, ', ' + str(shard) if shard else ''),
+               source=source, state='running')
+        r = b.build_source(stage, source, ps, force, shard=shard, base_fingerprint=base_fingerprint)
+        record_memory(ps, source)
 
     return r
 
 
-def unify_mp(b, partition_name):
+def unify_mp(b, partition_name, append=False):
     """Unify all of the segment partitions for a parent partition, then run stats on the MPR file"""
 
     with b.progress.start('coalesce_mp',0,message="MP coalesce {}".format(partition_name)) as ps:
-        r = b.unify_partition(partition_name, None, ps)
+        r = b.unify_partition(partition_name, None, ps, append=append)
 
     return r
 
 
+def unify_table_mp(b, table_name, append=False):
+    """Unify all of the segment partitions for a table. If append is True, the segments are added to the rows of
+    partitions that were unified earlier in the build"""
+
+    b.unify_partitions([table_name], append=[table_name] if append else None)
+
+    return table_name
+
+
 def ingest_mp(b, stage, source_name, clean_files):
     """Ingest a source, using only arguments that can be pickled, for multiprocessing access"""
 
@@ -179,5 +432,6 @@ def ingest_mp(b, stage, source_name, clean_files):
 
     with b.progress.start('ingest_mp',0,message="MP ingestion", source=source) as ps:
         r =  b._ingest_source(source, ps, clean_files)
+        record_memory(ps, source)
 
     return r
@@ -564,7 +564,11 @@ class MetadataFile(DictBuildSourceFile):
         # Maybe use this to avoid overwriting configs that changed by bundle program.
         # fs_sync_time = self._dataset.config.sync[self.file_const][self.file_to_record]
 
-        self._dataset.config.metadata.set(ad)
+        metadata = self._dataset.config.metadata
+
+        # Write all of the config records in one transaction, rather than committing each term
+        with metadata.deferred_writes():
+            metadata.set(ad)
 
         self._dataset._database.commit()
 
@@ -940,7 +944,7 @@ class SchemaFile(RowBuildSourceFile):
 
     def record_to_objects(self):
         """Create config records to match the file metadata"""
-        from ambry.orm import Column, Table, Dataset
+        from ambry.orm import Column
 
         def _clean_int(i):
             if i is None:
@@ -965,7 +969,7 @@ class SchemaFile(RowBuildSourceFile):
         errors = []
         warnings = []
 
-        extant_tables = {t.name: t for t in self._dataset.tables}
+        loader = SchemaLoader(self._dataset)
 
         old_types_map = {
             'varchar': Column.DATATYPE_STR,
@@ -979,7 +983,6 @@ class SchemaFile(RowBuildSourceFile):
         from ambry.bundle.process import CallInterval
         run_progress_f = CallInterval(run_progress_f, 10)
 
-        table_number = self._dataset._database.next_sequence_id(Dataset, self._dataset.vid, Table)
         for row in bsfile.dict_row_reader:
 
             line_no += 1
@@ -1023,47 +1026,26 @@ class SchemaFile(RowBuildSourceFile):
             # There are still some old data types hanging around
             data_type = old_types_map.get(data_type.lower(), data_type)
 
-            table_name = row['table']
-
-            try:
-                table = extant_tables[table_name]
-            except KeyError:
-                table = self._dataset.new_table(
-                    table_name,
-                    sequence_id=table_number,
-                    description=row.get('description') if row['column'] == 'id' else ''
-                )
-
-                table_number += 1
-                extant_tables[table_name] = table
-
             data = {k.replace('d_', '', 1): v
                     for k, v in list(row.items()) if k and k.startswith('d_') and v}
 
-            if row['column'] == 'id':
-                table.data.update(data)
-                data = {}
-
-            table.add_column(
+            loader.add_column(
+                row['table'],
                 row['column'],
-                fk_vid=row['is_fk'] if row.get('is_fk', False) else None,
                 description=(row.get('description', '') or '').strip(),
                 datatype=data_type,
                 valuetype=value_type,
                 parent=row.get('parent'),
-                proto_vid=row.get('proto_vid'),
                 size=_clean_int(row.get('size', None)),
                 width=_clean_int(row.get('width', None)),
                 data=data,
                 keywords=row.get('keywords'),
-                measure=row.get('measure'),
                 transform=row.get('transform'),
                 derivedfrom=row.get('derivedfrom'),
                 units=row.get('units', None),
-                universe=row.get('universe'),
-                update_existing= True)
+                universe=row.get('universe'))
 
-        self._dataset.t_sequence_id = table_number
+        loader.load()
 
         return warnings, errors
 
@@ -1122,6 +1104,232 @@ class SchemaFile(RowBuildSourceFile):
         bsfile.update_contents(msgpack.packb(rows), 'application/msgpack')
 
 
+class SchemaLoader(object):
+    """Apply the rows of a schema file to the tables and columns of a dataset in bulk.
+
+    The existing tables and columns are read with one query each, the rows are applied to them in memory with the
+    same rules as Dataset.new_table() and Table.add_column(), and then only the new and changed records are
+    written, with executemany inserts and updates in the session's transaction. Large schemas, such as those
+    for the US Census, have tens of thousands of columns, and creating ORM objects for them one at a time
+    takes minutes.
+    """
+
+    def __init__(self, dataset):
+        from collections import OrderedDict
+
+        self._dataset = dataset
+        self._database = dataset._database
+
+        self.tables = OrderedDict()  # Table records, keyed by name
+        self.columns = {}  # Column records, keyed by table name then column name
+
+        self._new = set()  # Keys of the table and column records that are not in the database
+        self._loaded = {}  # The original values of the records that are in the database
+        self._table_numbers = {}  # Parsed table vids, for creating column numbers
+
+        self._read()
+
+    @staticmethod
+    def _attrs(orm_class):
+        """Map ORM attribute names to database column names"""
+        return {p.key: p.columns[0].name for p in orm_class.__mapper__.column_attrs}
+
+    def _read(self):
+        from sqlalchemy.sql import select
+        from ambry.orm import Table, Column
+
+        session = self._database.session
+
+        # Pending changes must be in the database before it is read and written directly
+        session.flush()
+
+        def records(orm_class):
+            attrs = self._attrs(orm_class)
+            q = select([orm_class.__table__]).where(orm_class.__table__.c[attrs['d_vid']] == self._dataset.vid)
+
+            for row in session.execute(q):
+                yield {k: row[c] for k, c in attrs.items()}
+
+        for t in records(Table):
+            self.tables[t['name']] = t
+            self.columns[t['name']] = {}
+            self._loaded[(Table, t['name'])] = dict(t)
+
+        table_names = {t['vid']: t['name'] for t in self.tables.values()}
+
+        for c in records(Column):
+            c['t_name'] = table_names[c['t_vid']]
+            self.columns[c['t_name']][c['name']] = c
+            self._loaded[(Column, c['t_name'], c['name'])] = dict(c)
+
+    def new_table(self, name, description=None):
+        from ambry.orm import Table, Dataset
+        from ambry.identity import ObjectNumber, TableNumber
+
+        sequence_id = self._database.next_sequence_id(Dataset, self._dataset.vid, Table)
+
+        dataset_vid = ObjectNumber.parse(self._dataset.vid)
+
+        t = dict(name=name, d_vid=self._dataset.vid, d_id=str(dataset_vid.rev(None)),
+                 id=str(TableNumber(dataset_vid.rev(None), sequence_id)),
+                 vid=str(TableNumber(dataset_vid, sequence_id)),
+                 sequence_id=sequence_id, description=description, data={}, c_sequence_id=1)
+
+        self.tables[name] = t
+        self.columns[name] = {}
+        self._new.add((Table, name))
+
+        self.add_column(name, 'id', datatype='int', is_primary_key=True, description=description)
+
+        return t
+
+    def add_column(self, table_name, name, **kwargs):
+        """Add a column to the table, or update it, with the same rules as Table.add_column(), and create the
+        table if it doesn't exist. """
+        from ambry.orm import Table, Column
+        from ambry.identity import ObjectNumber, ColumnNumber
+
+        table_name = Table.mangle_name(table_name)
+        name = Column.mangle_name(name)
+
+        attrs = self._attrs(Column)
+
+        for key in kwargs:
+            if key not in attrs and key != 'transform':
+                raise AttributeError("Column record has no attribute {}".format(key))
+
+        try:
+            t = self.tables[table_name]
+        except KeyError:
+            t = self.new_table(table_name, description=kwargs.get('description') if name == 'id' else '')
+
+        if name == 'id':
+            # The data for the id row is for the table
+            t['data'] = dict(t['data'] or {}, **kwargs.get('data', {}))
+            kwargs['data'] = {}
+
+        columns = self.columns[table_name]
+
+        try:
+            c = columns[name]
+        except KeyError:
+            sequence_id = max(t['c_sequence_id'] or 1, len(columns) + 1)
+            t['c_sequence_id'] = sequence_id + 1
+
+            try:
+                ton = self._table_numbers[t['vid']]
+            except KeyError:
+                ton = self._table_numbers[t['vid']] = ObjectNumber.parse(t['vid'])
+
+            con = ColumnNumber(ton, sequence_id)
+
+            # Start with every attribute unset, as a new Column object has them, so that altname, description
+            # and the others are None when the record is inserted or compared
+            c = columns[name] = dict.fromkeys(attrs)
+            c.update(vid=str(con), id=str(con.rev(None)), sequence_id=sequence_id, t_vid=t['vid'],
+                     d_vid=self._dataset.vid, t_name=table_name, name=name, datatype='str', is_primary_key=False,
+                     _transform=Column.clean_transform(None), data=None)
+            self._new.add((Column, table_name, name))
+
+        c['data'] = dict(c['data'] or {}, **kwargs.get('data', {}))
+
+        for key, value in kwargs.items():
+
+            if key == 'data':
+                continue
+
+            # Don't update the type if the user has specfied a custom type
+            if key == 'datatype' and c['datatype'] not in Column.types:
+                continue
+
+            # Don't change a datatype if the value is set and the new value is unknown
+            if key == 'datatype' and value == 'unknown' and c['datatype']:
+                continue
+
+            if key == 'description' and not value:
+                continue
+
+            if key == 'is_primary_key' and isinstance(value, str) and len(value) == 0:
+                value = False
+
+            if key == 'transform':
+                c['_transform'] = Column.clean_transform(value)
+            else:
+                c[key] = value
+
+        # If the id column has a description and the table does not, add it to
+        # the table.
+        if name == 'id' and c['is_primary_key'] and not t['description']:
+            t['description'] = c.get('description')
+
+        return c
+
+    def _write(self, orm_class, records, keys):
+        """Insert the new records and update the changed ones"""
+        from sqlalchemy import bindparam
+
+        attrs = self._attrs(orm_class)
+        table = orm_class.__table__
+        session = self._database.session
+
+        defaults = {k: (table.c[c].default.arg if table.c[c].default is not None else None)
+                    for k, c in attrs.items()}
+
+        inserts = []
+        updates = []
+
+        for key, r in zip(keys, records):
+            key = (orm_class,) + key
+
+            if key in self._new:
+                inserts.append({c: r.get(k, defaults[k]) for k, c in attrs.items()})
+            else:
+                orig = self._loaded[key]
+                changed = {attrs[k]: r[k] for k in attrs if r[k] != orig[k]}
+
+                if changed:
+                    updates.append(changed)
+                    changed['_vid'] = r['vid']
+
+        if inserts:
+            session.execute(table.insert(), inserts)
+
+        # Executemany requires the same parameters for every row, so group the updates by the columns they change
+        groups = {}
+        for u in updates:
+            groups.setdefault(tuple(sorted(u.keys())), []).append(u)
+
+        for group in groups.values():
+            session.execute(table.update().where(table.c[attrs['vid']] == bindparam('_vid')), group)
+
+        return len(inserts), len(updates)
+
+    def load(self):
+        """Write the tables and columns, and expire the ORM objects that have been changed"""
+        from ambry.orm import Table, Column
+
+        session = self._database.session
+
+        n_tables = self._write(Table, list(self.tables.values()), [(k,) for k in self.tables.keys()])
+
+        column_keys = []
+        columns = []
+        for table_name, table_columns in self.columns.items():
+            for name, c in table_columns.items():
+                column_keys.append((table_name, name))
+                columns.append(c)
+
+        n_columns = self._write(Column, columns, column_keys)
+
+        for o in list(session.identity_map.values()):
+            if isinstance(o, (Table, Column)) and o.d_vid == self._dataset.vid:
+                session.expire(o)
+
+        session.expire(self._dataset, ['tables'])
+
+        return n_tables, n_columns
+
+
 class SourceSchemaFile(RowBuildSourceFile):
 
     file_const = File.BSFILE.SOURCESCHEMA
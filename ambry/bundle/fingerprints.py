@@ -0,0 +1,181 @@
+"""A content-addressed store for the segment partitions that source builds produce.
+
+Each build of a source is keyed by a fingerprint: a hash of everything the build reads. A later build
+of a source with the same fingerprint copies the stored partitions instead of running the pipeline.
+The store is limited in size; the entries that were used least recently are removed first.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of the
+Revised BSD License, included in this distribution as LICENSE.txt
+
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import types
+
+
+def file_hash(f, block_size=1024 * 1024):
+    """Return the SHA1 hash of the contents of an open file"""
+
+    h = hashlib.sha1()
+
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        h.update(block)
+
+    return h.hexdigest()
+
+
+def json_default(o):
+    """JSON encoder default for the parts of a fingerprint. Classes and functions are encoded by name, and dates
+    in ISO format. Other objects don't have a representation that is stable between processes, so they raise
+    a TypeError, rather than putting a repr with a memory address into the fingerprint. """
+    from ambry.util import qualified_name
+
+    if isinstance(o, (type, types.FunctionType, types.BuiltinFunctionType)):
+        return qualified_name(o)
+    elif isinstance(o, (datetime.date, datetime.time)):
+        return o.isoformat()
+    elif isinstance(o, (set, frozenset)):
+        return sorted(o)
+
+    raise TypeError("Can't fingerprint a value of type {}: {!r}".format(type(o).__name__, o))
+
+
+class FingerprintStore(object):
+    """A directory of build outputs, keyed by fingerprint.
+
+    Each entry is a directory. It holds a manifest that describes the partitions and a copy of each
+    partition's datafile. An entry is written to a temporary directory and then renamed, so readers
+    never see a partial entry. This lets processes and machines share the directory.
+
+    If max_size is set, storing an entry removes the least recently used entries until the store is no larger
+    than max_size bytes. Reading an entry's manifest marks it as used.
+    """
+
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, root, max_size=None):
+        self.root = root
+        self.max_size = max_size
+
+    def path(self, fingerprint, *args):
+        """Return the path to the entry for a fingerprint, or to a file in it"""
+        return os.path.join(self.root, fingerprint[:2], fingerprint, *args)
+
+    def get(self, fingerprint):
+        """Return the manifest stored for a fingerprint, or None if there isn't one"""
+
+        try:
+            with open(self.path(fingerprint, self.MANIFEST)) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        try:
+            os.utime(self.path(fingerprint), None)
+        except OSError:
+            pass  # Another process removed it, but the files are still open
+
+        return manifest
+
+    def open(self, fingerprint, file_name):
+        """Open a file stored for a fingerprint, for reading"""
+        return open(self.path(fingerprint, file_name), 'rb')
+
+    def put(self, fingerprint, manifest, datafiles):
+        """Store the manifest and the datafiles for a fingerprint.
+
+        :param fingerprint: The fingerprint of the build
+        :param manifest: A dict that can be encoded as JSON
+        :param datafiles: Dict of file names to datafiles, which are objects with an open() method, like MPRowsFile
+        :return: True if the entry was stored, or False if there already is one.
+        """
+
+        path = self.path(fingerprint)
+
+        if os.path.exists(path):
+            return False
+
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+
+        os.makedirs(tmp_path)
+
+        try:
+            for file_name, datafile in datafiles.items():
+                with datafile.open(mode='rb') as f_in, open(os.path.join(tmp_path, file_name), 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+
+            with open(os.path.join(tmp_path, self.MANIFEST), 'w') as f:
+                json.dump(manifest, f)
+
+            os.rename(tmp_path, path)
+
+        except:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+            if os.path.exists(path):
+                return False  # Another process stored the same build first
+
+            raise
+
+        if self.max_size:
+            self.prune(self.max_size)
+
+        return True
+
+    def remove(self, fingerprint):
+        """Remove the entry for a fingerprint"""
+        shutil.rmtree(self.path(fingerprint), ignore_errors=True)
+
+    def entries(self):
+        """Yield (fingerprint, size in bytes, time of last use) for each entry in the store"""
+
+        if not os.path.isdir(self.root):
+            return
+
+        for prefix in os.listdir(self.root):
+            prefix_path = os.path.join(self.root, prefix)
+
+            if not os.path.isdir(prefix_path):
+                continue
+
+            for fingerprint in os.listdir(prefix_path):
+                if fingerprint.endswith('.tmp'):
+                    continue
+
+                path = os.path.join(prefix_path, fingerprint)
+
+                try:
+                    size = sum(os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path))
+                    yield fingerprint, size, os.path.getmtime(path)
+                except OSError:
+                    continue  # Removed by another process
+
+    def prune(self, max_size):
+        """Remove the least recently used entries until the store is no larger than max_size bytes. Returns
+        the fingerprints of the removed entries"""
+
+        entries = sorted(self.entries(), key=lambda e: e[2])
+
+        total = sum(size for _, size, _ in entries)
+
+        removed = []
+
+        for fingerprint, size, _ in entries:
+            if total <= max_size:
+                break
+
+            self.remove(fingerprint)
+            removed.append(fingerprint)
+            total -= size
+
+        return removed
@@ -8,14 +8,120 @@ the Revised BSD License, included in this distribution as LICENSE.txt
 
 import os
 import platform
+import threading
+import time
+from collections import OrderedDict
+
 from ambry.orm import Process
+from ambry.util import get_logger
 from six import string_types
 
+logger = get_logger(__name__)
+
 
 class ProgressLoggingError(Exception):
     pass
 
 
+class ProgressWriter(object):
+    """Write updates to process records on a background thread.
+
+    Updates are buffered by record id, so several updates to a record between flushes become one UPDATE, and
+    all of the buffered updates are written in one transaction. The writer uses its own connections, so it
+    doesn't share a session with the thread that makes the updates."""
+
+    def __init__(self, engine, schema=None, interval=2):
+        """
+
+        :param engine: The engine for the database that holds the process records
+        :param schema: The Postgres schema of the process table, or None
+        :param interval: Seconds between flushes
+        """
+        self._engine = engine
+        self._schema = schema
+        self.interval = interval
+
+        self._table = Process.__table__
+        self._columns = {prop.key: prop.columns[0].name for prop in Process.__mapper__.column_attrs}
+
+        self._pending = OrderedDict()  # Record ids to dicts of attribute values
+        self._lock = threading.Lock()  # Guards _pending
+        self._flush_lock = threading.Lock()  # Keeps flushes in order
+
+        self._thread = None
+        self._stopped = threading.Event()
+
+        self.n_flushes = 0  # Number of transactions written
+
+    def update(self, rec_id, values):
+        """Buffer new values for the attributes of a process record"""
+
+        with self._lock:
+            self._pending.setdefault(rec_id, {}).update(values)
+
+            if self._thread is None and not self._stopped.is_set():
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def flush(self):
+        """Write all of the buffered updates"""
+
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, OrderedDict()
+
+            if not pending:
+                return
+
+            modified = time.time()
+
+            try:
+                with self._engine.connect() as conn:
+                    if self._schema:
+                        conn.execute('SET search_path TO {}'.format(self._schema))
+
+                    with conn.begin():
+                        for rec_id, values in pending.items():
+                            values = {self._columns[k]: v for k, v in values.items()}
+                            values['pr_modified'] = modified
+
+                            conn.execute(self._table.update().where(self._table.c.pr_id == rec_id).values(**values))
+            except:
+                self._restore(pending)
+                raise
+
+            self.n_flushes += 1
+
+    def _restore(self, pending):
+        """Put updates that failed to be written back in the buffer, to be written by the next flush. Values
+        that were buffered since the updates were taken from the buffer are newer, so they replace them."""
+
+        with self._lock:
+            newer, self._pending = self._pending, pending
+
+            for rec_id, values in newer.items():
+                self._pending.setdefault(rec_id, {}).update(values)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                # The updates are still buffered, so the next flush tries again
+                logger.error('Failed to write progress records: {}'.format(e))
+
+    def close(self):
+        """Stop the background thread and write the remaining updates"""
+
+        self._stopped.set()
+
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+        self.flush()
+
+
 class ProgressSection(object):
     """A handler of the records for a single routine or phase"""
 
@@ -33,6 +139,8 @@ class ProgressSection(object):
 
         self.rec = None
 
+        self._writer = parent._writer
+
         self._ai_rec_id = None  # record for add_update
 
         self._group = None
@@ -127,6 +235,11 @@ class ProgressSection(object):
         if self._logger:
             self._logger.info(self.rec.log_str)
 
+        if self._writer:
+            # Detach the record, so later updates to it only go through the writer
+            self._session.flush()
+            self._session.expunge(rec)
+
         self._session.commit()
         self._ai_rec_id = None
 
@@ -142,16 +255,25 @@ class ProgressSection(object):
         if not self.rec:
             return self.add(**kwargs)
         else:
+            values = {}
+
             for k, v in kwargs.items():
 
                 # Don't update object; use whatever was set in the original record
                 if k not in ('source', 's_vid', 'table', 't_vid', 'partition', 'p_vid'):
                     setattr(self.rec, k, v)
+                    values[k] = v
+
+            if self._writer:
+                self._writer.update(self.rec.id, values)
+            else:
+                self._session.merge(self.rec)
 
-            self._session.merge(self.rec)
             if self._logger:
                 self._logger.info(self.rec.log_str)
-            self._session.commit()
+
+            if not self._writer:
+                self._session.commit()
 
             self._ai_rec_id = None
             return self.rec.id
@@ -177,6 +299,10 @@ class ProgressSection(object):
     def done(self, *args, **kwargs):
         """Mark the whole ProgressSection as done"""
         kwargs['state'] = 'done'
+
+        if self._writer:
+            self._writer.flush()
+
         pr_id = self.add(*args, log_action='done', **kwargs)
 
         self._session.query(Process).filter(Process.group == self._group).update({Process.state: 'done'})
@@ -192,7 +318,16 @@ class ProgressSection(object):
 class ProcessLogger(object):
     """Database connection and access object for recording build progress and build state"""
 
-    def __init__(self, dataset, logger=None, new_connection=True, new_sqlite_db=True):
+    def __init__(self, dataset, logger=None, new_connection=True, new_sqlite_db=True, flush_interval=2):
+        """
+
+        :param dataset: The dataset that the records are for
+        :param logger: Logger for writing records to the bundle log
+        :param new_connection: If True, use a new connection to the database, rather than the dataset's
+        :param new_sqlite_db: If True, and the database is Sqlite, write records to a separate progress database
+        :param flush_interval: When the logger has its own connection, updates to records are buffered, and
+            written on a background thread this often, in seconds. If None, updates are written immediately.
+        """
         import os.path
 
         self._vid = dataset.vid
@@ -216,7 +351,7 @@ class ProcessLogger(object):
                 parts = os.path.split(db.dsn)
                 dsn = '/'.join(parts[:-1] + ('progress.db',))
 
-            self._db = Database(dsn, foreign_keys=False)
+            self._db = Database(dsn, foreign_keys=False, read_concurrency=db.read_concurrency)
             self._db.create()  # falls through if already exists
             self._engine = self._db.engine
             self._connection = self._db.connection
@@ -239,20 +374,38 @@ class ProcessLogger(object):
         if schema:
             self._session.execute('SET search_path TO {}'.format(schema))
 
+        # An in-memory Sqlite database can't be shared with the writer's connections
+        if flush_interval and new_connection and self._db.dsn != 'sqlite://':
+            self._writer = ProgressWriter(self._db.engine, schema, flush_interval)
+        else:
+            self._writer = None
+
     def __del__(self):
+        if getattr(self, '_writer', None):
+            self._writer.close()
+
         if self._db.driver == 'sqlite':
             self._db.close()
         else:
             self.close()
 
+    def flush(self):
+        """Write buffered updates to records"""
+        if self._writer:
+            self._writer.flush()
+
     def close(self):
 
+        if self._writer:
+            self._writer.close()
+
         if self._connection and self._new_connection:
             self._connection.close()
 
     @property
     def dataset(self):
         from ambry.orm import Dataset
+        self.flush()
         return self._session.query(Dataset).filter(Dataset.vid == self._d_vid).one()
 
     def start(self, phase, stage, **kwargs):
@@ -262,6 +415,7 @@ class ProcessLogger(object):
     @property
     def records(self):
         """Return all start records for this the dataset, grouped by the start record"""
+        self.flush()
 
         return (self._session.query(Process)
                 .filter(Process.d_vid == self._d_vid)).all()
@@ -269,6 +423,7 @@ class ProcessLogger(object):
     @property
     def starts(self):
         """Return all start records for this the dataset, grouped by the start record"""
+        self.flush()
 
         return (self._session.query(Process)
                 .filter(Process.d_vid == self._d_vid)
@@ -278,12 +433,14 @@ class ProcessLogger(object):
     @property
     def query(self):
         """Return all start records for this the dataset, grouped by the start record"""
+        self.flush()
 
         return self._session.query(Process).filter(Process.d_vid == self._d_vid)
 
     @property
     def exceptions(self):
         """Return all start records for this the dataset, grouped by the start record"""
+        self.flush()
 
         return (self._session.query(Process)
                 .filter(Process.d_vid == self._d_vid)
@@ -293,6 +450,8 @@ class ProcessLogger(object):
     def clean(self):
         """Delete all of the records"""
 
+        self.flush()
+
         # Deleting seems to be really weird and unrelable.
         self._session \
             .query(Process) \
@@ -313,6 +472,7 @@ class ProcessLogger(object):
 
     def commit(self):
         assert self._new_connection
+        self.flush()
         self._session.commit()
 
     @property
@@ -0,0 +1,345 @@
+"""Dependency-aware scheduling of the tasks of a build or ingestion.
+
+Rather than running every source in a stage and waiting for all of them to finish before starting the next stage,
+the tasks are arranged in a graph, and each task is started as soon as the tasks it depends on are done.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
+the Revised BSD License, included in this distribution as LICENSE.txt
+
+"""
+
+import heapq
+import time
+from collections import OrderedDict
+
+from six.moves.queue import Queue, Empty
+
+from ambry.dbexceptions import BuildError, MemoryLimitError
+
+
+class Task(object):
+    """A unit of work, such as building a source or unifying the partitions of a table"""
+
+    def __init__(self, key, f, args, deps=None, stage=None, label=None, local=False, cost=None, memory=None):
+        """
+
+        :param key: A hashable key for the task, which other tasks use to depend on it.
+        :param f: The function to run. For tasks that run in a process pool, it must be one of the
+            functions in ambry.bundle.concurrent
+        :param args: Arguments for f
+        :param deps: Keys of tasks that must be done before this one can start
+        :param stage: The stage of the source the task is for, or None
+        :param label: Description for progress messages
+        :param local: If True, run the task in this process, even when the other tasks run in a pool.
+        :param cost: Estimated run time of the task, in seconds, or None if it is unknown
+        :param memory: Estimated peak memory of the process running the task, in bytes, or None if it is unknown
+        """
+        self.key = key
+        self.f = f
+        self.args = tuple(args)
+        self.deps = set(deps or [])
+        self.stage = stage
+        self.label = label or str(key)
+        self.local = local
+        self.cost = cost
+        self.memory = memory
+        self.alone = False  # If True, the task must run without any other tasks in the pool
+
+        self.state = 'blocked'
+        self.result = None
+        self.exception = None
+
+        self.started = None
+        self.finished = None
+
+    def __repr__(self):
+        return '<Task {} {}>'.format(self.label, self.state)
+
+
+class DAGScheduler(object):
+    """Run a graph of tasks, either in this process or in a process pool.
+
+    The tasks that are ready to run, because all of their dependencies are done, are started in order of
+    their stage, then longest first, by estimated cost, then the order they were added, with tasks that have
+    no stage first. Starting the longest tasks first keeps a large task that is started last from holding up
+    the end of a stage. In a pool, tasks are started until every pool process has one, or until the next task
+    would exceed the pool's memory budget, so ready tasks wait in the scheduler, where they are counted as
+    queued. A task that fails because its worker exceeded the memory limit is run again by itself.
+
+    """
+
+    poll_interval = 1  # Seconds between checks for failed pool tasks
+
+    def __init__(self, ps=None, before_stage=None, after_stage=None):
+        """
+
+        :param ps: A ProgressSection for recording the number of queued, running, and blocked tasks
+        :param before_stage: Function to call with the stage number before the first task of a stage starts
+        :param after_stage: Function to call with the stage number after all of the tasks in a stage are done
+        """
+
+        self.tasks = OrderedDict()
+        self._ps = ps
+        self._before_stage = before_stage
+        self._after_stage = after_stage
+
+        self._started_stages = set()
+
+        self.processes = 1  # Number of tasks that can run at once. Set by run()
+
+    def add(self, key, f, args, deps=None, stage=None, label=None, local=False, cost=None, memory=None):
+        """Add a task. Returns the Task"""
+
+        if key in self.tasks:
+            raise BuildError('Duplicate task: {}'.format(key))
+
+        t = Task(key, f, args, deps=deps, stage=stage, label=label, local=local, cost=cost, memory=memory)
+        self.tasks[key] = t
+
+        return t
+
+    def add_dependency(self, key, dep):
+        """Make task key depend on task dep"""
+        self.tasks[key].deps.add(dep)
+
+    def check(self):
+        """Check that all dependencies are tasks, and that there are no cycles"""
+
+        for t in self.tasks.values():
+            for dep in t.deps:
+                if dep not in self.tasks:
+                    raise BuildError('Task {} depends on unknown task {}'.format(t.label, dep))
+
+        # Repeatedly remove tasks that have no remaining dependencies. Anything left is in a cycle.
+        remaining = {k: set(t.deps) for k, t in self.tasks.items()}
+
+        while remaining:
+            free = [k for k, deps in remaining.items() if not deps]
+
+            if not free:
+                raise BuildError('Dependency cycle between tasks: {}'
+                                 .format(', '.join(sorted(self.tasks[k].label for k in remaining))))
+
+            for k in free:
+                del remaining[k]
+
+            for deps in remaining.values():
+                deps.difference_update(free)
+
+    @property
+    def counts(self):
+        """A dict of the number of tasks in each state. 'queued' tasks are ready to run, but waiting for a
+        pool process"""
+
+        counts = dict(blocked=0, queued=0, running=0, done=0, failed=0)
+
+        for t in self.tasks.values():
+            if t.state == 'blocked' and self._is_ready(t):
+                counts['queued'] += 1
+            else:
+                counts[t.state] += 1
+
+        return counts
+
+    @property
+    def failed(self):
+        return [t for t in self.tasks.values() if t.state == 'failed']
+
+    def _is_ready(self, t):
+        return all(self.tasks[dep].state == 'done' for dep in t.deps)
+
+    def ready(self):
+        """Return the tasks that can be started, in the order they should be started"""
+
+        order = {k: i for i, k in enumerate(self.tasks)}
+
+        ready = [t for t in self.tasks.values() if t.state == 'blocked' and self._is_ready(t)]
+
+        # Tasks without a stage, such as unifying partitions, are usually holding up later stages, so they go first
+        return sorted(ready, key=lambda t: (t.stage is not None, t.stage, -(t.cost or 0), order[t.key]))
+
+    def _stage_tasks(self, stage):
+        return [t for t in self.tasks.values() if t.stage == stage and not t.local]
+
+    def predicted_makespan(self, stage):
+        """Return the estimated time to run the tasks in a stage, from their costs, if they are assigned,
+        longest first, to whichever process is free first. Dependencies are ignored. """
+
+        loads = [0.0] * self.processes
+
+        for cost in sorted((t.cost or 0 for t in self._stage_tasks(stage)), reverse=True):
+            heapq.heapreplace(loads, loads[0] + cost)
+
+        return max(loads)
+
+    def makespan(self, stage):
+        """Return the time from the start of the first task in a stage to the end of the last, or None if the
+        stage isn't done"""
+
+        tasks = self._stage_tasks(stage)
+
+        if not tasks or any(t.finished is None for t in tasks):
+            return None
+
+        return max(t.finished for t in tasks) - min(t.started for t in tasks)
+
+    def _progress(self, message):
+
+        if not self._ps:
+            return
+
+        c = self.counts
+
+        self._ps.add_update('{}; queued: {}, running: {}, blocked: {}, done: {}{}'.format(
+            message, c['queued'], c['running'], c['blocked'], c['done'],
+            ', failed: {}'.format(c['failed']) if c['failed'] else ''),
+            item_type='tasks', item_total=len(self.tasks), item_count=c['done'], data=c)
+
+    def _start(self, t):
+
+        if t.stage is not None and t.stage not in self._started_stages:
+            self._started_stages.add(t.stage)
+            if self._before_stage:
+                self._before_stage(t.stage)
+
+        t.state = 'running'
+        t.started = time.time()
+
+    def _finish(self, t, result=None, exception=None):
+
+        t.finished = time.time()
+
+        if exception is not None:
+            t.state = 'failed'
+            t.exception = exception
+        else:
+            t.state = 'done'
+            t.result = result
+
+            if (t.stage is not None and self._after_stage and
+                    all(o.state == 'done' for o in self.tasks.values() if o.stage == t.stage)):
+                self._after_stage(t.stage)
+
+        self._progress('{} {}'.format('Failed' if exception is not None else 'Finished', t.label))
+
+    def _admit(self, t, running, pool):
+        """Return True if there is enough memory to start a task in the pool, given the pool's memory_budget.
+
+        The memory in use is the larger of the estimates for the running tasks and the measured size of the
+        pool's workers. A task that must run alone waits for the pool to be empty, and the first task always
+        starts, however large its estimate. """
+
+        if not running:
+            return True
+
+        if t.alone or any(self.tasks[k].alone for k in running):
+            return False
+
+        budget = getattr(pool, 'memory_budget', None)
+
+        if not budget:
+            return True
+
+        in_use = sum(self.tasks[k].memory or 0 for k in running)
+
+        worker_rss = pool.worker_rss() if hasattr(pool, 'worker_rss') else None
+
+        return max(in_use, worker_rss or 0) + (t.memory or 0) <= budget
+
+    def _retry_alone(self, t, exception):
+        """Return a task that exceeded the memory limit to the ready tasks, to run again by itself"""
+
+        t.state = 'blocked'
+        t.alone = True
+        t.started = t.finished = None
+
+        self._progress('Retrying {} alone after: {}'.format(t.label, exception))
+
+    def _run_local(self, t):
+        self._start(t)
+        self._progress('Running {}'.format(t.label))
+        self._finish(t, t.f(*t.args))
+
+    def run(self, pool=None, raise_errors=True):
+        """Run all of the tasks.
+
+        :param pool: If not None, a process pool from Library.process_pool(). Tasks that are not local are run
+            in the pool, one task per process. Otherwise, the tasks are run in this process, one at a time,
+            and exceptions are raised as soon as they occur.
+        :param raise_errors: If True, when a pool task fails, wait for the running tasks to finish, then
+            raise the exception from the first failed task. Otherwise, the tasks that depend on a failed task
+            are not run, and the caller can check the failed property.
+        """
+
+        self.check()
+
+        self.processes = pool._processes if pool is not None else 1
+
+        if pool is None:
+            while True:
+                ready = self.ready()
+                if not ready:
+                    break
+                self._run_local(ready[0])
+
+            return self
+
+        done_q = Queue()
+        running = OrderedDict()  # Task keys to the AsyncResult of the task.
+        processes = pool._processes
+        stopped = False
+
+        while True:
+
+            if not stopped:
+                # Local tasks don't need room in the pool, so they run before the pool tasks, which may have to wait
+                local = [t for t in self.ready() if t.local]
+
+                for t in local:
+                    self._run_local(t)
+
+                # Local tasks may have made more tasks ready
+                if local:
+                    continue
+
+                for t in self.ready():
+                    if len(running) >= processes or not self._admit(t, running, pool):
+                        break
+
+                    self._start(t)
+                    # map_async() with a single argument, rather than apply_async(), because the pool's
+                    # worker function expects the task structure that map_async() produces.
+                    running[t.key] = pool.map_async(t.f, [t.args], 1, callback=lambda r, k=t.key: done_q.put(k))
+                    self._progress('Started {}'.format(t.label))
+
+            if not running:
+                break
+
+            # The callback is only called for successful tasks, so failures are found by polling.
+            try:
+                done_q.get(timeout=self.poll_interval)
+            except Empty:
+                pass
+
+            for k, r in list(running.items()):
+                if not r.ready():
+                    continue
+
+                del running[k]
+
+                try:
+                    self._finish(self.tasks[k], r.get()[0])
+                except MemoryLimitError as e:
+                    if self.tasks[k].alone:
+                        self._finish(self.tasks[k], exception=e)
+                        stopped = stopped or raise_errors
+                    else:
+                        self._retry_alone(self.tasks[k], e)
+                except Exception as e:
+                    self._finish(self.tasks[k], exception=e)
+                    stopped = stopped or raise_errors
+
+        if raise_errors and self.failed:
+            raise self.failed[0].exception
+
+        return self
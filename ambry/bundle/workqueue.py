@@ -0,0 +1,463 @@
+"""A queue of bundle tasks in the library database, for running builds on several hosts.
+
+Instead of sending tasks to a local process pool, Bundle.build() and Bundle.ingest() can add them to the tasks
+table of the library database, with a QueuePool, which Library.process_pool() returns when the library
+worker_mode config value is 'queue'. Worker processes on any host that shares the library database, started
+with `ambry library worker`, lease the tasks, run them, and write back the results.
+
+A worker holds a lease on a task while it runs it, and renews the lease with a heartbeat. If the worker dies,
+the lease expires and another worker can run the task again. A worker that finds it has lost the lease on a
+running task exits, so the two workers don't write the task's outputs at the same time. Since the tasks write to
+the bundle's build directory, the build filesystem must be on storage that all of the hosts share.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of the
+Revised BSD License, included in this distribution as LICENSE.txt
+
+"""
+
+import os
+import platform
+import threading
+import time
+from multiprocessing import TimeoutError
+
+from sqlalchemy import and_, or_, select
+
+from ambry.dbexceptions import BuildError
+from ambry.orm.task import QueuedTask
+from ambry.util import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_LEASE_SECONDS = 60  # A task is released if its worker misses heartbeats for this long
+MAX_ATTEMPTS = 3  # Number of times a task can be leased before it fails
+
+
+def function_name(f):
+    """Return the name of a function, for storing in the queue"""
+    return '{}.{}'.format(f.__module__, f.__name__)
+
+
+def import_function(name):
+    """Import a function from the name returned by function_name()"""
+    module_name, f_name = name.rsplit('.', 1)
+
+    return getattr(__import__(module_name, fromlist=[f_name]), f_name)
+
+
+def worker_id():
+    return '{}/{}'.format(platform.node(), os.getpid())
+
+
+class BuildQueue(object):
+    """Add, lease and complete tasks in the tasks table of a library database.
+
+    Each operation uses its own short connection and transaction, so processes polling the queue don't hold
+    locks on a Sqlite database, and leases are taken with a conditional update, so only one worker can get
+    each task."""
+
+    def __init__(self, database):
+        self._db = database
+        self._table = QueuedTask.__table__
+
+        # Map from table column names to QueuedTask attribute names
+        self._attrs = {prop.columns[0].name: prop.key for prop in QueuedTask.__mapper__.column_attrs}
+
+    def _connect(self):
+        conn = self._db.engine.connect()
+
+        if self._db._schema:
+            conn.execute('SET search_path TO {}'.format(self._db._schema))
+
+        return conn
+
+    def _to_task(self, row):
+        return QueuedTask(**{self._attrs[k]: v for k, v in row.items()})
+
+    def enqueue(self, batch, f, d_vid, args, stage=None, s_vid=None):
+        """Add a task to run f(bundle, *args), where bundle is the bundle for d_vid. Returns the task id"""
+        now = time.time()
+
+        with self._connect() as conn:
+            r = conn.execute(self._table.insert().values(
+                tk_batch=batch, tk_d_vid=d_vid, tk_s_vid=s_vid, tk_phase=f.__name__, tk_stage=stage,
+                tk_function=function_name(f), tk_args=tuple(args), tk_state='queued', tk_attempts=0,
+                tk_created=now, tk_modified=now))
+
+            return r.inserted_primary_key[0]
+
+    def lease(self, worker, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        """Lease the oldest task that is queued, or that has an expired lease. Returns a QueuedTask, or None if
+        there are no tasks to run."""
+        t = self._table
+        c = t.c
+
+        now = time.time()
+
+        leasable = or_(c.tk_state == 'queued', and_(c.tk_state == 'leased', c.tk_expires < now))
+
+        with self._connect() as conn:
+
+            # Tasks that have failed to finish too many times are probably killing their workers.
+            conn.execute(t.update()
+                         .where(and_(c.tk_state == 'leased', c.tk_expires < now, c.tk_attempts >= max_attempts))
+                         .values(tk_state='failed', tk_ex_class='LeaseExpired', tk_modified=now,
+                                 tk_result=BuildError('Task lease expired {} times'.format(max_attempts))))
+
+            task_ids = [row[0] for row in conn.execute(select([c.tk_id]).where(leasable).order_by(c.tk_id))]
+
+            for task_id in task_ids:
+
+                # Another worker may have leased the task after the select, and then the update won't match.
+                r = conn.execute(t.update()
+                                 .where(and_(c.tk_id == task_id, leasable))
+                                 .values(tk_state='leased', tk_worker=worker, tk_attempts=c.tk_attempts + 1,
+                                         tk_heartbeat=now, tk_expires=now + lease_seconds, tk_modified=now))
+
+                if r.rowcount == 1:
+                    return self._to_task(conn.execute(t.select(c.tk_id == task_id)).first())
+
+        return None
+
+    def heartbeat(self, task_id, worker, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Extend the lease on a task. Returns False if the worker no longer holds the lease"""
+        c = self._table.c
+        now = time.time()
+
+        with self._connect() as conn:
+            r = conn.execute(self._table.update()
+                             .where(and_(c.tk_id == task_id, c.tk_worker == worker, c.tk_state == 'leased'))
+                             .values(tk_heartbeat=now, tk_expires=now + lease_seconds))
+
+            return r.rowcount == 1
+
+    def finish(self, task_id, worker, result=None, exception=None, trace=None):
+        """Record the result of a task, or the exception that it raised. Returns False if the worker
+        no longer holds the lease, in which case the result is discarded."""
+        from ambry.util import qualified_name
+        import pickle
+
+        c = self._table.c
+
+        values = dict(tk_modified=time.time())
+
+        if exception is not None:
+            try:
+                pickle.dumps(exception)
+            except Exception:
+                exception = BuildError('{}: {}'.format(qualified_name(type(exception)), exception))
+
+            values.update(tk_state='failed', tk_result=exception,
+                          tk_ex_class=qualified_name(type(exception)), tk_ex_trace=trace)
+        else:
+            values.update(tk_state='done', tk_result=result)
+
+        with self._connect() as conn:
+            r = conn.execute(self._table.update()
+                             .where(and_(c.tk_id == task_id, c.tk_worker == worker, c.tk_state == 'leased'))
+                             .values(**values))
+
+            return r.rowcount == 1
+
+    def tasks(self, ids=None, batch=None, states=None):
+        """Return QueuedTasks, selected by id, batch or state"""
+        t = self._table
+        c = t.c
+
+        q = t.select().order_by(c.tk_id)
+
+        if ids is not None:
+            q = q.where(c.tk_id.in_(list(ids)))
+
+        if batch is not None:
+            q = q.where(c.tk_batch == batch)
+
+        if states is not None:
+            q = q.where(c.tk_state.in_(list(states)))
+
+        with self._connect() as conn:
+            return [self._to_task(row) for row in conn.execute(q)]
+
+    def cancel(self, batch):
+        """Cancel the tasks in a batch that haven't been leased"""
+        c = self._table.c
+
+        with self._connect() as conn:
+            conn.execute(self._table.update()
+                         .where(and_(c.tk_batch == batch, c.tk_state == 'queued'))
+                         .values(tk_state='cancelled', tk_modified=time.time()))
+
+    def clean(self, states=('done', 'failed', 'cancelled')):
+        """Delete finished tasks"""
+
+        with self._connect() as conn:
+            conn.execute(self._table.delete().where(self._table.c.tk_state.in_(list(states))))
+
+
+class QueueResult(object):
+    """The result of QueuePool.map_async(), with the interface of multiprocessing's AsyncResult"""
+
+    finished_states = ('done', 'failed', 'cancelled')
+
+    def __init__(self, queue, ids, callback=None):
+        self._queue = queue
+        self._ids = ids
+        self._callback = callback
+        self._tasks = None
+
+    def ready(self):
+
+        if self._tasks is None:
+            tasks = self._queue.tasks(ids=self._ids)
+
+            if all(t.state in self.finished_states for t in tasks):
+                self._tasks = tasks
+
+                if self._callback and self.successful():
+                    self._callback([t.result for t in tasks])
+
+        return self._tasks is not None
+
+    def successful(self):
+        assert self._tasks is not None, 'Result is not ready'
+        return all(t.state == 'done' for t in self._tasks)
+
+    def wait(self, timeout=None, poll_interval=1):
+        start = time.time()
+
+        while not self.ready():
+            if timeout is not None and time.time() - start > timeout:
+                break
+
+            time.sleep(poll_interval)
+
+    def get(self, timeout=None):
+
+        self.wait(timeout)
+
+        if not self.ready():
+            raise TimeoutError
+
+        for t in self._tasks:
+            if t.state == 'failed':
+                if isinstance(t.result, Exception):
+                    raise t.result
+                raise BuildError('Task {} failed on {}: {}'.format(t.id, t.worker, t.exception_class))
+
+            elif t.state == 'cancelled':
+                raise BuildError('Task {} was cancelled'.format(t.id))
+
+        return [t.result for t in self._tasks]
+
+
+class QueuePool(object):
+    """Stands in for the process pool from Library.process_pool(), but adds the tasks to the library build queue,
+    for workers on any host to run.
+
+    Like the process pool, the functions are the task functions from ambry.bundle.concurrent, or any other
+    module level function, and the first argument is a bundle vid. """
+
+    def __init__(self, library, processes):
+        """
+        :param library: The library, which must use the same database as the workers
+        :param processes: The number of tasks that the scheduler may have in the queue at once.
+        """
+        from uuid import uuid4
+
+        self._library = library
+        self._processes = processes
+        self.batch = uuid4().hex
+
+        self.queue = BuildQueue(library.database)
+
+    def map_async(self, func, iterable, chunksize=None, callback=None):
+        """Add a task for each item in iterable, which must be an argument list that starts with a bundle vid"""
+
+        ids = []
+
+        for args in iterable:
+            args = tuple(args)
+
+            stage, s_vid = (args[1], args[2]) if func.__name__ in ('build_mp', 'ingest_mp') else (None, None)
+
+            ids.append(self.queue.enqueue(self.batch, func, args[0], args[1:], stage=stage, s_vid=s_vid))
+
+        return QueueResult(self.queue, ids, callback)
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+    def terminate(self):
+        self.queue.cancel(self.batch)
+
+
+class Heartbeat(threading.Thread):
+    """Renew the lease on a task while a worker runs it.
+
+    If the lease is lost, because another worker took over the task after the lease expired, or because the lease
+    expired while the heartbeat couldn't reach the database, call on_lost(), which should stop the task and end the
+    process, so two workers don't write the same outputs at once."""
+
+    def __init__(self, queue, task_id, worker, lease_seconds, on_lost=None):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+
+        self._queue = queue
+        self._task_id = task_id
+        self._worker = worker
+        self._lease_seconds = lease_seconds
+        self._on_lost = on_lost
+        self._stopped = threading.Event()
+
+    def run(self):
+        renewed = time.time()
+
+        while not self._stopped.wait(self._lease_seconds / 3.0):
+            try:
+                if self._queue.heartbeat(self._task_id, self._worker, self._lease_seconds):
+                    renewed = time.time()
+                    continue
+
+                logger.warn('Lost the lease on task {}'.format(self._task_id))
+
+            except Exception as e:
+                logger.error('Heartbeat for task {} failed: {}'.format(self._task_id, e))
+
+                if time.time() - renewed < self._lease_seconds:
+                    continue
+
+                logger.warn('Lease on task {} expired'.format(self._task_id))
+
+            if self._on_lost and not self._stopped.is_set():
+                self._on_lost()
+
+            return
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def run_worker(library, lease_seconds=DEFAULT_LEASE_SECONDS, poll_interval=1, idle_timeout=None, max_tasks=None):
+    """Lease and run tasks from the library build queue.
+
+    Like the warm pool workers, the worker keeps the bundle for each bundle vid between tasks.
+
+    :param library: The library
+    :param lease_seconds: Time that a task stays leased without a heartbeat.
+    :param poll_interval: Seconds to wait between checks of an empty queue.
+    :param idle_timeout: If not None, exit after the queue has been empty for this many seconds.
+    :param max_tasks: If not None, exit after running this many tasks.
+    :return: The number of tasks run.
+    """
+    import traceback
+    from .concurrent import _warm_bundle, _reset_bundle, start_watchdog, stop_watchdog, memory_limit_error
+
+    queue = BuildQueue(library.database)
+    worker = worker_id()
+    bundles = {}
+
+    completed = 0
+    idle_since = time.time()
+
+    while max_tasks is None or completed < max_tasks:
+
+        task = queue.lease(worker, lease_seconds)
+
+        if task is None:
+            if idle_timeout is not None and time.time() - idle_since > idle_timeout:
+                break
+
+            time.sleep(poll_interval)
+            continue
+
+        def on_lost(task_id=task.id):
+            # Another worker may be running the task, so stop before this one writes any more of its outputs
+            logger.error('Worker {} stopping; another worker may run task {}'.format(worker, task_id))
+            os._exit(1)
+
+        heartbeat = Heartbeat(queue, task.id, worker, lease_seconds, on_lost=on_lost)
+        heartbeat.start()
+
+        def on_exceed(growth, task_id=task.id):
+            queue.finish(task_id, worker, exception=memory_limit_error(growth))
+            os._exit(1)
+
+        start_watchdog(on_exceed)
+
+        b = None
+
+        try:
+            f = import_function(task.function)
+            b = _warm_bundle(library, bundles, task.d_vid)
+
+            result = f(b, *task.args)
+
+            heartbeat.stop()
+            queue.finish(task.id, worker, result=result)
+
+        except Exception as e:
+            tb = traceback.format_exc()
+
+            if b is not None:
+                b.error('Worker {} task {} raised an exception: {}'.format(worker, task.id, e), False)
+                b.error(tb, False)
+
+            bundles.pop(task.d_vid, None)
+
+            heartbeat.stop()
+            queue.finish(task.id, worker, exception=e, trace=tb)
+
+        finally:
+            stop_watchdog()
+            _reset_bundle(library, b)
+
+        completed += 1
+        idle_since = time.time()
+
+    return completed
+
+
+def worker_process(database_dsn, accounts_password, memory_limit=None, **kwargs):
+    """Run a worker in a new process, with a library constructed the same way as for the process pool workers.
+    The keyword arguments are passed to run_worker()
+
+    :param memory_limit: Bytes of memory the worker may use while running a task, or None for no limit
+    """
+    from ambry.library import new_library
+    from ambry.run import get_runconfig
+    from .concurrent import init_library
+
+    init_library(database_dsn, accounts_password, memory_limit=memory_limit)
+
+    library = new_library(get_runconfig())
+    library.database.close()  # Maybe it is still open after the fork.
+
+    try:
+        return run_worker(library, **kwargs)
+    finally:
+        library.close()
+
+
+def run_workers(library, processes, memory_limit=None, **kwargs):
+    """Run a worker in each of several new processes, and wait for them to exit. The keyword arguments are
+    passed to run_worker()"""
+    from multiprocessing import Process
+
+    workers = [Process(target=worker_process, args=(library.database.dsn, library._account_password, memory_limit),
+                       kwargs=kwargs)
+               for _ in range(processes)]
+
+    for w in workers:
+        w.start()
+
+    try:
+        for w in workers:
+            w.join()
+    except KeyboardInterrupt:
+        for w in workers:
+            w.terminate()
+        raise
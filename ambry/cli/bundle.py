@@ -318,6 +318,10 @@ def make_parser(cmd=None, parser=None):
     command_p.add_argument('-c', '--clean', default=False, action='store_true',
                            help='Equivalent to bambry clean -y ')
 
+    command_p.add_argument('-R', '--reuse', default=False, action='store_true',
+                           help='Reuse the outputs of earlier builds of sources with the same fingerprint, rather '
+                                'than running their pipelines')
+
     command_p.add_argument('-s', '--source', action='append',
                            help='Sources to build, instead of running all sources')
     command_p.add_argument('-t', '--table', action='append',
@@ -1051,6 +1055,8 @@ def bundle_build(args, l, rc):
 
     b = b.cast_to_subclass()
 
+    b.reuse_builds = args.reuse
+
     b.build(sources=args.source, tables=args.table, stage=args.stage, force=args.force)
 
     b.set_last_access(Bundle.STATES.BUILT)
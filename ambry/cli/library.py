@@ -54,6 +54,23 @@ def make_parser(cmd):
     sp.add_argument('-b', '--blocks', default=False, action='store_true',
                     help='List locks that are blocked or are blocking another process')
 
+    sp = asp.add_parser('worker', help='Run tasks from the library build queue')
+    sp.set_defaults(subcommand='worker')
+    sp.add_argument('-n', '--processes', type=int, default=1, help='Number of worker processes to run')
+    sp.add_argument('-l', '--lease', type=int, default=60,
+                    help='Seconds a task stays leased to a worker that stops sending heartbeats')
+    sp.add_argument('-i', '--idle', type=int, default=None,
+                    help='Exit after the queue has been empty for this many seconds')
+    sp.add_argument('-m', '--max-tasks', type=int, default=None, help='Exit after running this many tasks')
+    sp.add_argument('-M', '--memory-limit', type=int, default=None,
+                    help='Megabytes of memory a task may add to a worker before the worker abandons it and exits')
+
+    sp = asp.add_parser('queue', help='List or clean the tasks in the library build queue')
+    sp.set_defaults(subcommand='queue')
+    sp.add_argument('-a', '--all', default=False, action='store_true',
+                    help='List all tasks, not just the queued and running tasks')
+    sp.add_argument('-c', '--clean', default=False, action='store_true', help='Delete finished tasks')
+
     sp = asp.add_parser('export', help='Dump a library configuration, remortes, accounts and bundles')
     sp.set_defaults(subcommand='export')
     sp.add_argument('-p', '--password', required=True, help='Encryption password')
@@ -114,6 +131,53 @@ def library_clean(args, l, config):
 def library_number(args, l, config):
     print(l.number(assignment_class=args.key))
 
+def library_worker(args, l, config):
+    """Run tasks from the library build queue"""
+    import os
+    from ambry.bundle.workqueue import run_worker, run_workers
+
+    kwargs = dict(lease_seconds=args.lease, idle_timeout=args.idle, max_tasks=args.max_tasks)
+
+    memory_limit = args.memory_limit * 2 ** 20 if args.memory_limit else None
+
+    if args.processes > 1:
+        prt('Starting {} build queue workers'.format(args.processes))
+        run_workers(l, args.processes, memory_limit=memory_limit, **kwargs)
+    else:
+        from ambry.library import new_library
+
+        os.environ['AMBRY_MEMORY_LIMIT'] = str(memory_limit or 0)
+        os.environ['AMBRY_WORKER'] = '1'
+
+        # Open the library again, with the database connection settings for workers
+        logger = l.logger
+        l.close()
+        l = new_library(config)
+        l.logger = logger
+
+        prt('Starting build queue worker')
+        try:
+            n = run_worker(l, **kwargs)
+        finally:
+            l.close()
+        prt('Ran {} tasks'.format(n))
+
+def library_queue(args, l, config):
+    """List or clean the library build queue"""
+    from tabulate import tabulate
+    from ambry.bundle.workqueue import BuildQueue
+
+    q = BuildQueue(l.database)
+
+    if args.clean:
+        q.clean()
+
+    tasks = q.tasks(states=None if args.all else ('queued', 'leased'))
+
+    rows = [(t.id, t.d_vid, t.phase, t.stage, t.s_vid, t.state, t.worker, t.attempts) for t in tasks]
+
+    print(tabulate(rows, headers='id d_vid phase stage source state worker attempts'.split()))
+
 def library_pg(args, l, config):
     """Report on the operation of a Postgres Library database"""
     import tabulate
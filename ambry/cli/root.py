@@ -45,6 +45,8 @@ def make_parser(cmd):
                        help='Information about the remotes')
     group.add_argument('-a', '--accounts', default=False, action='store_true',
                        help='Information about accounts')
+    group.add_argument('-n', '--connections', default=False, action='store_true',
+                       help='Information about the connections to the library database')
 
 
 
@@ -228,6 +230,21 @@ def root_info(args, l, rc):
     if l:
         prt('Library:   {}', l.database.dsn)
         prt('Remotes:   {}', ', '.join([str(r.short_name) for r in l.remotes]) if l.remotes else '')
+
+        if args.connections:
+            ci = l.database.connection_info()
+            prt('Pool:      {}', ci['pool_status'])
+
+            if 'server' in ci:
+                prt('Server:    {} of {} connections, {} from ambry processes',
+                    sum(r['count'] for r in ci['server']), ci['max_connections'],
+                    sum(r['count'] for r in ci['server'] if r['application'].startswith('ambry')))
+
+            prt('This process: {connects} connects, {checkouts} checkouts, {checked_out} checked out', **ci)
+
+            if 'server' in ci:
+                print tabulate([(r['application'], r['state'], r['count']) for r in ci['server']],
+                               headers='Application State Count'.split())
     else:
         fs = LibraryFilesystem(rc)
         prt('Library:   {} {}(Inaccessible!){}', fs.database_dsn, ansicolors.FAIL, ansicolors.ENDC)
@@ -122,6 +122,10 @@ class BuildError(PhaseError):
 
     """General error while building a bundle."""
 
+class MemoryLimitError(BuildError):
+
+    """A worker process exceeded the memory limit while running a task."""
+
 class IngestionError(PhaseError):
 
 
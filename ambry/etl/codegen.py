@@ -8,6 +8,10 @@ the Revised BSD License, included in this distribution as LICENSE.txt
 import ast
 import meta
 
+# Version of the code that make_row_processors() generates. Change it when the generated code changes, so
+# caster code that was cached by earlier versions isn't loaded.
+CODE_VERSION = 1
+
 
 def file_loc():
     """Return file and line number"""
@@ -66,6 +70,39 @@ def row_{table}_{stage}(row, row_n, errors, scratch, accumulator, pipe, bundle,
     ]
 """
 
+# Runs the per-value caster for one cell of a vectorized column, for the cells that vector_cast() can't convert.
+fallback_template = """
+def fallback_{f_name}(v, row, row_n, errors, accumulator, pipe, bundle, source, row_proxy):
+
+    v = {f_name}(v, {i_s}, {i_d}, {header_s}, '{header_d}', row_proxy.set_row(row), row_n, errors, {{}}, accumulator, pipe, bundle, source)
+
+    return cast_{datatype}(v, '{header_d}', errors)
+"""
+
+batch_template = """
+from ambry.valuetype.vectors import vector_cast
+
+def batch_{table}(rows, row_n, errors, accumulator, pipe, bundle, source, row_proxy):
+
+    def fallback(f, i_s):
+        return lambda i: f(rows[i][i_s], rows[i], row_n + i, errors, accumulator, pipe, bundle, source, row_proxy)
+
+    n = len(rows)
+    cols = list(zip(*rows))
+
+    return [
+{stack}
+    ]
+"""
+
+# Transforms that vector_cast() can run, for each kind of column. Duplicated from ambry.valuetype.vectors,
+# which can't be imported unless NumPy is installed.
+vector_transforms = {
+    'int': ('nullify', 'int_n', 'float_n', 'clean_int'),
+    'float': ('nullify', 'int_n', 'float_n'),
+    'date': ('nullify',)
+}
+
 
 class CodeGenError(Exception):
     pass
@@ -81,17 +118,120 @@ def make_env(bundle, base_env):
     return _ff
 
 
-def make_row_processors(bundle, source_headers, dest_table, env):
+def vector_kind(env, column):
+    """Return the kind of vector_cast(), 'int', 'float' or 'date', that can cast a column, or None if the
+    column's transforms must be run one value at a time.
+
+    Only columns with a single pipe segment, no initializer or exception handler, a plain int, float or
+    date value type, and a few of the standard transforms can be vectorized.
+    """
+    from ambry.valuetype import IntValue, FloatValue, DateValue
+    from ambry.valuetype import types
+
+    segments = column.expanded_transform
+
+    if len(segments) != 1:
+        return None
+
+    segment = segments[0]
+
+    if segment['init'] or segment['exception']:
+        return None
+
+    dt = segment['datatype']
+
+    for kind, base in (('int', IntValue), ('float', FloatValue), ('date', DateValue)):
+        if column.datatype == kind and isinstance(dt, type) and issubclass(dt, base) and dt.__new__ == base.__new__:
+            break
+    else:
+        return None
+
+    for t in segment['transforms']:
+        # The transform must also not be overridden by the bundle
+        if t not in vector_transforms[kind] or env.get(t) is not getattr(types, t):
+            return None
+
+    return kind
+
+
+# Transforms from ambry.valuetype.types that never raise exceptions, so they can be inlined in the row functions
+inline_transforms = ('nullify', 'int_n', 'float_n')
+
+
+def inline_expr(env, segment, v):
+    """Return an expression that runs a column's transform segment on the value expression v, or None if the
+    segment must be run in its own column function.
+
+    Segments can be inlined if they have no initializer or exception handler, and their datatype cast and
+    transforms can't raise exceptions, since the column functions convert exceptions into casting errors. That
+    is true for the plain int, long, float, str and text value types, which return a FailedValue on errors,
+    and for the transforms in inline_transforms.
+    """
+    from ambry.valuetype import IntValue, LongValue, FloatValue, StrValue, TextValue
+    from ambry.valuetype import types
+
+    if segment['init'] or segment['exception']:
+        return None
+
+    expr = v
+
+    dt = segment['datatype']
+
+    if dt:
+        if not isinstance(dt, type):
+            return None
+
+        for base in (IntValue, LongValue, FloatValue, StrValue, TextValue):
+            if issubclass(dt, base) and dt.__new__ == base.__new__ and dt.__init__ == base.__init__:
+                break
+        else:
+            return None
+
+        expr = '{}({})'.format(dt.__name__, expr)
+
+    for t in segment['transforms']:
+        # The transform must also not be overridden by the bundle
+        if t not in inline_transforms or env.get(t) is not getattr(types, t):
+            return None
+
+        expr = '{}({})'.format(t, expr)
+
+    return expr
+
+
+def make_row_processors(bundle, source_headers, dest_table, env, vectorize=False, inline=True):
     """
     Make multiple row processors for all of the columns in a table.
 
     :param source_headers:
+    :param vectorize: If True, and NumPy is installed, also generate a batch processor, batch_processor,
+        which casts the columns that vector_kind() accepts a whole batch at a time. The first row processor
+        produces None for these columns, and the batch processor returns a list of (column index, values)
+        tuples to replace them, before the later row processors run, since their transforms can reference
+        the vectorized columns.
+    :param inline: If True, put the code for segments that inline_expr() accepts directly in the row
+        function, rather than generating a function for the column.
 
     :return:
     """
 
     dest_headers = [c.name for c in dest_table.columns]
 
+    vector_kinds = {}
+
+    if vectorize:
+        try:
+            import numpy
+        except ImportError:
+            pass
+        else:
+            for c in dest_table.columns:
+                kind = vector_kind(env, c)
+                if kind:
+                    vector_kinds[c.name] = kind
+
+    batch_stack = []
+
     row_processors = []
 
     out = [file_header]
@@ -161,11 +301,34 @@ def make_row_processors(bundle, source_headers, dest_table, env):
                 col_args = '# col_args not implemented yet'
             )
 
-            seg_funcs.append(f_name
-                             + ('({v}, {i_s}, {i_d}, {header_s}, \'{header_d}\', '
-                                'row, row_n, errors, scratch, accumulator, pipe, bundle, source)')
-                             .format(v=v, i_s=i_s, i_d=i_d, header_s="'" + header_s + "'" if header_s else 'None',
-                                     header_d=header_d))
+            header_s_arg = "'" + header_s + "'" if header_s else 'None'
+
+            expr = inline_expr(env, segment, v) if inline else None
+
+            if expr and col_name not in vector_kinds:
+                seg_funcs.append(expr)
+                out.append('\n'.join(preamble))
+                continue
+
+            if col_name in vector_kinds:
+                # The batch processor supplies the value, or calls the column function through the fallback
+                seg_funcs.append('None')
+
+                if header_s:
+                    out.append(fallback_template.format(f_name=f_name, i_s=i_s, i_d=i_d, header_s=header_s_arg,
+                                                        header_d=header_d, datatype=column.datatype))
+                    batch_stack.append("({}, vector_cast('{}', cols[{}], {!r}, fallback(fallback_{}, {})))"
+                                       .format(i_d, vector_kinds[col_name], i_s,
+                                               tuple(segment['transforms']), f_name, i_s))
+                elif col_num > 1:
+                    batch_stack.append('({}, [None] * n)'.format(i_d))
+                else:
+                    batch_stack.append('({}, list(range(row_n, row_n + n)))'.format(i_d))
+            else:
+                seg_funcs.append(f_name
+                                 + ('({v}, {i_s}, {i_d}, {header_s}, \'{header_d}\', '
+                                    'row, row_n, errors, scratch, accumulator, pipe, bundle, source)')
+                                 .format(v=v, i_s=i_s, i_d=i_d, header_s=header_s_arg, header_d=header_d))
 
             out.append('\n'.join(preamble))
 
@@ -186,7 +349,8 @@ def make_row_processors(bundle, source_headers, dest_table, env):
 
     # Add the final datatype cast, which is done seperately to avoid an unecessary function call.
 
-    stack = '\n'.join("{}cast_{}(row[{}], '{}', errors),".format(indent, c.datatype, i, c.name)
+    stack = '\n'.join("{}row[{}], # {} is vectorized".format(indent, i, c.name) if c.name in vector_kinds else
+                      "{}cast_{}(row[{}], '{}', errors),".format(indent, c.datatype, i, c.name)
                       for i, c in enumerate(dest_table.columns) )
 
     out.append(row_template.format(
@@ -199,8 +363,83 @@ def make_row_processors(bundle, source_headers, dest_table, env):
 
     out.append('row_processors = [{}]'.format(','.join(row_processors)))
 
+    if batch_stack:
+        out.append(batch_template.format(
+            table=dest_table.name,
+            stack='\n'.join(indent + l + ',' for l in batch_stack)
+        ))
+
+        out.append('batch_processor = batch_{}'.format(dest_table.name))
+    else:
+        out.append('batch_processor = None')
+
     return '\n'.join(out)
 
+fused_template = """
+def {f_name}(rows{args}):
+
+    for row in rows:
+{stack}
+        yield row
+"""
+
+
+def make_fused_loop(f_name, pipes):
+    """
+    Generate a function that runs rows through a sequence of fusible pipes in a single loop. The function
+    is a generator that takes an iterator of rows, and its other arguments default to the row functions
+    of the pipes, so they are local variables in the loop.
+
+    :param f_name: Name of the generated function
+    :param pipes: Sequence of pipes that have a fusible value and have processed their headers.
+    :return: A tuple of the code, and a dict of the row functions that the code references.
+    """
+    from ambry.util import qualified_class_name
+
+    stack = []
+    env = {}
+
+    for i, pipe in enumerate(pipes):
+
+        if pipe.fusible == 'pass':
+            stack.append('# {}: header only'.format(qualified_class_name(pipe)))
+            continue
+
+        fn = 'f_{}'.format(i)
+        env[fn] = pipe.fused_body()
+
+        stack.append('row = {}(row) # {}'.format(fn, qualified_class_name(pipe)))
+
+        if pipe.fusible == 'filter':
+            stack.append('if not row:')
+            stack.append('    continue')
+        elif pipe.fusible != 'map':
+            raise CodeGenError("Unknown fusible type '{}' for pipe {}"
+                               .format(pipe.fusible, qualified_class_name(pipe)))
+
+    code = fused_template.format(
+        f_name=f_name,
+        args=''.join(', {0}={0}'.format(fn) for fn in sorted(env)),
+        stack='\n'.join(indent + l for l in stack)
+    )
+
+    return code, env
+
+
+def code_names(code):
+    """Return the names that a code object, and the code objects of the functions defined in it, reference.
+    This includes attribute names, so it is a superset of the global names the code uses. """
+    import types
+
+    names = set(code.co_names)
+
+    for c in code.co_consts:
+        if isinstance(c, types.CodeType):
+            names |= code_names(c)
+
+    return names
+
+
 def calling_code(f, f_name=None, raise_for_missing=True):
     """Return the code string for calling a function. """
     import inspect
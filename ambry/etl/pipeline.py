@@ -106,6 +106,109 @@ class StopPipe(Exception):
     pass
 
 
+DEFAULT_BATCH_SIZE = 2000  # Rows per batch when a pipeline is run in batch mode
+
+# The segment number of a shard is the source's sequence id times this, plus the shard number, so the segments of
+# a source's shards don't collide with the segments of other sources.
+SHARD_SEGMENTS = 10000
+
+
+class Shard(object):
+    """A range of rows in a source's ingested datafile. A large source can be built as several shards, each in its
+    own process, with each shard writing its own segment partitions. The segments are coalesced with those of the
+    other sources when the partitions are unified.
+
+    The rows of a shard are numbered from its start_row, so the ids in a shard's segments are unique and increase
+    from shard to shard. They are the datafile row numbers only when no pipe drops or adds rows; if a filter or
+    a select drops rows, there are gaps at the shard boundaries where a whole-source build would have none.
+    Unifying the partitions renumbers the ids, so the unified partition has the same ids either way. """
+
+    def __init__(self, n, start_row, end_row=None):
+        """
+
+        :param n: Shard number, starting at 0
+        :param start_row: Index of the first data row of the shard
+        :param end_row: Index after the last data row of the shard, or None to read to the end of the datafile
+        """
+        assert 0 <= n < SHARD_SEGMENTS
+
+        self.n = n
+        self.start_row = start_row
+        self.end_row = end_row
+
+    def segment(self, source):
+        """Return the segment number for partitions written from this shard of a source"""
+        return source.sequence_id * SHARD_SEGMENTS + self.n
+
+    def __str__(self):
+        return 'shard {}: rows {} to {}'.format(self.n, self.start_row, self.end_row if self.end_row else 'end')
+
+
+def make_shards(n_rows, shard_rows):
+    """Return a list of Shards that cover n_rows rows, with about shard_rows rows in each. The last shard reads to
+    the end of the datafile, in case the row count does not include all of the rows. """
+
+    n_shards = max(1, min(SHARD_SEGMENTS, (n_rows + shard_rows - 1) // shard_rows))
+
+    shard_rows = (n_rows + n_shards - 1) // n_shards
+
+    return [Shard(i, i * shard_rows, (i + 1) * shard_rows if i < n_shards - 1 else None)
+            for i in range(n_shards)]
+
+
+def segment_sort_key(segment):
+    """Sort key for the segment number of a segment partition, which orders segments the same way as sorting
+    the partition names does, but keeps the shards of a source together and in order. """
+
+    if segment >= SHARD_SEGMENTS:
+        return str(segment // SHARD_SEGMENTS), segment % SHARD_SEGMENTS
+    else:
+        return str(segment), 0
+
+
+def is_shard_segment(segment):
+    """Return True if a segment number is for a shard of a source. The ids in a shard's segments start at the
+    shard's first row, so they must be renumbered when the partition is unified. """
+    return segment >= SHARD_SEGMENTS
+
+
+def _overrides(pipe, name, base):
+    """Return True if the pipe's class overrides the method ``name`` defined in ``base``"""
+    return (six.get_unbound_function(getattr(type(pipe), name)) is not
+            six.get_unbound_function(getattr(base, name)))
+
+
+def batched(itr, batch_size=DEFAULT_BATCH_SIZE):
+    """Yield the first item from an iterator, which is the header, then yield the remaining
+    items in lists of up to batch_size items"""
+    from itertools import islice
+
+    itr = iter(itr)
+
+    try:
+        yield next(itr)
+    except StopIteration:
+        return
+
+    while True:
+        batch = list(islice(itr, batch_size))
+
+        if not batch:
+            return
+
+        yield batch
+
+
+def iter_batches(pipe, batch_size=DEFAULT_BATCH_SIZE):
+    """Return a generator that yields the header from a pipe, then lists of rows. Pipes that only
+    produce single rows are batched by chunking their row iterator"""
+
+    if hasattr(pipe, 'iter_batches'):
+        return pipe.iter_batches(batch_size)
+    else:
+        return batched(pipe, batch_size)
+
+
 class Pipe(object):
     """A step in the pipeline"""
 
@@ -120,6 +223,19 @@ class Pipe(object):
     limit = None
     indent = '    '  # For __str__ formatting
 
+    _batch_stopped = False  # Set by process_batch() when process_body() stops the iteration
+    batch_size = None  # Set by iter_batches(), before process_header(), when the pipe processes batches
+
+    # If not None, the pipe can be fused into a compiled pipeline loop. 'pass' for pipes that only alter
+    # the header, 'map' for pipes that return a row for every row, and 'filter' for pipes that return
+    # either a row or None.
+    fusible = None
+    fused_in = None  # Set to the FusedPipe that runs this pipe in a compiled pipeline
+
+    # If True, the pipe is a source pipe that only touches the database before yielding its header, so its
+    # rows can be read in a background thread by a ReadAheadPipe.
+    read_ahead_ok = False
+
     scratch = {}  # Data area for the casters and derived values to use.
 
     @property
@@ -141,6 +257,20 @@ class Pipe(object):
 
         return self
 
+    @property
+    def shard(self):
+        """The Shard of the source's rows that the pipeline is building, or None if it is building all of them"""
+        return getattr(self.pipeline, 'shard', None)
+
+    @property
+    def source_segment(self):
+        """Segment number for the partitions written from the source: the source's sequence id, or, if the
+        pipeline is building a shard of the source, the shard's segment number"""
+
+        shard = self.shard
+
+        return shard.segment(self.source) if shard else self.source.sequence_id
+
     def process_header(self, headers):
         """Called to process the first row, the header. Must return the header,
         possibly modified. The returned header will be sent upstream"""
@@ -151,6 +281,61 @@ class Pipe(object):
         """Called to process each row in the body. Must return a row to be sent upstream"""
         return row
 
+    def process_batch(self, rows):
+        """Called to process a list of body rows when the pipeline runs in batch mode. Must return
+        a list of rows to be sent upstream. This implementation adapts process_body(), so pipes
+        only need to override it when they can process a whole batch more efficiently. """
+
+        header_len = len(self.headers)
+        process_body = self.process_body
+        out = []
+
+        try:
+            for row in rows:
+                row = process_body(row)
+
+                if row:  # Check that the rows have the same length as the header
+                    self.row_n += 1
+                    if len(row) != header_len:
+                        m = 'Header width mismatch in row {}. Row width = {}, header width = {}'.format(
+                            self.row_n, len(row), header_len)
+
+                        self.error(m)
+                        raise BadRowError(self, row, m)
+
+                    out.append(row)
+        except StopIteration:
+            # Pipes like Head stop the iteration from process_body(), so hand back the partial batch
+            # and let iter_batches() end the run.
+            self._batch_stopped = True
+
+        return out
+
+    def check_batch(self, rows):
+        """Check that the rows a process_batch() override returns are as wide as the header, as __iter__ and
+        process_batch() do for each row, and count them in row_n. Returns the rows. """
+
+        header_len = len(self.headers)
+
+        if any(len(row) != header_len for row in rows):
+            for row in rows:
+                self.row_n += 1
+                if len(row) != header_len:
+                    m = 'Header width mismatch in row {}. Row width = {}, header width = {}'.format(
+                        self.row_n, len(row), header_len)
+
+                    self.error(m)
+                    raise BadRowError(self, row, m)
+
+        self.row_n += len(rows)
+
+        return rows
+
+    def fused_body(self):
+        """Return the function that a compiled pipeline calls for each row. Called after the header
+        is processed"""
+        return self.process_body
+
     def finish(self):
         """Called after the last row has been processed"""
         pass
@@ -158,6 +343,7 @@ class Pipe(object):
     def __iter__(self):
         rg = iter(self._source_pipe)
         self.row_n = 0
+        self.batch_size = None
         self.headers = self.process_header(next(rg))
 
         yield self.headers
@@ -174,7 +360,7 @@ class Pipe(object):
                         m = 'Header width mismatch in row {}. Row width = {}, header width = {}'.format(
                             self.row_n, len(row), header_len)
 
-                        self.bundle.error(m)
+                        self.error(m)
                         raise BadRowError(self, row, m)
 
                     yield row
@@ -189,6 +375,42 @@ class Pipe(object):
 
         self.finish()
 
+    def iter_batches(self, batch_size=DEFAULT_BATCH_SIZE):
+        """Like __iter__, but after the header, yield lists of rows, which are processed with
+        process_batch() """
+
+        if _overrides(self, '__iter__', Pipe):
+            # The pipe generates its own rows, so all we can do is chunk them.
+            for batch in batched(self, batch_size):
+                yield batch
+            return
+
+        bg = iter_batches(self._source_pipe, batch_size)
+
+        self.row_n = 0
+        self._batch_stopped = False
+        self.batch_size = batch_size
+
+        try:
+            headers = next(bg)
+        except StopIteration:
+            return
+
+        self.headers = self.process_header(headers)
+
+        yield self.headers
+
+        for batch in bg:
+            batch = self.process_batch(batch)
+
+            if batch:
+                yield batch
+
+            if self._batch_stopped:
+                return
+
+        self.finish()
+
     def log(self, m):
 
         if self.bundle:
@@ -235,20 +457,83 @@ class RowProxyPipe(Pipe):
         self.finish()
 
 
+class FusedPipe(Pipe):
+    """Runs a sequence of fusible pipes in a single generated loop, rather than through a
+    generator for each pipe. Created by the Pipeline when it is run in compiled mode. """
+
+    def __init__(self, pipeline, n, pipes):
+
+        self.pipeline = pipeline
+        self.n = n
+        self.pipes = pipes
+        self.code = None
+
+        for p in self.pipes:
+            p.fused_in = self
+
+    @property
+    def name(self):
+        return 'fused_{}'.format(self.n)
+
+    def __iter__(self):
+        from .codegen import make_fused_loop
+
+        rg = iter(self._source_pipe)
+
+        headers = next(rg)
+
+        for p in self.pipes:
+            p.row_n = 0
+            p.batch_size = None
+            p.headers = headers = p.process_header(headers)
+
+        self.headers = headers
+
+        yield self.headers
+
+        self.code, env = make_fused_loop(self.name, self.pipes)
+
+        path = '<string>'
+
+        if self.bundle and self.source:
+            path = self.bundle.write_code('fused', '{}-{}'.format(self.source.name, self.name), self.code)
+
+        exec(compile(self.code, path, 'exec'), env)
+
+        for row in env[self.name](rg):
+            yield row
+
+        for p in self.pipes:
+            p.finish()
+
+    def __str__(self):
+        return '{}; {}'.format(qualified_class_name(self), ', '.join(qualified_class_name(p) for p in self.pipes))
+
+
 class DatafileSourcePipe(Pipe):
     """A Source pipe that generates rows from an MPR file.  """
 
-    def __init__(self, bundle, source):
+    read_ahead_ok = True  # Rows can be read in a background thread by a ReadAheadPipe
+
+    def __init__(self, bundle, source, shard=None):
+        """
+
+        :param bundle:
+        :param source: A source record or source name
+        :param shard: If not None, a Shard, and only the rows in the shard's row range are generated
+        :return:
+        """
         self.bundle = bundle
 
         if isinstance(source, string_types):
             source = bundle.source(source)
 
         self._source = source
+        self._shard = shard
 
         self._datafile = source.datafile
         # file_name is for the pipeline logger, to generate a file
-        self.file_name = source.name
+        self.file_name = source.name if shard is None else '{}-shard-{}'.format(source.name, shard.n)
         self.path = self._datafile.path
 
     def __iter__(self):
@@ -273,11 +558,21 @@ class DatafileSourcePipe(Pipe):
 
             yield self.headers
 
-            for row in r.rows:
+            if self._shard:
+                from itertools import islice
+                rows = islice(r.rows, self._shard.start_row, self._shard.end_row)
+            else:
+                rows = r.rows
+
+            for row in rows:
                 yield row
 
         self.finish()
 
+    @property
+    def shard(self):
+        return self._shard
+
     def start(self):
         pass
 
@@ -287,13 +582,17 @@ class DatafileSourcePipe(Pipe):
     def __str__(self):
         from ..util import qualified_class_name
 
-        return '{}; {} {}'.format(qualified_class_name(self), type(self.source), self.path)
+        shard = '; {}'.format(self._shard) if self._shard else ''
+
+        return '{}; {} {}{}'.format(qualified_class_name(self), type(self.source), self.path, shard)
 
 
 class SourceFileSourcePipe(Pipe):
     """A source pipe that read from the original data file, but skips rows according to the sources's
     row spec"""
 
+    read_ahead_ok = True
+
     def __init__(self, bundle, source_rec, source_file):
         """
 
@@ -327,6 +626,8 @@ class SourceFileSourcePipe(Pipe):
         itr = iter(self._file)
 
         start_line = self._source.start_line or 0
+        # Read before the header is yielded; with read-ahead, the rows are read in another thread
+        end_line = self._source.end_line
 
         # Throw away data before the data start line,
         for i in range(start_line):
@@ -336,8 +637,8 @@ class SourceFileSourcePipe(Pipe):
 
         if self.limit:
 
-            if self._source.end_line:
-                for i in range(start_line, self._source.end_line):
+            if end_line:
+                for i in range(start_line, end_line):
                     if i > self.limit:
                         break
                     yield next(itr)
@@ -350,8 +651,8 @@ class SourceFileSourcePipe(Pipe):
 
         else:
 
-            if self._source.end_line:
-                for i in range(start_line, self._source.end_line):
+            if end_line:
+                for i in range(start_line, end_line):
                     yield next(itr)
             else:
                 for row in itr:
@@ -418,6 +719,8 @@ class GeneratorSourcePipe(Pipe):
 class PartitionSourcePipe(Pipe):
     """Base class for a source pipe that implements it own iterator """
 
+    read_ahead_ok = True
+
     def __init__(self, bundle, source, partition):
 
         self.bundle = bundle
@@ -436,10 +739,16 @@ class PartitionSourcePipe(Pipe):
         if self.limit:
             raise NotImplementedError()
 
-        yield [c.name for c in self._partition.table.columns]
+        headers = [c.name for c in self._partition.table.columns]
 
-        for row in iter(self._partition):
-            yield row
+        # Get the reader before the header is yielded; with read-ahead, the rows are read in another thread
+        reader = self._partition.reader
+
+        yield headers
+
+        with reader as r:
+            for row in r:
+                yield row
 
         self.finish()
 
@@ -454,22 +763,163 @@ class PartitionSourcePipe(Pipe):
         return 'Partition {}'.format(qualified_class_name(self))
 
 
+class ReadAheadPipe(Pipe):
+    """Reads the rows from a source pipe in a background thread, and passes them on in batches through a
+    bounded queue, so that reading, decompressing and parsing the source overlaps with the casting and
+    writing in the downstream pipes.
+
+    The header is read in the calling thread, so the source pipe should do all of its database access
+    before yielding the header. The counters show which side is the bottleneck: reader_waits is the number
+    of times the reader found the queue full, and consumer_waits the number of times the downstream
+    pipes found it empty.
+    """
+
+    _end = object()  # Queue marker for the end of the rows
+
+    def __init__(self, queue_depth=4, read_batch_size=DEFAULT_BATCH_SIZE):
+        super(ReadAheadPipe, self).__init__()
+
+        self.queue_depth = queue_depth
+        self.read_batch_size = read_batch_size
+
+        self.reader_waits = 0
+        self.consumer_waits = 0
+        self.batches = 0
+        self.rows = 0
+
+    def _read(self, itr, q, stop):
+        """Thread function: put batches of rows from itr on the queue"""
+        from six.moves.queue import Full
+        from itertools import islice
+        import sys
+
+        def put(item):
+            try:
+                q.put_nowait(item)
+                return
+            except Full:
+                self.reader_waits += 1
+
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return
+                except Full:
+                    pass
+
+        try:
+            while not stop.is_set():
+                # The source may reuse a RowProxy for each row, so batches must hold copies
+                batch = [list(row) if isinstance(row, RowProxy) else row
+                         for row in islice(itr, self.read_batch_size)]
+
+                if not batch:
+                    break
+
+                put(batch)
+
+        except Exception:
+            put(sys.exc_info())
+
+        put(self._end)
+
+    def _iter_batches(self):
+        """Yield the header from the source pipe, then batches of rows, read by a background thread"""
+        import threading
+        from six.moves.queue import Queue, Empty
+
+        self.reader_waits = self.consumer_waits = self.batches = self.rows = 0
+
+        itr = iter(self._source_pipe)
+
+        try:
+            yield next(itr)
+        except StopIteration:
+            return
+
+        q = Queue(maxsize=self.queue_depth)
+        stop = threading.Event()
+
+        thread = threading.Thread(target=self._read, args=(itr, q, stop), name='read-ahead')
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                try:
+                    batch = q.get_nowait()
+                except Empty:
+                    self.consumer_waits += 1
+                    batch = q.get()
+
+                if batch is self._end:
+                    break
+
+                if isinstance(batch, tuple):  # exc_info from the reader thread
+                    six.reraise(*batch)
+
+                self.batches += 1
+                self.rows += len(batch)
+
+                yield batch
+        finally:
+            # Release the reader if the downstream pipes stopped early
+            stop.set()
+            thread.join(1)
+
+    def __iter__(self):
+
+        self.row_n = 0
+
+        bg = self._iter_batches()
+
+        try:
+            self.headers = next(bg)
+        except StopIteration:
+            return
+
+        yield self.headers
+
+        for batch in bg:
+            for row in batch:
+                self.row_n += 1
+                yield row
+
+    def iter_batches(self, batch_size=DEFAULT_BATCH_SIZE):
+        # The batches from the queue are passed on as they are, regardless of the downstream batch size
+        return self._iter_batches()
+
+    def report(self):
+        return ('queue depth {}, batch size {}: {} batches, {} rows, reader waited {} times, '
+                'consumer waited {} times'.format(self.queue_depth, self.read_batch_size, self.batches,
+                                                  self.rows, self.reader_waits, self.consumer_waits))
+
+    def __str__(self):
+        return '{}; {}'.format(qualified_class_name(self), self.report())
+
+
 class Sink(Pipe):
-    """ A final stage pipe, which consumes its input and produces no output rows. """
+    """ A final stage pipe, which consumes its input and produces no output rows. If a batch_size
+    is given to run(), the upstream pipes are run in batch mode. """
 
     def __init__(self, count=None, callback=None, callback_freq=1000):
         self._count = count
         self._callback = callback
         self._callback_freq = callback_freq
         self.i = 0
+        self.batches = 0
         self._start_time = None
 
-    def run(self, count=None,  *args, **kwargs):
+    def run(self, count=None, batch_size=None, *args, **kwargs):
         from time import time
 
         self._start_time = time()
 
         count = count if count else self._count
+
+        if batch_size:
+            return self.run_batches(count, batch_size)
+
         cb_count = self._callback_freq
         for i, row in enumerate(self._source_pipe):
             self.i = i
@@ -478,10 +928,37 @@ class Sink(Pipe):
 
             if cb_count == 0:
                 cb_count = self._callback_freq
-                self._callback(self, i)
+                if self._callback:
+                    self._callback(self, i)
             cb_count -= 1
 
+    def run_batches(self, count=None, batch_size=DEFAULT_BATCH_SIZE):
+        """Consume the upstream pipes in batches of rows. The callback is called about every
+        callback_freq rows. """
 
+        cb_count = self._callback_freq
+
+        bg = iter_batches(self._source_pipe, batch_size)
+
+        try:
+            next(bg)  # The header
+        except StopIteration:
+            return
+
+        for batch in bg:
+            self.batches += 1
+
+            if count and self.i + len(batch) >= count:
+                self.i = count
+                break
+
+            self.i += len(batch)
+
+            cb_count -= len(batch)
+            if cb_count <= 0:
+                cb_count = self._callback_freq
+                if self._callback:
+                    self._callback(self, self.i)
 
     def report_progress(self):
         """
@@ -493,7 +970,7 @@ class Sink(Pipe):
         from time import time
 
         # rows, rate = pl.sink.report_progress()
-        return (self.i, round(float(self.i) / float(time() - self._start_time), 2))
+        return (self.i, round(float(self.i) / max(float(time() - self._start_time), 1e-6), 2))
 
 
 class IterSource(Pipe):
@@ -544,6 +1021,8 @@ class Nullify(Pipe):
     """Turn all column values that don't represent a real value, such as SPACE, empty string, or None,
     into a real None value"""
 
+    fusible = 'map'
+
     def __init__(self):
         """
         Construct with one or more 2-element tuple or a string, in a similar format to what
@@ -568,6 +1047,11 @@ class Nullify(Pipe):
     def process_body(self, row):
         return self.row_processor(row)
 
+    def process_batch(self, rows):
+        # The rows are built from the positions of the header, so they are always as wide as the header
+        row_processor = self.row_processor
+        return [row_processor(row) for row in rows]
+
     def __str__(self):
         from ..util import qualified_class_name
         return '{} '.format(qualified_class_name(self))
@@ -577,6 +1061,8 @@ class Slice(Pipe):
     """Select a slice of the table, using a set of tuples to represent the start and end positions of each
     part of the slice."""
 
+    fusible = 'map'
+
     def __init__(self, *args):
         """
         Construct with one or more 2-element tuple or a string, in a similar format to what
@@ -660,6 +1146,10 @@ class Slice(Pipe):
 
         return self.slicer(row)
 
+    def process_batch(self, rows):
+        slicer = self.slicer
+        return self.check_batch([slicer(row) for row in rows])
+
     def __str__(self):
         from ..util import qualified_class_name
 
@@ -737,6 +1227,8 @@ class SelectRows(Pipe):
 
     """
 
+    fusible = 'filter'
+
     def __init__(self, pred):
         """
 
@@ -852,6 +1344,8 @@ class ReplaceWithDestHeader(Pipe):
     """Replace the incomming header with the destination header, excluding the destination tables
      first column, which should be the id"""
 
+    fusible = 'pass'
+
     def __init__(self):
         pass
 
@@ -925,6 +1419,8 @@ class MapSourceHeaders(Pipe):
      purpose of this pipe is to normalize multiple sources to one header structure, for instance,
       there are multiple year releases of a file that have column name changes from year to year. """
 
+    fusible = 'pass'
+
     def __init__(self, error_on_fail=False):
 
         self.error_on_fail = error_on_fail
@@ -967,6 +1463,9 @@ class MapSourceHeaders(Pipe):
 
         return super(MapSourceHeaders, self).process_body(row)
 
+    def process_batch(self, rows):
+        return self.check_batch(rows)
+
     def __str__(self):
         return qualified_class_name(self) + ': map = {} '.format(self.map)
 
@@ -974,6 +1473,8 @@ class MapSourceHeaders(Pipe):
 class NoOp(Pipe):
     """Do Nothing. Mostly for replacing other pipes to remove them from the pipeline"""
 
+    fusible = 'pass'
+
 
 class MangleHeader(Pipe):
     """"Alter the header so the values are well-formed, converting to alphanumerics and underscores"""
@@ -1178,6 +1679,8 @@ class AddDeleteExpand(Pipe):
 
     """
 
+    fusible = 'map'
+
     def __init__(self, add=[], delete=[], edit={}, expand={}, as_dict=False):
         """
 
@@ -1277,20 +1780,21 @@ class AddDeleteExpand(Pipe):
 
         try:
             r1 = self.edit_row(rp)
-        except:
-            # Todo, put this into the exception
-            print('EDIT ROW CODE', self.edit_row_code)
-            raise
+        except Exception as e:
+            raise PipelineError(self, "Failed to run edit row code: '{}' : {}".format(self.edit_row_code, e))
 
         try:
             r2 = self.expand_row(rp)
-        except:
-            # FIXME: put this into the exception
-            print('EXPAND ROW CODE: ', self.expand_row_code)
-            raise
+        except Exception as e:
+            raise PipelineError(self, "Failed to run expand row code: '{}' : {}".format(self.expand_row_code, e))
 
         return r1 + r2
 
+    def process_batch(self, rows):
+        # The expanders can return any number of values, so the rows are checked against the header
+        process_body = self.process_body
+        return self.check_batch([process_body(row) for row in rows])
+
     def __str__(self):
         from ..util import qualified_class_name
 
@@ -1375,11 +1879,14 @@ class CastColumns(Pipe):
 
     """
 
+    fusible = 'map'
+
     def __init__(self):
 
         super(CastColumns, self).__init__()
 
         self.row_processors = []
+        self.batch_processor = None # Vectorized caster, for batch mode
         self.orig_headers = None
         self.new_headers = None
         self.row_proxy_1 = None # Row proxy with  source headers
@@ -1406,7 +1913,18 @@ class CastColumns(Pipe):
 
         self.row_proxy_2 = RowProxy(self.new_headers)
 
-        self.row_processors = self.bundle.build_caster_code(self.source, headers, pipe=self)
+        if self.shard:
+            # Number the rows from the shard's first datafile row, so row numbers don't overlap those of the
+            # earlier shards. If rows are dropped, they don't match a whole-source build; see Shard.
+            self.row_n = self.shard.start_row
+
+        if self.batch_size:
+            # In batch mode, try to cast whole columns at once. Requires NumPy.
+            self.row_processors, self.batch_processor = self.bundle.build_caster_code(
+                self.source, headers, pipe=self, vectorize=True)
+        else:
+            self.row_processors = self.bundle.build_caster_code(self.source, headers, pipe=self)
+            self.batch_processor = None
 
         self.errors = {}
 
@@ -1440,6 +1958,79 @@ class CastColumns(Pipe):
 
         return row
 
+    def process_batch(self, rows):
+        """Cast a batch of rows. The row processors build each row from the columns of the destination table,
+        so the rows are always as wide as the header, and aren't checked. """
+        from ambry.valuetype.exceptions import CastingError, TooManyCastingErrors
+
+        row_processors = self.row_processors
+        rp1, rp2 = self.row_proxy_1, self.row_proxy_2
+        errors, accumulator, bundle, source = self.errors, self.accumulator, self.bundle, self.source
+
+        row_n = self.row_n
+
+        out = []
+        append = out.append
+
+        try:
+            if self.batch_processor and rows:
+                # Values for the vectorized columns, which the first row processor leaves as None. They
+                # have to be in the rows before the later stages, which can reference them.
+                vector_cols = self.batch_processor(rows, row_n, errors, accumulator, self, bundle, source, rp1)
+
+                first = row_processors[0]
+                scratches = []
+
+                for row in rows:
+                    scratch = {}
+                    append(first(rp1.set_row(row), row_n, errors, scratch, accumulator, self, bundle, source))
+                    scratches.append(scratch)
+                    row_n += 1
+
+                for i, values in vector_cols:
+                    for row, v in zip(out, values):
+                        row[i] = v
+
+                rows, out = out, []
+                append = out.append
+                row_n = self.row_n
+                row_processors = row_processors[1:]
+                rp1 = rp2
+            else:
+                scratches = None
+
+            for j, row in enumerate(rows):
+                scratch = scratches[j] if scratches else {}
+                rp = rp1
+
+                for proc in row_processors:
+                    row = proc(rp.set_row(row), row_n, errors, scratch, accumulator, self, bundle, source)
+                    rp = rp2
+
+                append(row)
+                row_n += 1
+
+        except CastingError as e:
+            raise PipelineError(self, "Failed to cast column in table {}, row {}: {}"
+                                .format(self.source.dest_table.name, row_n, e))
+        except TooManyCastingErrors:
+            self.report_errors()
+        finally:
+            self.row_n = row_n
+
+        return out
+
+    def fused_body(self):
+
+        process_body = self.process_body
+
+        def cast_row(row):
+            row = process_body(row)
+            self.row_n += 1
+            return row
+
+        return cast_row
+
     def report_errors(self):
 
         from ambry.valuetype.exceptions import TooManyCastingErrors
@@ -1514,6 +2105,8 @@ class RemoveBlankColumns(Pipe):
 class Skip(Pipe):
     """Skip rows of a table that match a predicate """
 
+    fusible = 'filter'
+
     def __init__(self, pred, table=None):
         """
 
@@ -1585,6 +2178,25 @@ class Skip(Pipe):
             self.bundle.error("Failed to process predicate in Skip pipe: '{}' ".format(self.code))
             raise
 
+    def process_batch(self, rows):
+
+        if not self._check:
+            self.ignored += len(rows)
+            return self.check_batch(rows)
+
+        pred, bundle, source, rp = self.pred, self.bundle, self.source, self.row_proxy
+
+        try:
+            out = [row for row in rows if not pred(self, bundle, source, rp.set_row(row))]
+        except Exception as e:
+            self.bundle.error("Failed to process predicate in Skip pipe: '{}' ".format(self.code))
+            raise
+
+        self.skipped += len(rows) - len(out)
+        self.passed += len(out)
+
+        return self.check_batch(out)
+
 
 class Collect(Pipe):
     """Collect rows so they can be viewed or processed after the run. """
@@ -1737,6 +2349,8 @@ class SelectPartition(Pipe):
 
      """
 
+    fusible = 'map'
+
     def __init__(self, select_f=None):
         """
 
@@ -1769,8 +2383,10 @@ class SelectPartition(Pipe):
 
             self.select_f = select_f
             self.process_body = self.process_body_select
+            self.process_batch = self.process_batch_select
         else:
             self.process_body = self.process_body_default
+            self.process_batch = self.process_batch_default
 
         self._row_proxy = None
 
@@ -1783,7 +2399,7 @@ class SelectPartition(Pipe):
                                              # time=self.source.time,
                                              # space=self.source.space,
                                              # grain=self.source.grain,
-                                             segment=self.source.sequence_id)
+                                             segment=self.source_segment)
         self._orig_headers = row
         self._row_proxy = RowProxy(row)
         return row + ['_pname']
@@ -1808,6 +2424,28 @@ class SelectPartition(Pipe):
     def process_body_default(self, row):
         return list(row) + [self._default]
 
+    def process_batch_select(self, rows):
+        select_f, bundle, source, rp = self.select_f, self.bundle, self.source, self._row_proxy
+
+        out = []
+
+        for row in rows:
+            name = select_f(self, bundle, source, rp.set_row(row))
+
+            if not isinstance(name, PartialPartitionName):
+                name = PartialPartitionName(**name)
+
+            if not name.table:
+                name.table = source.dest_table_name
+
+            out.append(list(row) + [name])
+
+        return self.check_batch(out)
+
+    def process_batch_default(self, rows):
+        default = [self._default]
+        return self.check_batch([list(row) + default for row in rows])
+
     def __str__(self):
         return qualified_class_name(self) + ' selector = {}'.format(self._code)
 
@@ -1815,6 +2453,8 @@ class SelectPartition(Pipe):
 class SelectPartitionFromSource(Pipe):
     """Set the name of the partition to write rows to from the  table, time, space and grain of the source"""
 
+    fusible = 'map'
+
     def __init__(self, use_source_id=True):
         self._default = None
         self._code = 'default'
@@ -1830,7 +2470,7 @@ class SelectPartitionFromSource(Pipe):
             time=str(self.source.time) if self.source.time is not None else None,
             space=str(self.source.space) if self.source.space is not None else None,
             grain=str(self.source.grain) if self.source.grain is not None else None,
-            segment=self.source.sequence_id if self._use_source_id else None)
+            segment=self.source_segment if self._use_source_id else None)
 
         self._orig_headers = row
         self._row_proxy = RowProxy(row)
@@ -1851,6 +2491,8 @@ class PartitionWriter(object):
 class WriteToPartition(Pipe, PartitionWriter):
     """Writes to one of several partitions, depending on the contents of columns that selects a partition"""
 
+    fusible = 'map'
+
     def __init__(self):
         """
 
@@ -1883,7 +2525,12 @@ class WriteToPartition(Pipe, PartitionWriter):
 
         self._headers[self.source.name] = row
 
-        self._source_id = self.source.sequence_id
+        self._source_id = self.source_segment
+
+        if self.shard:
+            # Number the rows from the start of the shard, so the ids of the shards' segments don't overlap. They
+            # are renumbered when the partitions are unified; see Shard.
+            self._count = self.shard.start_row
 
         self._start_time = time.time()
 
@@ -1902,7 +2549,6 @@ class WriteToPartition(Pipe, PartitionWriter):
         return p
 
     def process_body(self, row):
-        from ambry.orm.exc import NotFoundError
 
         self._count += 1
 
@@ -1911,6 +2557,69 @@ class WriteToPartition(Pipe, PartitionWriter):
         if not pname.segment:
             pname.segment = self._source_id
 
+        (p, header_mapper, body_mapper, writer) = self._datafile(pname)
+
+        try:
+            mapped_row = body_mapper(row)
+
+            # Assuming it is an ID!
+            if mapped_row[0] is None:
+                mapped_row[0] = self._count
+
+            writer.insert_row(mapped_row)
+        except Exception as e:
+            self.bundle.logger.error('Insert failed to {}: {}\n{}'.format(p.datafile.path, mapped_row, e))
+            raise
+
+        return row
+
+    def process_batch(self, rows):
+        # The rows are passed on unchanged, and SelectPartition has already checked their widths
+
+        p_name_index = self.p_name_index
+        count = self._count
+
+        last_pname = None
+        p, body_mapper, writer = None, None, None
+        mapped_row = None
+
+        try:
+            for row in rows:
+                count += 1
+
+                pname = row[p_name_index]
+
+                # Most selectors return the same name object for every row, so only look up the
+                # datafile when it changes.
+                if pname is not last_pname:
+                    if not pname.segment:
+                        pname.segment = self._source_id
+
+                    (p, _, body_mapper, writer) = self._datafile(pname)
+                    last_pname = pname
+
+                mapped_row = body_mapper(row)
+
+                # Assuming it is an ID!
+                if mapped_row[0] is None:
+                    mapped_row[0] = count
+
+                writer.insert_row(mapped_row)
+
+        except Exception as e:
+            self.bundle.logger.error('Insert failed to {}: {}\n{}'.format(p.datafile.path if p else None,
+                                                                            mapped_row, e))
+            raise
+        finally:
+            self._count = count
+
+        return rows
+
+    def _datafile(self, pname):
+        """Return the partition, mappers and writer for a partition name, creating the partition
+        and its datafile if they don't exist yet. """
+        from ambry.orm.exc import NotFoundError
+
         df_key = (str(self.source.name), str(pname))
 
         try:
@@ -1950,19 +2659,7 @@ class WriteToPartition(Pipe, PartitionWriter):
             # It is a new datafile, so it needs a header.
             writer.headers = header_mapper(self.headers)
 
-        try:
-            mapped_row = body_mapper(row)
-
-            # Assuming it is an ID!
-            if mapped_row[0] is None:
-                mapped_row[0] = self._count
-
-            writer.insert_row(mapped_row)
-        except Exception as e:
-            self.bundle.logger.error('Insert failed to {}: {}\n{}'.format(p.datafile.path, mapped_row, e))
-            raise
-
-        return row
+        return p, header_mapper, body_mapper, writer
 
     def finish(self):
 
@@ -2053,7 +2750,18 @@ class PipelineSegment(list):
 
 
 class Pipeline(OrderedDict):
-    """Hold a defined collection of PipelineGroups, and when called, coalesce them into a single pipeline """
+    """Hold a defined collection of PipelineGroups, and when called, coalesce them into a single pipeline
+
+    If batch_size is set, either in the constructor, the 'batch_size' key of the pipeline configuration,
+    or in run(), the pipes pass lists of rows to each other, using Pipe.process_batch(), rather than one row
+    at a time.
+
+    If compiled is set, in the same ways, runs of consecutive fusible pipes are replaced with a FusedPipe,
+    which processes rows for all of them in one generated loop.
+
+    If read_ahead is set to a queue depth, and the source pipe allows it, a ReadAheadPipe reads the source
+    rows in a background thread, in batches of read_ahead_batch_size rows.
+    """
 
     bundle = None
     name = None
@@ -2063,6 +2771,12 @@ class Pipeline(OrderedDict):
     source_name = None
     final = None
     sink = None
+    batch_size = None
+    compiled = False
+    read_ahead = None
+    read_ahead_batch_size = None
+    read_ahead_pipe = None  # The ReadAheadPipe from the last run
+    shard = None  # A Shard, when the pipeline builds only a range of the source's rows
 
     _group_names = ['source', 'source_map', 'first', 'map', 'cast', 'body',
                     'last', 'select_partition', 'write', 'final']
@@ -2079,6 +2793,10 @@ class Pipeline(OrderedDict):
         super(Pipeline, self).__setattr__('final', [])
         super(Pipeline, self).__setattr__('stopped', False)
         super(Pipeline, self).__setattr__('sink', None)
+        super(Pipeline, self).__setattr__('batch_size', kwargs.pop('batch_size', None))
+        super(Pipeline, self).__setattr__('compiled', kwargs.pop('compiled', False))
+        super(Pipeline, self).__setattr__('read_ahead', kwargs.pop('read_ahead', None))
+        super(Pipeline, self).__setattr__('read_ahead_batch_size', kwargs.pop('read_ahead_batch_size', None))
 
         for k, v in iteritems(kwargs):
             if k not in self._group_names:
@@ -2142,6 +2860,18 @@ class Pipeline(OrderedDict):
                 # The 'final' segment is actually a list of names of Bundle methods to call afer the pipeline
                 # completes
                 super(Pipeline, self).__setattr__('final', pipes)
+            elif segment_name == 'batch_size':
+                # Not a segment; the number of rows per batch, to run the pipeline in batch mode.
+                super(Pipeline, self).__setattr__('batch_size', int(pipes) if pipes else None)
+            elif segment_name == 'compiled':
+                # Not a segment; if true, fuse pipes into a generated loop
+                super(Pipeline, self).__setattr__('compiled', bool(pipes))
+            elif segment_name == 'read_ahead':
+                # Not a segment; the number of batches to queue when reading the source in a background thread
+                super(Pipeline, self).__setattr__('read_ahead', int(pipes) if pipes else None)
+            elif segment_name == 'read_ahead_batch_size':
+                # Not a segment; the number of rows in each read-ahead batch
+                super(Pipeline, self).__setattr__('read_ahead_batch_size', int(pipes) if pipes else None)
             elif segment_name == 'replace':
                 for frm, to in iteritems(pipes):
                     self.replace(eval_pipe(frm), eval_pipe(to))
@@ -2260,7 +2990,8 @@ class Pipeline(OrderedDict):
 
     def __setattr__(self, k, v):
         if k.startswith('_OrderedDict__') or k in (
-                'name', 'phase', 'sink', 'dest_table', 'source_name', 'source_table', 'final'):
+                'name', 'phase', 'sink', 'dest_table', 'source_name', 'source_table', 'final', 'batch_size',
+                'compiled', 'read_ahead', 'read_ahead_batch_size', 'read_ahead_pipe', 'shard'):
             return super(Pipeline, self).__setattr__(k, v)
 
         self.__setitem__(k, v)
@@ -2298,7 +3029,77 @@ class Pipeline(OrderedDict):
 
         return chain, last
 
-    def run(self, count=None, source_pipes=None, callback=None, limit = None):
+    def _fuse(self, chain):
+        """Re-link a collected chain, replacing runs of fusible pipes with FusedPipes. Returns the
+        new last pipe. The chain itself is not altered, so pipes can still be found by class."""
+
+        last = None
+        run = []
+        n = 0
+
+        def fuse_run(last, n):
+            fp = FusedPipe(self, n, run[:])
+            fp.bundle = self.bundle
+            fp.segment = run[0].segment
+            fp.set_source_pipe(last)
+            del run[:]
+            return fp
+
+        for p in chain:
+            p.fused_in = None
+
+            if last is not None and p.fusible and not _overrides(p, '__iter__', Pipe):
+                run.append(p)
+                continue
+
+            if run:
+                last = fuse_run(last, n)
+                n += 1
+
+            if last is not None:
+                p.set_source_pipe(last)
+
+            last = p
+
+        if run:
+            last = fuse_run(last, n)
+
+        return last
+
+    def _read_ahead(self, chain, last, batch_size):
+        """If read-ahead is configured and the source pipe allows it, link a ReadAheadPipe after the source
+        pipe. Returns the new last pipe. """
+
+        source_pipe = chain[0] if chain else None
+
+        super(Pipeline, self).__setattr__('read_ahead_pipe', None)
+
+        if not self.read_ahead or not getattr(source_pipe, 'read_ahead_ok', False):
+            return last
+
+        ra = ReadAheadPipe(self.read_ahead, self.read_ahead_batch_size or batch_size or DEFAULT_BATCH_SIZE)
+        ra.bundle = self.bundle
+        ra.segment = source_pipe.segment
+        ra.set_source_pipe(source_pipe)
+
+        super(Pipeline, self).__setattr__('read_ahead_pipe', ra)
+
+        if last is source_pipe:
+            return ra
+
+        # Find the pipe that reads from the source, which may be a FusedPipe
+        p = last
+        while p._source_pipe is not source_pipe:
+            p = p._source_pipe
+
+        p.set_source_pipe(ra)
+
+        return last
+
+    def run(self, count=None, source_pipes=None, callback=None, limit = None, batch_size=None, compiled=None):
+
+        batch_size = batch_size or self.batch_size
+        compiled = self.compiled if compiled is None else compiled
 
         try:
 
@@ -2315,16 +3116,26 @@ class Pipeline(OrderedDict):
 
                     chain, last = self._collect()
 
+                    if compiled:
+                        last = self._fuse(chain)
+
+                    last = self._read_ahead(chain, last, batch_size)
+
                     self.sink.set_source_pipe(last)
 
-                    self.sink.run(limit=limit)
+                    self.sink.run(limit=limit, batch_size=batch_size)
 
             else:
                 chain, last = self._collect()
 
+                if compiled:
+                    last = self._fuse(chain)
+
+                last = self._read_ahead(chain, last, batch_size)
+
                 self.sink.set_source_pipe(last)
 
-                self.sink.run(limit=limit)
+                self.sink.run(limit=limit, batch_size=batch_size)
 
         except StopPipe:
             super(Pipeline, self).__setattr__('stopped', True)
@@ -2346,12 +3157,44 @@ class Pipeline(OrderedDict):
 
         for pipe in chain:
             segment_name = pipe.segment.name if hasattr(pipe, 'segment') else '?'
-            out.append(u('{}: {}').format(segment_name, pipe))
+            fused = ' [{}]'.format(pipe.fused_in.name) if getattr(pipe, 'fused_in', None) else ''
+            out.append(u('{}: {}{}').format(segment_name, pipe, fused))
 
         out.append('final: ' + str(self.final))
 
         return 'Pipeline {}\n'.format(self.name if self.name else '') + '\n'.join(out)
 
+    def fused_report(self):
+        """Return a description of which pipes were fused into generated loops in the last compiled run"""
+
+        chain, last = self._collect()
+
+        groups = OrderedDict()
+        unfused = []
+
+        for pipe in chain:
+            fp = getattr(pipe, 'fused_in', None)
+            if fp:
+                groups.setdefault(fp.name, []).append(qualified_class_name(pipe))
+            else:
+                unfused.append(qualified_class_name(pipe))
+
+        if not groups:
+            return 'No fused pipes'
+
+        out = ['{}: {}'.format(name, ', '.join(pipes)) for name, pipes in iteritems(groups)]
+        out.append('Not fused: {}'.format(', '.join(unfused)))
+
+        return '\n'.join(out)
+
+    def read_ahead_report(self):
+        """Return the queue and starvation counters of the read-ahead thread from the last run"""
+
+        if not self.read_ahead_pipe:
+            return 'No read-ahead'
+
+        return self.read_ahead_pipe.report()
+
     def headers_report(self):
 
         out = []
@@ -8,6 +8,7 @@ import imp
 import os
 import sys
 import tempfile
+import time
 import traceback
 
 import json
@@ -32,6 +33,7 @@ from ambry.run import get_runconfig
 from ambry.util import get_logger, memoize
 
 from .filesystem import LibraryFilesystem
+from .refcache import RefCache
 
 logger = get_logger(__name__)
 # debug logging
@@ -93,7 +95,20 @@ class Library(object):
 
         self._fs = LibraryFilesystem(config)
 
-        self._db = Database(self._fs.database_dsn, echo=echo)
+        library_config = self._config.library or {}
+
+        # For Sqlite libraries that are read while bundles are building, like those for the web UI
+        read_concurrency = bool(library_config.get('read_concurrency'))
+
+        # Postgres pool settings. Behind a transaction pooler, like pgbouncer, the workers of a build don't
+        # keep connections open; the pooler shares a few server connections among all of them.
+        pool = {k: int(library_config.get(k)) for k in ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle')
+                if library_config.get(k) is not None}
+
+        null_pool = bool(library_config.get('pgbouncer')) and bool(int(os.getenv('AMBRY_WORKER', 0)))
+
+        self._db = Database(self._fs.database_dsn, echo=echo, read_concurrency=read_concurrency,
+                            read_only=read_only, pool=pool, null_pool=null_pool)
 
         self._account_password = self.config.accounts.password
 
@@ -107,6 +122,8 @@ class Library(object):
 
         self.processes = None  # Number of multiprocessing proccors. Default to all of them
 
+        self._ref_cache = RefCache(self._db)
+
         if search:
             self._search = Search(self, search)
         else:
@@ -170,9 +187,11 @@ class Library(object):
         return self.database.drop()
 
     def clean(self):
+        self._ref_cache.invalidate()
         return self.database.clean()
 
     def close(self):
+        self._ref_cache.invalidate()
         return self.database.close()
 
     def exists(self):
@@ -251,6 +270,7 @@ class Library(object):
 
         ds = self._db.new_dataset(**kwargs)
         self._db.commit()
+        self._ref_cache.invalidate_revisions(ds.vid)
 
         b = self.bundle(ds.vid)
         b.state = Bundle.STATES.NEW
@@ -282,6 +302,7 @@ class Library(object):
 
         if not ds:
             ds = self._db.new_dataset(**identity.dict)
+            self._ref_cache.invalidate_revisions(ds.vid)
 
         b = Bundle(ds, self)
         b.commit()
@@ -300,10 +321,15 @@ class Library(object):
         if isinstance(ref, Dataset):
             ds = ref
         else:
-            try:
-                ds = self._db.dataset(ref)
-            except NotFoundError:
-                ds = None
+            vid = self._ref_cache.get('bundle', ref)
+
+            ds = self._db.session.query(Dataset).get(vid) if vid else None
+
+            if not ds:
+                try:
+                    ds = self._db.dataset(ref)
+                except NotFoundError:
+                    ds = None
 
         if not ds:
             try:
@@ -315,6 +341,9 @@ class Library(object):
         if not ds:
             raise NotFoundError('Failed to find dataset for ref: {}'.format(ref))
 
+        ds._database = self._db
+        self._ref_cache.put('bundle', ref, ds.vid, ds.vid)
+
         b = Bundle(ds, self)
         b.capture_exceptions = capture_exceptions
 
@@ -345,30 +374,38 @@ class Library(object):
         if not ref:
             raise NotFoundError("No partition for empty ref")
 
-        try:
-            on = ObjectNumber.parse(ref)
-            ds_on = on.as_dataset
+        vid = self._ref_cache.get('partition', ref)
+
+        # Usually comes from the session's identity map, without a query
+        p = self.database.session.query(Partition).get(vid) if vid else None
 
-            ds = self._db.dataset(ds_on)  # Could do it in on SQL query, but this is easier.
+        if not p:
+            try:
+                on = ObjectNumber.parse(ref)
+                ds_on = on.as_dataset
 
-            # The refresh is required because in some places the dataset is loaded without the partitions,
-            # and if that persist, we won't have partitions in it until it is refreshed.
+                ds = self._db.dataset(ds_on)  # Could do it in on SQL query, but this is easier.
 
-            self.database.session.refresh(ds)
+                # The refresh is required because in some places the dataset is loaded without the partitions,
+                # and if that persist, we won't have partitions in it until it is refreshed.
 
-            p = ds.partition(ref)
+                self.database.session.refresh(ds)
 
-        except NotObjectNumberError:
-            q = (self.database.session.query(Partition)
-                 .filter(or_(Partition.name == str(ref), Partition.vname == str(ref)))
-                 .order_by(Partition.vid.desc()))
+                p = ds.partition(ref)
 
-            p = q.first()
+            except NotObjectNumberError:
+                q = (self.database.session.query(Partition)
+                     .filter(or_(Partition.name == str(ref), Partition.vname == str(ref)))
+                     .order_by(Partition.vid.desc()))
 
-        if not p:
-            raise NotFoundError("No partition for ref: '{}'".format(ref))
+                p = q.first()
 
-        b = self.bundle(p.d_vid)
+            if not p:
+                raise NotFoundError("No partition for ref: '{}'".format(ref))
+
+            self._ref_cache.put('partition', ref, p.d_vid, p.vid)
+
+        b = self._ref_cache.bundle(self, p.d_vid)
         p = b.wrap_partition(p)
 
         if localize:
@@ -390,6 +427,13 @@ class Library(object):
 
         """
 
+        vid = self._ref_cache.get('table', ref)
+
+        table = self.database.session.query(Table).get(vid) if vid else None
+
+        if table:
+            return table
+
         try:
             obj_number = ObjectNumber.parse(ref)
             ds_obj_number = obj_number.as_dataset
@@ -406,6 +450,9 @@ class Library(object):
 
         if not table:
             raise NotFoundError("No table for ref: '{}'".format(ref))
+
+        self._ref_cache.put('table', ref, table.d_vid, table.vid)
+
         return table
 
     def remove(self, bundle):
@@ -416,6 +463,8 @@ class Library(object):
         if isinstance(bundle, string_types):
             bundle = self.bundle(bundle)
 
+        self._ref_cache.invalidate(bundle.dataset.vid)
+
         self.database.remove_dataset(bundle.dataset)
 
     #
@@ -466,6 +515,7 @@ class Library(object):
         del d['cache_key']
 
         ds = self.database.new_dataset(**d)
+        self._ref_cache.invalidate_revisions(ds.vid)
 
         nb = self.bundle(ds.vid)
         nb.set_file_system(source_url=b.source_fs.getsyspath('/'))
@@ -512,12 +562,29 @@ class Library(object):
         except NotFoundError:
             pass
 
+        copied = []
+
+        def copy_cb(message, n):
+            copied.append((message, n))
+            if cb:
+                cb(message, n)
+
+        t0 = time.time()
+
         try:
             self.dataset(ds.vid)  # Skip loading bundles we already have
         except NotFoundError:
-            self.database.copy_dataset(ds, cb=cb)
+            self.database.copy_dataset(ds, cb=copy_cb)
+            self._ref_cache.invalidate_revisions(ds.vid)
 
         b = self.bundle(ds.vid)  # It had better exist now.
+
+        if copied:
+            with b.progress.start('checkin', 0, message='Check in bundle') as ps:
+                for message, n in copied:
+                    ps.add(message=message, item_type='records', item_count=n)
+
+                ps.add(message='Copied bundle {} in {:0.2f}s'.format(ds.vid, time.time() - t0))
         # b.state = Bundle.STATES.INSTALLED
         b.commit()
 
@@ -525,6 +592,9 @@ class Library(object):
 
         self.search.index_bundle(b)
 
+        # Move the records of the check in out of the write-ahead log, so the log doesn't grow and slow readers
+        self.database.checkpoint()
+
         return b
 
     def send_to_remote(self, b, no_partitions=False):
@@ -1161,17 +1231,58 @@ class Library(object):
         return bundles
 
     def process_pool(self, limited_run=False):
-        """Return a pool for multiprocess operations, sized either to the number of CPUS, or a configured value"""
+        """Return a pool for multiprocess operations, sized either to the number of CPUS, or a configured value
+
+        By default, each worker process runs one task and exits. If the library.worker_mode config value is
+        'warm', the workers run many tasks, and keep the library and bundles loaded between them. For warm
+        workers, library.worker_max_tasks sets the number of tasks a worker runs before it is replaced.
+
+        If library.worker_mode is 'queue', the pool adds the tasks to the library build queue, for workers on
+        any host to run, and the number of processes is the number of tasks to keep in the queue.
+
+        For local pools, library.memory_budget is the number of megabytes that the workers may use together. A
+        task only starts if the estimate of its memory, from previous runs of its source, fits in the budget.
+        library.memory_limit is the number of megabytes that a task may add to the memory of its worker before
+        the worker is terminated, and the task is run again, by itself.
+        """
 
         from multiprocessing import cpu_count
-        from ambry.bundle.concurrent import Pool, init_library
+        from ambry.bundle.concurrent import Pool, init_library, worker, warm_worker
 
         if self.processes:
             cpus = self.processes
         else:
             cpus = cpu_count()
 
-        self.logger.info('Starting MP pool with {} processors'.format(cpus))
-        return Pool(self, processes=cpus, initializer=init_library,
-                    maxtasksperchild=1,
-                    initargs=[self.database.dsn, self._account_password, limited_run])
+        library_config = self.config.library or {}
+
+        if library_config.get('worker_mode') == 'queue':
+            from ambry.bundle.workqueue import QueuePool
+
+            self.logger.info('Queueing tasks for build workers, {} at a time'.format(cpus))
+            return QueuePool(self, cpus)
+
+        elif library_config.get('worker_mode') == 'warm':
+            worker_f = warm_worker
+            max_tasks = library_config.get('worker_max_tasks')
+            max_tasks = int(max_tasks) if max_tasks else None
+        else:
+            worker_f = worker
+            max_tasks = 1
+
+        mb = lambda k: int(float(library_config.get(k)) * 2 ** 20) if library_config.get(k) else None
+
+        memory_budget = mb('memory_budget')
+        memory_limit = mb('memory_limit')
+
+        self.logger.info('Starting MP pool with {} processors{}{}'
+                         .format(cpus, ', warm workers' if worker_f is warm_worker else '',
+                                 ', memory budget {} MB'.format(library_config.get('memory_budget'))
+                                 if memory_budget else ''))
+        pool = Pool(self, processes=cpus, initializer=init_library,
+                    maxtasksperchild=max_tasks, worker_f=worker_f,
+                    initargs=[self.database.dsn, self._account_password, limited_run, memory_limit])
+
+        pool.memory_budget = memory_budget
+
+        return pool
@@ -33,7 +33,12 @@ class LibraryFilesystem(object):
             p = join(p, *args)
 
         if not isdir(p) and mkdir:
-            makedirs(p)
+            try:
+                makedirs(p)
+            except OSError:
+                # Another process, such as a build worker, may have just created it.
+                if not isdir(p):
+                    raise
 
         p = normpath(p)
 
@@ -62,6 +67,10 @@ class LibraryFilesystem(object):
     def extracts(self, *args):
         return self._compose('extracts',args)
 
+    def fingerprints(self, *args):
+        """Store of build outputs, keyed by the fingerprints of the builds. May be shared between machines"""
+        return self._compose('fingerprints',args)
+
     def python(self, *args):
         return self._compose('python',args)
 
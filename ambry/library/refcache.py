@@ -0,0 +1,125 @@
+"""Cache of the objects that references to bundles, partitions and tables resolve to.
+
+Copyright (c) 2016 Civic Knowledge. This file is licensed under the terms of the
+Revised BSD License, included in this distribution as LICENSE.txt
+"""
+
+import time
+
+from six import string_types
+
+from ambry.identity import ObjectNumber
+
+
+class RefCache(object):
+    """Maps references to the vids they resolved to, so the library can load the object by its primary key,
+    usually from the session's identity map, rather than searching for it again.
+
+    A reference that is a vid always resolves to the same object. Other references, like ids and names,
+    resolve to the latest revision of a dataset, so the cache entries for them are dropped when a later
+    revision appears. The latest revisions are checked at most once every ``check_interval`` seconds.
+    """
+
+    def __init__(self, database, check_interval=5):
+        self._database = database
+        self.check_interval = check_interval
+
+        self._entries = {}  # (kind, ref) -> (dataset vid, object vid)
+        self._latest = {}  # dataset vid -> (time checked, vid of the latest revision)
+        self._bundles = {}  # dataset vid -> Bundle, for wrapping partitions
+
+    @staticmethod
+    def key(kind, ref):
+        """Return the cache key for a reference, or None if the reference can't be cached"""
+
+        if isinstance(ref, ObjectNumber):
+            ref = str(ref)
+
+        if not isinstance(ref, string_types) or not ref:
+            return None
+
+        return (kind, ref)
+
+    def get(self, kind, ref):
+        """Return the vid of the object that the reference last resolved to, or None"""
+
+        key = self.key(kind, ref)
+
+        try:
+            d_vid, vid = self._entries[key]
+        except KeyError:
+            return None
+
+        if key[1] != vid and self.latest_revision(d_vid) != d_vid:
+            self.invalidate(d_vid)
+            return None
+
+        return vid
+
+    def put(self, kind, ref, d_vid, vid):
+        key = self.key(kind, ref)
+
+        if key:
+            self._entries[key] = (d_vid, vid)
+
+            if key[1] != vid and d_vid not in self._latest:
+                # The reference was just resolved, so this is the latest revision for now
+                self._latest[d_vid] = (time.time(), d_vid)
+
+    def latest_revision(self, d_vid):
+        """Return the vid of the latest revision of the dataset"""
+        from ambry.orm import Dataset
+
+        checked, latest = self._latest.get(d_vid, (0, None))
+
+        if time.time() - checked > self.check_interval:
+            session = self._database.session
+
+            d_id = session.query(Dataset.id).filter(Dataset.vid == d_vid).as_scalar()
+
+            latest = (session.query(Dataset.vid)
+                      .filter(Dataset.id == d_id)
+                      .order_by(Dataset.revision.desc())
+                      .limit(1).scalar())
+
+            self._latest[d_vid] = (time.time(), latest)
+
+        return latest
+
+    def bundle(self, library, d_vid):
+        """Return a bundle for wrapping the partitions of a dataset, shared by all of the partitions"""
+        from ambry.bundle import Bundle
+
+        try:
+            return self._bundles[d_vid]
+        except KeyError:
+            b = self._bundles[d_vid] = Bundle(library.dataset(d_vid), library)
+            return b
+
+    def invalidate(self, d_vid=None):
+        """Drop the entries for a dataset, or for all datasets"""
+
+        if d_vid is None:
+            self._entries.clear()
+            self._latest.clear()
+            self._bundles.clear()
+            return
+
+        for key, (entry_d_vid, _) in list(self._entries.items()):
+            if entry_d_vid == d_vid:
+                del self._entries[key]
+
+        self._latest.pop(d_vid, None)
+        self._bundles.pop(d_vid, None)
+
+    def invalidate_revisions(self, d_vid):
+        """Drop the entries for every revision of a dataset. Called when a revision is created or copied, since
+        references that aren't vids may now resolve to it"""
+
+        d_id = str(ObjectNumber.parse(d_vid).rev(None))
+
+        d_vids = set(e[0] for e in self._entries.values()) | set(self._latest) | set(self._bundles)
+
+        for entry_d_vid in d_vids:
+            if str(ObjectNumber.parse(entry_d_vid).rev(None)) == d_id:
+                self.invalidate(entry_d_vid)
@@ -120,7 +120,7 @@ class DatasetSQLiteIndex(BaseDatasetIndex):
 
         self._parsed_query = (query, query_params)
 
-        connection = self.backend.library.database.connection
+        connection = self.backend.library.database.read_connection
         # Operate on the raw connection
         connection.connection.create_function('rank', 1, _make_rank_func((1., .1, 0, 0)))
 
@@ -159,7 +159,7 @@ class DatasetSQLiteIndex(BaseDatasetIndex):
 
         query = ('SELECT vid FROM dataset_index ' + limit_str)
 
-        for row in self.backend.library.database.connection.execute(query).fetchall():
+        for row in self.backend.library.database.read_connection.execute(query).fetchall():
             yield row['vid']
 
     def _as_document(self, dataset):
@@ -229,7 +229,7 @@ class DatasetSQLiteIndex(BaseDatasetIndex):
             SELECT vid
             FROM dataset_index;""")
 
-        for result in self.backend.library.database.connection.execute(query):
+        for result in self.backend.library.database.read_connection.execute(query):
             res = DatasetSearchResult()
             res.vid = result[0]
             res.b_score = 1
@@ -279,7 +279,7 @@ class IdentifierSQLiteIndex(BaseIdentifierIndex):
         query_parts.append(';')
         query = text('\n'.join(query_parts))
 
-        results = self.backend.library.database.connection.execute(query, **query_params).fetchall()
+        results = self.backend.library.database.read_connection.execute(query, **query_params).fetchall()
         for result in results:
             vid, type, name, score = result
             yield IdentifierSearchResult(
@@ -304,7 +304,7 @@ class IdentifierSQLiteIndex(BaseIdentifierIndex):
 
         query = ('SELECT identifier FROM identifier_index ' + limit_str)
 
-        for row in self.backend.library.database.connection.execute(query).fetchall():
+        for row in self.backend.library.database.read_connection.execute(query).fetchall():
             yield row['identifier']
 
     def _index_document(self, identifier, force=False):
@@ -353,7 +353,7 @@ class IdentifierSQLiteIndex(BaseIdentifierIndex):
             SELECT identifier, type, name
             FROM identifier_index;""")
 
-        for result in self.backend.library.database.connection.execute(query):
+        for result in self.backend.library.database.read_connection.execute(query):
             vid, type_, name = result
             res = IdentifierSearchResult(
                 score=1, vid=vid, type=type_, name=name)
@@ -405,7 +405,7 @@ class PartitionSQLiteIndex(BasePartitionIndex):
 
         self._parsed_query = (query, query_params)
 
-        connection = self.backend.library.database.connection
+        connection = self.backend.library.database.read_connection
 
         connection.connection.create_function('rank', 1, _make_rank_func((1., .1, 0, 0)))
 
@@ -445,7 +445,7 @@ class PartitionSQLiteIndex(BasePartitionIndex):
 
         query = ('SELECT vid FROM partition_index ' + limit_str)
 
-        for row in self.backend.library.database.connection.execute(query).fetchall():
+        for row in self.backend.library.database.read_connection.execute(query).fetchall():
             yield row['vid']
 
     def _as_document(self, partition):
@@ -565,7 +565,7 @@ class PartitionSQLiteIndex(BasePartitionIndex):
             SELECT dataset_vid, vid
             FROM partition_index;""")
 
-        for result in self.backend.library.database.connection.execute(query):
+        for result in self.backend.library.database.read_connection.execute(query):
             dataset_vid, vid = result
             partitions.append(PartitionSearchResult(dataset_vid=dataset_vid, vid=vid, score=1))
         return partitions
@@ -5,12 +5,15 @@ the Revised BSD License, included in this distribution as LICENSE.txt
 
 """
 from collections import Mapping, OrderedDict, MutableMapping
+from contextlib import contextmanager
 import copy
+from weakref import WeakKeyDictionary
 
 from six import iteritems, iterkeys, itervalues, StringIO, text_type, binary_type, string_types, u
 from six.moves.html_parser import HTMLParser
 
-from sqlalchemy.orm import object_session
+from sqlalchemy import event
+from sqlalchemy.orm import object_session, Session
 
 from ambry.orm.config import Config
 from ambry.orm.exc import MetadataError
@@ -19,6 +22,13 @@ from ambry.util import get_logger
 
 logger = get_logger(__name__)
 
+# Snapshots of the config rows of property trees, as session -> OrderedDict of (dataset vid, tree type) -> rows.
+# Like the ORM objects that a session loads, a snapshot lasts until the session's transaction ends. Writing a
+# config of the dataset drops it sooner.
+_snapshots = WeakKeyDictionary()
+
+MAX_SNAPSHOTS = 64  # Snapshots kept for each session. The least recently used are dropped first.
+
 
 class AttrDict(OrderedDict):
     def __init__(self, *argz, **kwz):
@@ -181,6 +191,9 @@ class StructuredPropertyTree(object):
 
     _synonyms = None
 
+    _root_config = None
+    _lazy_session = None  # Session to load the configs from, while _cached_configs holds config ids
+
     def __init__(self, d=None, path=None, synonyms=None):
         """ Object heirarchy for holding metadata.
 
@@ -202,8 +215,43 @@ class StructuredPropertyTree(object):
         self.register_members()
         self._config = None  # appropriate orm.config.Config instance
         self._valid_configs = []  # Configs exist in both - db and StructuredPropertyTree
+
+        self._loaded = False  # True after build_from_db, when _cached_configs has all of the configs
+        self._d_vid = None  # Vid of the dataset the tree was built from
+        self._deferred = 0  # Depth of deferred_writes() contexts
+        self._deferred_configs = []  # Configs created or changed while the writes are deferred
+
         self.set(d)
 
+    @property
+    def _config(self):
+        """The root config. After build_from_db, it is loaded with the other configs on first use."""
+        if self._root_config is None and self._lazy_session is not None:
+            self._load_configs()
+        return self._root_config
+
+    @_config.setter
+    def _config(self, config):
+        self._root_config = config
+
+    def _load_configs(self):
+        """Replace the config ids that build_from_db cached with Config instances, loaded in one query"""
+        session, self._lazy_session = self._lazy_session, None
+
+        paths = {v: k for k, v in iteritems(self._cached_configs) if not isinstance(v, Config)}
+
+        for config in session.query(Config).filter_by(d_vid=self._d_vid, type=self._type):
+            path = paths.pop(config.id, None)
+            if path is not None:
+                self._cached_configs[path] = config
+
+        for path in itervalues(paths):
+            # Deleted since the tree was built
+            del self._cached_configs[path]
+
+        if self._root_config is None:
+            self._root_config = self._cached_configs.get(())
+
     def _add_valid(self, config):
         """ """
         self._valid_configs.append(config)
@@ -220,21 +268,113 @@ class StructuredPropertyTree(object):
                 else:
                     raise MetadataError('Undeclared group: {} '.format(k))
 
-            # delete instances that were not updated as inactive.
+            # delete instances that were not updated as inactive. The new configs are all valid, so they
+            # don't have to be flushed first.
             session = object_session(self._config)
             valid_ids = [x.id for x in self._valid_configs]
-            missed_configs = session\
-                .query(Config)\
-                .filter(~Config.id.in_(valid_ids),
-                        Config.d_vid == self._config.dataset.vid,
-                        Config.type == self._type)\
-                .all()
+            with session.no_autoflush:
+                missed_configs = session\
+                    .query(Config)\
+                    .filter(~Config.id.in_(valid_ids),
+                            Config.d_vid == self._config.dataset.vid,
+                            Config.type == self._type)\
+                    .all()
 
             for conf in missed_configs:
                 logger.debug('Deleting {} config from database because it was removed from file.'.format(conf))
                 session.delete(conf)
+
+            if missed_configs:
+                self._write(session)
+
+    @contextmanager
+    def deferred_writes(self):
+        """Collect the changes to the config records of the tree and write them together, in one
+        transaction, when the context exits, rather than committing each term as it is set. If the
+        context exits with an exception, the changes are rolled back.
+
+            with metadata.deferred_writes():
+                metadata.set(d)
+        """
+
+        self._deferred += 1
+
+        try:
+            yield self
+        except:
+            self._deferred -= 1
+            if not self._deferred:
+                self._deferred_configs = []
+                if self._config is not None:
+                    object_session(self._config).rollback()
+            raise
+        else:
+            self._deferred -= 1
+            if not self._deferred and self._config is not None:
+                session = object_session(self._config)
+                self._write_deferred(session)
                 session.commit()
 
+    def _write(self, session, config=None):
+        """Commit a new or changed config record, or if the writes are deferred, remember it for later"""
+        if self._deferred:
+            if config is not None and config not in self._deferred_configs:
+                self._deferred_configs.append(config)
+        else:
+            if config is not None:
+                session.merge(config)
+            session.commit()
+
+    def _write_deferred(self, session):
+        """Write the configs that were created or changed while the writes were deferred, with one
+        multi-row INSERT and one multi-row UPDATE. The unit of work would write them one row at a time,
+        because configs refer to their parent configs. The configs are created parents first, so inserting
+        them in order satisfies the foreign keys."""
+        from time import time
+        from sqlalchemy import bindparam
+        from sqlalchemy.orm import make_transient_to_detached
+        from sqlalchemy.orm.attributes import get_history, set_committed_value
+
+        configs, self._deferred_configs = self._deferred_configs, []
+
+        if configs:
+            # The Core statements don't fire the mapper events that drop the snapshot
+            _drop_dataset_snapshots(configs[0].d_vid)
+
+        table = Config.__table__
+        columns = [(p.key, p.columns[0].key) for p in Config.__mapper__.column_attrs]
+        modified = int(time())
+
+        new = [c for c in configs if c in session.new]
+        changed = [c for c in configs if c in session.dirty and get_history(c, 'value').has_changes()]
+
+        if new:
+            rows = []
+            for c in new:
+                if c.parent is not None:
+                    c.parent_id = c.parent.id
+                c.modified = modified
+                rows.append({col: getattr(c, key) for key, col in columns})
+                session.expunge(c)
+
+            session.execute(table.insert(), rows)
+
+            # Attach the configs to the session again, as persistent objects with no changes to write
+            for c in new:
+                make_transient_to_detached(c)
+                session.add(c)
+
+        if changed:
+            session.execute(
+                table.update()
+                .where(table.c.co_id == bindparam('_id'))
+                .values(co_value=bindparam('_value', type_=table.c.co_value.type), co_modified=modified),
+                [dict(_id=c.id, _value=c.value) for c in changed])
+
+            for c in changed:
+                set_committed_value(c, 'value', c.value)
+                set_committed_value(c, 'modified', modified)
+
     def _get_path(self):
         """ Returns tuple with full path. """
         return tuple()
@@ -244,53 +384,57 @@ class StructuredPropertyTree(object):
             'Building property tree from db. dataset: {}, type: {}'.format(dataset.vid, self._type))
         session = object_session(dataset)
 
-        # optimization to use only one db hit.
-        instance_to_path_map = {}  # key is Config instance, value if tuple with path.
+        if session.autoflush:
+            session.flush()
 
-        configs = session.query(Config)\
-            .filter_by(d_vid=dataset.vid, type=self._type)\
-            .all()
+        self._d_vid = dataset.vid
 
-        # optimization: cache all configs to reduce db hits
-        for config in configs:
+        # optimization to use only one db hit, which returns tuples rather than Config instances.
+        rows = _config_rows(session, dataset.vid, self._type)
 
-            path = []
-            current = config
-            while current.parent:
-                # iterating until the root.
-                if current.parent and current.parent.key:
-                    path.insert(0, current.parent.key)
-                current = current.parent
+        # optimization: compute the paths from an index of the parents, rather than walking the parent
+        # relationships of each config. The configs are cached by id, and loaded when they are first written.
+        parents = {co_id: (parent_id, key) for co_id, parent_id, key, value, group in rows}
+        paths = _config_paths(parents)
 
-            if config.key:
-                path.append(config.key)
-            self._cached_configs[tuple(path)] = config
-            instance_to_path_map[config] = tuple(path)
+        for co_id, path in iteritems(paths):
+            self._cached_configs[path] = co_id
 
-        # populate all keys of the tree with appropriate values from db.
-        for config in configs:
-            if not config.parent_id:
+        # populate all keys of the tree with appropriate values from db. The tree is not bound yet,
+        # so setting the values does not write them back.
+        for co_id, parent_id, key, value, group in rows:
+            if not parent_id:
                 # Skip root config
-                self._config = config
                 continue
 
-            if config.group:
+            if group:
                 # Skip all groups
                 continue
 
             # value found, populate.
-            _set_value(instance_to_path_map, self._cached_configs, self, config)
+            _set_value(self, paths[co_id], value)
+
+        if paths:
+            self._lazy_session = session
 
         # tree is bound after build from db.
         self.link_config(session, dataset)
 
+        self._loaded = True
+
     def is_bound(self):
         """ Returns True if poperty tree is bound to the db. Otherwise returns False. """
-        return self._config is not None
+        return self._root_config is not None or self._lazy_session is not None
 
     def link_config(self, session, dataset):
         logger.debug(
             'Binding top level config to the db. dataset: {}, type: {}'.format(dataset.vid, self._type))
+
+        if self._lazy_session is not None and () in self._cached_configs:
+            logger.debug(
+                'Existing top level config bound. config id: {}'.format(self._cached_configs[()]))
+            return
+
         self._config, created = _get_config_instance(
             self, session,parent_id=None, d_vid=dataset.vid,type=self._type, dataset=dataset)
 
@@ -729,23 +873,23 @@ class VarDictGroup(DictGroup):
             self._parent.update_config()
 
         # create or update group config
-        self._config, created = get_or_create(
-            session, Config,
+        self._config, created = _get_config_instance(
+            self, session, path=self._get_path(),
             d_vid=dataset.vid, type=self._top._type,
             parent=self._parent._config, group=self._key,
             key=self._key,dataset=dataset)
         self._top._add_valid(self._config)
 
         # create or update value config
-        config, created = get_or_create(
-            session, Config, parent=self._config, d_vid=dataset.vid,
+        config, created = _get_config_instance(
+            self, session, path=self._get_path() + (key,),
+            parent=self._config, d_vid=dataset.vid,
             type=self._top._type, key=key,dataset=dataset)
 
         if config.value != value:
             # sync db value with term value.
             config.value = value
-            session.merge(config)
-            session.commit()
+            self._top._write(session, config)
             logger.debug(
                 'Config bound to the VarDictGroup key updated. config: {}'.format(config))
         self._top._add_valid(config)
@@ -812,8 +956,7 @@ class Term(object):
         if isinstance(self, (ScalarTerm, ListTerm)):
             if self._config.value != self.get():
                 self._config.value = self.get()
-                session.merge(self._config)
-                session.commit()
+                self._top._write(session, self._config)
         self._top._add_valid(self._config)
 
         # Tese lines fail when the term includes unicode
@@ -1145,63 +1288,137 @@ class ListTerm(Term):
         return iter(self._term_values)
 
 
-def _set_value(instance_to_path_map, path_to_instance_map, prop_tree, config_instance):
-    """ Finds appropriate term in the prop_tree and sets its value from config_instance.
+def _set_value(prop_tree, path, value):
+    """ Finds appropriate term in the prop_tree and sets its value.
 
     Args:
-        configs_map (dict): key is id of the config, value is Config instance (AKA cache of the configs)
         prop_tree (PropertyDictTree): poperty tree to populate.
-        config_instance (Config):
+        path (tuple): path of the term in the tree.
+        value: value of the config.
 
     """
-    path = instance_to_path_map[config_instance]
 
     # find group
     group = prop_tree
     for elem in path[:-1]:
         group = getattr(group, elem)
 
-    assert group._key == config_instance.parent.key
-    setattr(group, config_instance.key, config_instance.value)
+    setattr(group, path[-1], value)
 
-    #
-    # bind config to the term
-    #
-    # FIXME: Make all the terms to store config instance the same way.
-    term = getattr(group, config_instance.key)
-    try:
-        if hasattr(term, '_term'):
-            # ScalarTermS and ScalarTermU case
-            term._term._config = config_instance
-            return
-    except KeyError:
-        # python3 case. TODO: Find the way to make it simple.
-        pass
+
+def _config_paths(parents):
+    """ Returns the paths of the configs in the tree.
+
+    Args:
+        parents (dict): key is id of the config, value is tuple of (parent id, key) of the config.
+
+    Returns:
+        dict: key is id of the config, value is tuple with the path.
+    """
+    paths = {}
+
+    for co_id in parents:
+        # Collect the ancestors that don't have a path yet, so each config is visited once.
+        chain = []
+        while co_id in parents and co_id not in paths:
+            chain.append(co_id)
+            co_id = parents[co_id][0]
+
+        path = paths.get(co_id, tuple())
+        for co_id in reversed(chain):
+            key = parents[co_id][1]
+            if key:
+                path += (key,)
+            paths[co_id] = path
+
+    return paths
+
+
+def _config_rows(session, d_vid, type_):
+    """ Returns (id, parent_id, key, value, group) tuples of the configs of a property tree, from the snapshot
+    taken when they were last fetched in the session's current transaction, if there is one.
+
+    Args:
+        session (Sqlalchemy session):
+        d_vid (str): vid of the dataset.
+        type_ (str): type of the configs.
+
+    Returns:
+        list of tuples:
+    """
+    from sqlalchemy import and_, select
+
+    snapshots = _snapshots.get(session)
+
+    if snapshots is None:
+        snapshots = _snapshots[session] = OrderedDict()
+
+    key = (d_vid, type_)
 
     try:
-        if hasattr(term, '_config'):
-            term._config = config_instance
-            return
+        rows = snapshots.pop(key)
     except KeyError:
-        # python3 case. TODO: Find the way to make it simple.
-        pass
-    else:
-        pass  # the setting should have been handled by setattr(group, key, config.value)
+        table = Config.__table__
+        rows = [tuple(row) for row in session.execute(
+            select([table.c.co_id, table.c.parent_id, table.c.co_key, table.c.co_value, table.c.co_group])
+            .where(and_(table.c.co_d_vid == d_vid, table.c.co_type == type_))).fetchall()]
 
+    snapshots[key] = rows  # Most recently used last
 
-def get_or_create(session, model, **kwargs):
+    while len(snapshots) > MAX_SNAPSHOTS:
+        snapshots.popitem(last=False)
+
+    return list(rows)
+
+
+def _drop_dataset_snapshots(d_vid):
+    """ Drops the snapshots of a dataset in all sessions, or all snapshots if d_vid is None. """
+
+    for snapshots in list(_snapshots.values()):
+        for key in list(snapshots):
+            if d_vid is None or key[0] == d_vid:
+                del snapshots[key]
+
+
+def _drop_snapshot(mapper, conn, target):
+    """ Drops the snapshots of the dataset of a config that is flushed. """
+    _drop_dataset_snapshots(target.__dict__.get('d_vid'))
+
+
+def _drop_snapshots(*args):
+    """ Drops all of the snapshots after a bulk update or delete, which may have changed configs. """
+    _drop_dataset_snapshots(None)
+
+
+def _end_snapshots(session, transaction):
+    """ Drops the snapshots of a session when a transaction ends, by a commit, a rollback or closing the
+    session. Later transactions may see changes that other processes made. """
+    _snapshots.pop(session, None)
+
+
+for _name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Config, _name, _drop_snapshot)
+
+event.listen(Session, 'after_bulk_update', _drop_snapshots)
+event.listen(Session, 'after_bulk_delete', _drop_snapshots)
+event.listen(Session, 'after_transaction_end', _end_snapshots)
+
+
+def get_or_create(session, model, _query=True, _commit=True, **kwargs):
     """ Get or create sqlalchemy instance.
 
     Args:
         session (Sqlalchemy session):
         model (sqlalchemy model):
+        _query (boolean): If False, the caller knows the instance doesn't exist, so create it without a query.
+        _commit (boolean): If False, add the new instance to the session without committing it.
         kwargs (dict): kwargs to lookup or create instance.
 
     Returns:
         Tuple: first element is found or created instance, second is boolean - True if instance created,
             False if instance found.
     """
-    instance = session.query(model).filter_by(**kwargs).first()
+    instance = session.query(model).filter_by(**kwargs).first() if _query else None
     if instance:
         return instance, False
     else:
@@ -1209,27 +1426,46 @@ def get_or_create(session, model, **kwargs):
         if 'dataset' in kwargs:
             instance.update_sequence_id(session, kwargs['dataset'])
         session.add(instance)
-        session.commit()
+        if _commit:
+            session.commit()
         return instance, True
 
 
-def _get_config_instance(group_or_term, session, **kwargs):
+def _get_config_instance(group_or_term, session, path=None, **kwargs):
     """ Finds appropriate config instance and returns it.
 
     Args:
         group_or_term (Group or Term):
         session (Sqlalchemy session):
+        path (tuple): Path of the config in the tree. Defaults to the path of the group or term.
         kwargs (dict): kwargs to pass to get_or_create.
 
     Returns:
         tuple of (Config, bool):
     """
-    path = group_or_term._get_path()
-    cached = group_or_term._top._cached_configs.get(path)
+    top = group_or_term._top
+
+    if path is None:
+        path = group_or_term._get_path()
+
+    cached = top._cached_configs.get(path)
+    if cached is not None and not isinstance(cached, Config):
+        # Cached by id in build_from_db
+        top._load_configs()
+        cached = top._cached_configs.get(path)
+
     if cached:
         config = cached
         created = False
     else:
-        # does not exist or not yet cached
-        config, created = get_or_create(session, Config, **kwargs)
+        # does not exist or not yet cached. When the writes are deferred, and the tree was loaded from the
+        # database, all of the configs are in the cache, so a new one can be created without a query, which would
+        # also flush the pending configs one at a time.
+        deferred = bool(top._deferred)
+        config, created = get_or_create(session, Config, _query=not (deferred and top._loaded),
+                                        _commit=not deferred, **kwargs)
+        if created:
+            top._cached_configs[path] = config
+            if deferred:
+                top._write(session, config)
     return config, created
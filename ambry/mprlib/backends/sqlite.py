@@ -291,6 +291,10 @@ class SQLiteBackend(DatabaseBackend):
                 .format(dsn, self._dsn))
             self._connection = apsw.Connection(dsn)
 
+            if self._library.database.read_concurrency:
+                # Wait for locks held by the library's connections, as they do.
+                self._connection.setbusytimeout(int(self._library.database.sqlite_busy_timeout * 1000))
+
         return self._connection
 
     def _add_partition(self, connection, partition):
@@ -439,5 +439,6 @@ from ambry.orm.plot import Plot
 from ambry.orm.database import Database
 from ambry.orm.account import Account
 from ambry.orm.process import Process
+from ambry.orm.task import QueuedTask
 from ambry.orm.remote import Remote
 
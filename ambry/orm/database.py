@@ -19,12 +19,13 @@ from . import Column, Partition, Table, Dataset, Config, File,\
 from ambry.orm.remote import Remote
 from ambry.orm.account import Account
 from ambry.orm.process import Process
+from ambry.orm.task import QueuedTask
 import logging
 
 ROOT_CONFIG_NAME = 'd000'
 ROOT_CONFIG_NAME_V = 'd000001'
 
-SCHEMA_VERSION = 128
+SCHEMA_VERSION = 129
 
 # Note: If you are going to change POSTGRES_SCHEMA_NAME do not forget to change docs:
 #   1. README.rst (search for 'Install pg_trgm extension')
@@ -34,7 +35,7 @@ POSTGRES_PARTITION_SCHEMA_NAME = 'partitions'  # schema for mpr files
 
 ALL_TABLES = [
     Dataset, Config, Table, Column, Partition, File, Code,
-    ColumnStat, SourceTable, SourceColumn, DataSource, Account, Process, Remote, Plot]
+    ColumnStat, SourceTable, SourceColumn, DataSource, Account, Process, Remote, Plot, QueuedTask]
 
 # Database connection information
 Dbci = namedtuple('Dbc', 'dsn_template sql')
@@ -65,13 +66,32 @@ logger = get_logger(__name__)
 class Database(object):
     """ Stores local database of the datasets. """
 
-    def __init__(self, dsn, echo=False, foreign_keys=True, engine_kwargs=None, application_prefix='ambry'):
+    sequence_block_size = 50  # Number of sequence ids to reserve at a time, in next_sequence_id
+
+    # Sqlite settings for the read concurrency mode
+    sqlite_busy_timeout = 30  # Seconds to wait for a lock
+    sqlite_mmap_size = 256 * 2 ** 20  # Bytes of the database file to memory map for reads
+    sqlite_wal_autocheckpoint = 1000  # Pages in the write-ahead log before it is checkpointed
+
+    # Default Postgres pool settings. For most use, a small pool is good to prevent connection exhaustion, but
+    # these settings may be too low for the main public web application.
+    postgres_pool = dict(pool_size=5, max_overflow=5)
+
+    def __init__(self, dsn, echo=False, foreign_keys=True, engine_kwargs=None, application_prefix='ambry',
+                 read_concurrency=False, read_only=False, pool=None, null_pool=False):
         """ Initializes database.
 
         Args:
             dsn (str): database connect string, 'sqlite://' for example.
             echo (boolean): echo parameter of the create_engine.
             engine_kwargs (dict): parameters to pass to the create_engine method of the Sqlalchemy.
+            read_concurrency (boolean): For Sqlite file databases, use a write-ahead log, so readers don't
+                block the writer or each other, memory map the file, and wait for locks rather than failing.
+            read_only (boolean): In the read concurrency mode, only allow queries on all of the connections.
+            pool (dict): Postgres pool settings, pool_size, max_overflow, pool_timeout and pool_recycle, to
+                override the defaults in postgres_pool.
+            null_pool (boolean): For Postgres, don't keep connections in a pool; open one for each checkout
+                and close it on checkin. For worker processes behind a pooler like pgbouncer.
 
         """
 
@@ -102,8 +122,24 @@ class Database(object):
 
         self.library = None  # Set externally when checking in in
 
+        # Blocks of sequence ids reserved by this process, keyed by parent table, sequence column and parent vid
+        self._sequence_blocks = {}
+
         self._application_prefix = application_prefix
 
+        self.read_concurrency = bool(read_concurrency and self.driver == 'sqlite' and self.path and
+                                     'memory' not in self.dsn)
+        self.read_only = bool(read_only and self.read_concurrency)
+
+        self._read_engine = None
+        self._read_connection = None
+
+        self.pool = dict(self.postgres_pool, **(pool or {}))
+        self.null_pool = null_pool
+
+        # Counts of connection events in this process, for connection_info()
+        self._connection_counts = dict(connects=0, checkouts=0, checkins=0)
+
     def create(self):
         """Create the database from the base SQL."""
 
@@ -174,13 +210,21 @@ class Database(object):
                         'application_name': '{}:{}'.format(self._application_prefix, os.getpid())
                     }
 
-                # For most use, a small pool is good to prevent connection exhaustion, but these settings may
-                # be too low for the main public web application.
+                if self.null_pool:
+                    from sqlalchemy.pool import NullPool
+                    pool_kwargs = dict(poolclass=NullPool)
+                else:
+                    pool_kwargs = {k: v for k, v in self.pool.items() if v is not None}
 
-                self._engine = create_engine(self.dsn, echo=self._echo,
-                                             pool_size=5, max_overflow=5, **self.engine_kwargs)
+                pool_kwargs.update(self.engine_kwargs)
+
+                self._engine = create_engine(self.dsn, echo=self._echo, **pool_kwargs)
 
             else:
+                if self.read_concurrency and 'connect_args' not in self.engine_kwargs:
+                    # Sqlite's busy handler retries a locked database with increasing delays, up to the timeout
+                    self.engine_kwargs['connect_args'] = {'timeout': self.sqlite_busy_timeout}
+
                 self._engine = create_engine(
                     self.dsn, echo=self._echo, **self.engine_kwargs)
 
@@ -191,6 +235,7 @@ class Database(object):
             @event.listens_for(self._engine, 'connect')
             def connect(dbapi_connection, connection_record):
                 connection_record.info['pid'] = os.getpid()
+                self._connection_counts['connects'] += 1
 
             @event.listens_for(self._engine, 'checkout')
             def checkout(dbapi_connection, connection_record, connection_proxy):
@@ -204,6 +249,12 @@ class Database(object):
                         "Connection record belongs to pid %s, attempting to check out in pid %s" %
                         (connection_record.info['pid'], pid))
 
+                self._connection_counts['checkouts'] += 1
+
+            @event.listens_for(self._engine, 'checkin')
+            def checkin(dbapi_connection, connection_record):
+                self._connection_counts['checkins'] += 1
+
             if self.driver == 'sqlite':
                 @event.listens_for(self._engine, 'connect')
                 def pragma_on_connect(dbapi_con, con_record):
@@ -212,7 +263,9 @@ class Database(object):
                     # dbapi_con.execute('PRAGMA foreign_keys = ON;')
                     # Not clear that there is a performance improvement.
 
-                    # dbapi_con.execute('PRAGMA journal_mode = WAL')
+                    if self.read_concurrency:
+                        self._sqlite_read_concurrency_pragmas(dbapi_con, query_only=self.read_only)
+
                     dbapi_con.execute('PRAGMA synchronous = OFF')
                     dbapi_con.execute('PRAGMA temp_store = MEMORY')
                     dbapi_con.execute('PRAGMA cache_size = 500000')
@@ -224,6 +277,101 @@ class Database(object):
 
         return self._engine
 
+    def _sqlite_read_concurrency_pragmas(self, dbapi_con, query_only=False):
+        """Set up a new Sqlite connection for the read concurrency mode"""
+        from sqlite3 import OperationalError
+
+        if not query_only:
+            # The journal mode is stored in the database file, so this only changes it once. Changing it needs
+            # an exclusive lock, so if another process has the database open in the old mode, try again later.
+            try:
+                dbapi_con.execute('PRAGMA journal_mode = WAL')
+            except OperationalError as e:
+                logger.debug('Failed to set WAL journal mode: {}'.format(e))
+
+            dbapi_con.execute('PRAGMA wal_autocheckpoint = {}'.format(int(self.sqlite_wal_autocheckpoint)))
+        else:
+            dbapi_con.execute('PRAGMA query_only = ON')
+
+        dbapi_con.execute('PRAGMA mmap_size = {}'.format(int(self.sqlite_mmap_size)))
+
+    @property
+    def read_engine(self):
+        """Return an engine for read-only connections. In the read concurrency mode, it is a separate
+        engine, with connections that can't write, so queries on them don't hold up the writers. Otherwise,
+        it is the main engine"""
+
+        if not self.read_concurrency:
+            return self.engine
+
+        if not self._read_engine:
+            self.engine  # Validates the version, and sets the journal mode
+
+            self._read_engine = create_engine(self.dsn, echo=self._echo,
+                                              connect_args={'timeout': self.sqlite_busy_timeout})
+
+            @event.listens_for(self._read_engine, 'connect')
+            def pragma_on_connect(dbapi_con, con_record):
+                self._sqlite_read_concurrency_pragmas(dbapi_con, query_only=True)
+                dbapi_con.execute('PRAGMA temp_store = MEMORY')
+
+        return self._read_engine
+
+    @property
+    def read_connection(self):
+        """Return an SqlAlchemy connection for queries, from the read engine"""
+
+        if not self.read_concurrency:
+            return self.connection
+
+        if not self._read_connection:
+            self._read_connection = self.read_engine.connect()
+
+        return self._read_connection
+
+    def checkpoint(self, mode='PASSIVE'):
+        """Copy the Sqlite write-ahead log into the database file. The PASSIVE mode copies what it can without
+        waiting for readers; the TRUNCATE mode waits for readers and empties the log.
+
+        :return: A tuple of (busy, pages in the log, pages checkpointed), or None if the database has no log.
+        """
+
+        if not self.read_concurrency or self.read_only:
+            return None
+
+        assert mode.upper() in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE')
+
+        with self.engine.connect() as conn:
+            return tuple(conn.execute('PRAGMA wal_checkpoint({})'.format(mode.upper())).fetchone())
+
+    def connection_info(self):
+        """Return a dict describing the connections to the database: the pool, counts of the connections this
+        process has opened, checked out and checked in, and, for Postgres, the connections the server has, by
+        application name, which for Ambry processes includes the process id."""
+
+        pool = self.engine.pool
+
+        d = dict(
+            pool=type(pool).__name__,
+            pool_status=pool.status(),
+            connects=self._connection_counts['connects'],
+            checkouts=self._connection_counts['checkouts'],
+            checkins=self._connection_counts['checkins'],
+            checked_out=self._connection_counts['checkouts'] - self._connection_counts['checkins']
+        )
+
+        if self.driver == 'postgres':
+            with self.engine.connect() as conn:
+                d['max_connections'] = int(conn.execute('SHOW max_connections').scalar())
+
+                d['server'] = [
+                    dict(application=row[0] or '', state=row[1] or '', count=row[2]) for row in conn.execute(
+                        "SELECT application_name, state, count(*) FROM pg_stat_activity "
+                        "WHERE datname = current_database() GROUP BY application_name, state ORDER BY 1, 2")
+                ]
+
+        return d
+
     @property
     def connection(self):
         """Return an SqlAlchemy connection."""
@@ -277,9 +425,18 @@ class Database(object):
         self.close_connection()
 
         if self._engine:
+            self.release_sequence_ids()
+
             self._engine.dispose()  # CLose all of the connections in the pool
             # self._engine = None
 
+        if self._read_connection:
+            self._read_connection.close()
+            self._read_connection = None
+
+        if self._read_engine:
+            self._read_engine.dispose()
+
     def close_session(self):
 
         if self._session:
@@ -566,6 +723,8 @@ class Database(object):
 
         ssq = self.session.query
 
+        self.clear_sequence_ids(ds.vid)
+
         ssq(Process).filter(Process.d_vid == ds.vid).delete()
         ssq(Code).filter(Code.d_vid == ds.vid).delete()
         ssq(ColumnStat).filter(ColumnStat.d_vid == ds.vid).delete()
@@ -583,6 +742,8 @@ class Database(object):
 
         ssq = self.session.query
 
+        self.clear_sequence_ids(ds.vid)
+
         ssq(Process).filter(Process.d_vid == ds.vid).delete()
         ssq(Code).filter(Code.d_vid == ds.vid).delete()
         ssq(ColumnStat).filter(ColumnStat.d_vid == ds.vid).delete()
@@ -618,6 +779,7 @@ class Database(object):
     def _copy_dataset_copy(self, ds, tables, incver, cb=None, **kwargs):
         from sqlalchemy.orm import noload
 
+        source_db = ds._database
         source_session = ds.session
         dest_session = self.session
 
@@ -632,16 +794,119 @@ class Database(object):
         dest_session.merge(dso)
         dest_session.commit()
 
-        for table_class in tables:
-            self._copy_dataset_merge(ds, source_session, dest_session, table_class, incver, cb=cb)
+        # The fast copies move the rows as they are, so they can't change the version numbers
+        if incver:
+            fast_copy = None
+        elif self.driver == 'sqlite' and source_db.driver == 'sqlite' and os.path.exists(source_db.path):
+            fast_copy = self._copy_dataset_attach
+        elif self.driver == 'postgres':
+            fast_copy = self._copy_dataset_pg_copy
+        else:
+            fast_copy = None
+
+        try:
+            if fast_copy:
+                try:
+                    fast_copy(source_db, ds.vid, tables + [Config], cb=cb)
+                    return self.dataset(dso.vid)
+                except Exception as e:
+                    self.logger.warn('Fast copy of {} failed, copying through the ORM: {}'.format(ds.vid, e))
+
+            for table_class in tables:
+                self._copy_dataset_merge(ds, source_session, dest_session, table_class, incver, cb=cb)
+
+            self._copy_dataset_configs(ds, source_session, dest_session, incver, cb=cb)
+
+            return self.dataset(dso.vid)
+
+        finally:
+            # The query above left the source dataset's collections empty, so a later delete of the
+            # dataset wouldn't cascade to its children
+            source_session.expire(ds)
+
+    def _copy_dataset_report(self, table_class, vid, n, t0, method, cb=None):
+        """Report the time to copy the records of one table to the progress callback, or the log"""
+        import time
+
+        msg = 'Copied {} {} records in {:0.2f}s ({})'.format(n, table_class.__tablename__, time.time() - t0, method)
+
+        if cb:
+            cb(msg, n)
+        else:
+            self.logger.info('{} for {}'.format(msg, vid))
+
+    def _copy_dataset_attach(self, source_db, vid, tables, cb=None):
+        """Copy the dataset's records from another Sqlite database by attaching it and inserting from selects,
+        so the rows never leave Sqlite. All of the tables are copied in one transaction. """
+        import time
+        from sqlalchemy import text
 
-        self._copy_dataset_configs(ds, source_session, dest_session, incver)
+        conn = self.engine.connect()
 
-        return self.dataset(dso.vid)
+        try:
+            conn.execute('ATTACH DATABASE ? AS copy_source', (source_db.path,))
+
+            try:
+                with conn.begin():
+                    for table_class in tables:
+                        t0 = time.time()
+
+                        cols = ', '.join(c.name for c in table_class.__table__.columns)
+                        d_vid_col = table_class.d_vid.property.columns[0].name
+
+                        r = conn.execute(text(
+                            'INSERT INTO main.{table} ({cols}) SELECT {cols} FROM copy_source.{table} '
+                            'WHERE {d_vid_col} = :vid'
+                            .format(table=table_class.__tablename__, cols=cols, d_vid_col=d_vid_col)),
+                            vid=vid)
+
+                        self._copy_dataset_report(table_class, vid, r.rowcount, t0, 'attach', cb)
+            finally:
+                conn.execute('DETACH DATABASE copy_source')
+        finally:
+            conn.close()
+
+    def _copy_dataset_pg_copy(self, source_db, vid, tables, cb=None):
+        """Copy the dataset's records into Postgres by streaming them through COPY ... FROM STDIN. All of the
+        tables are copied in one transaction. """
+        import time
+        from sqlalchemy.sql import select
+
+        raw = self.engine.raw_connection()
+
+        try:
+            cur = raw.cursor()
+
+            for table_class in tables:
+                t0 = time.time()
+
+                table = table_class.__table__
+                d_vid_col = table_class.d_vid.property.columns[0].name
+
+                rows = source_db.connection.execute(select([table]).where(table.c[d_vid_col] == vid))
+
+                counter = [0]
+                lines = _copy_lines(table, rows, self.engine.dialect, counter)
+
+                cur.copy_expert('COPY {}.{} ({}) FROM STDIN'
+                                .format(self._schema, table.name, ', '.join(c.name for c in table.columns)),
+                                _CopyReader(lines))
+
+                self._copy_dataset_report(table_class, vid, counter[0], t0, 'copy', cb)
+
+            raw.commit()
+        except:
+            raw.rollback()
+            raise
+        finally:
+            raw.close()
 
     def _copy_dataset_merge(self, ds, source_session, dest_session, table_class, incver, cb=None):
+        import time
         from sqlalchemy.orm import noload, undefer
 
+        t0 = time.time()
+
         i = [0] # ? Why are we doing this?
 
         options = [noload('*')]
@@ -676,16 +941,19 @@ class Database(object):
 
         dest_session.commit()
 
-        self.logger.info("Copied {} records of table {} for {}".format(i[0], table_class, ds.vid))
+        self._copy_dataset_report(table_class, ds.vid, i[0], t0, 'orm', cb)
 
-    def _copy_dataset_configs(self, ds, source_session, dest_session, incver):
+    def _copy_dataset_configs(self, ds, source_session, dest_session, incver, cb=None):
         # FIXME: Oh, this is horrible. Sqlalchemy inserts all of the configs as a group, but they are self-referential,
         # so some with a reference to a parent get inserted before their parent. The topo sort solves this,
         # but there must be a better way to do it.
 
+        import time
         from ..util import toposort
         from sqlalchemy.orm import noload
 
+        t0 = time.time()
+
         configs = source_session.query(Config).filter(Config.d_vid == ds.vid).options(noload('*')).all()
 
         dag = {c.id: {c.parent_id} for c in configs}
@@ -713,17 +981,42 @@ class Database(object):
 
         dest_session.commit()
 
+        self._copy_dataset_report(Config, ds.vid, len(objects), t0, 'orm', cb)
+
     def next_sequence_id(self, parent_table_class, parent_vid, child_table_class):
         """Get the next sequence id for child objects for a parent object that has a child sequence
-        field"""
+        field.
 
-        from sqlalchemy import text
+        Ids are reserved from the parent's sequence field in blocks of ``sequence_block_size``, with one
+        statement per block, and then handed out by this process without touching the database. Ids
+        that are still unused when the database is closed are returned, if no other process has reserved
+        a block after them.
+        """
 
         # Name of sequence id column in the child
         c_seq_col = child_table_class.sequence_id.property.columns[0].name
 
         p_seq_col = getattr(parent_table_class, c_seq_col).property.columns[0].name
 
+        key = (parent_table_class, p_seq_col, parent_vid)
+
+        block = self._sequence_blocks.get(key)
+
+        # The block is [next id, limit, pid]. Blocks aren't shared with forked processes
+        if not block or block[0] >= block[1] or block[2] != os.getpid():
+            first, limit = self._reserve_sequence_ids(parent_table_class, p_seq_col, parent_vid,
+                                                      self.sequence_block_size)
+            block = self._sequence_blocks[key] = [first, limit, os.getpid()]
+
+        v = block[0]
+        block[0] += 1
+        return v
+
+    def _reserve_sequence_ids(self, parent_table_class, p_seq_col, parent_vid, n):
+        """Advance the parent's sequence field by n, and return the range of reserved ids, as
+        (first, limit) """
+        from sqlalchemy import text
+
         p_vid_col = parent_table_class.vid.property.columns[0].name
 
         if self.driver == 'sqlite':
@@ -736,25 +1029,65 @@ class Database(object):
                                p_vid_col=p_vid_col, parent_vid=parent_vid))
 
             v = next(iter(self.session.execute(sql)))[0]
-            sql = text("UPDATE {p_table} SET {p_seq_col} = {p_seq_col} + 1 WHERE {p_vid_col} = '{parent_vid}' "
+            sql = text("UPDATE {p_table} SET {p_seq_col} = {p_seq_col} + {n} WHERE {p_vid_col} = '{parent_vid}' "
                        .format(p_table=parent_table_class.__tablename__, p_seq_col=p_seq_col,
-                               p_vid_col=p_vid_col, parent_vid=parent_vid))
+                               p_vid_col=p_vid_col, parent_vid=parent_vid, n=n))
 
             self.session.execute(sql)
             self.commit()
-            return v
+            return v, v + n
 
         else:
             # Must be postgres, or something else that supports "RETURNING"
             sql = text("""
-            UPDATE {p_table} SET {p_seq_col} = {p_seq_col} + 1 WHERE {p_vid_col} = '{parent_vid}' RETURNING {p_seq_col}
+            UPDATE {p_table} SET {p_seq_col} = {p_seq_col} + {n} WHERE {p_vid_col} = '{parent_vid}'
+            RETURNING {p_seq_col}
             """.format(p_table=parent_table_class.__tablename__, p_seq_col=p_seq_col, p_vid_col=p_vid_col,
-                       parent_vid=parent_vid))
+                       parent_vid=parent_vid, n=n))
 
             self.connection.execute('SET search_path TO {}'.format(self._schema))
             r = self.connection.execute(sql)
             v = next(iter(r))[0]
-            return v-1
+            return v - n, v
+
+    def release_sequence_ids(self):
+        """Return the unused ids in the reserved blocks to their parents, for the parents that have not had
+        another block reserved since. """
+        from sqlalchemy import text
+        from sqlalchemy.exc import SQLAlchemyError
+
+        blocks = [(k, b) for k, b in self._sequence_blocks.items() if b[2] == os.getpid() and b[0] < b[1]]
+
+        self._sequence_blocks = {}
+
+        if not blocks:
+            return
+
+        try:
+            with self.engine.begin() as conn:
+                if self._schema:
+                    conn.execute('SET search_path TO {}'.format(self._schema))
+
+                for (parent_table_class, p_seq_col, parent_vid), (next_id, limit, _) in blocks:
+                    p_vid_col = parent_table_class.vid.property.columns[0].name
+
+                    conn.execute(text(
+                        "UPDATE {p_table} SET {p_seq_col} = :next_id "
+                        "WHERE {p_vid_col} = :parent_vid AND {p_seq_col} = :limit"
+                        .format(p_table=parent_table_class.__tablename__, p_seq_col=p_seq_col,
+                                p_vid_col=p_vid_col)),
+                        next_id=next_id, parent_vid=parent_vid, limit=limit)
+
+        except SQLAlchemyError as e:
+            # The ids are just skipped
+            logger.debug('Failed to release sequence ids: {}'.format(e))
+
+    def clear_sequence_ids(self, parent_vid):
+        """Drop the reserved blocks for a parent, after its sequence fields are reset"""
+
+        for key in list(self._sequence_blocks.keys()):
+            if key[2] == parent_vid:
+                del self._sequence_blocks[key]
 
     def update_sequence_id(self, parent_table_class, parent_vid, child_table_class):
         from sqlalchemy import text
@@ -779,6 +1112,87 @@ class Database(object):
         return max_id
 
 
+def _copy_lines(table, rows, dialect, counter):
+    """Generate the lines of a Postgres COPY, in text format, for rows selected from a table. The values are
+    converted with the bind processors for the destination dialect, as they would be for an insert. """
+    from sqlalchemy.types import LargeBinary, Boolean
+    from sqlalchemy.dialects.postgresql.base import PGDialect
+    import binascii
+
+    converters = []
+
+    for c in table.columns:
+        base_type = getattr(c.type, 'impl', c.type)  # The underlying type of TypeDecorators, like PickleType
+
+        if isinstance(base_type, LargeBinary):
+            # Without a DBAPI, the processor doesn't wrap the bytes in the DBAPI's Binary
+            proc = c.type.bind_processor(PGDialect())
+            fmt = lambda v: '\\\\x' + binascii.hexlify(bytes(v)).decode('ascii')
+        elif isinstance(base_type, Boolean):
+            proc = c.type.bind_processor(dialect)
+            fmt = lambda v: 't' if v else 'f'
+        else:
+            proc = c.type.bind_processor(dialect)
+            fmt = _copy_escape
+
+        converters.append((proc, fmt))
+
+    for row in rows:
+        values = []
+
+        for v, (proc, fmt) in zip(row, converters):
+            if proc is not None and v is not None:
+                v = proc(v)
+
+            values.append('\\N' if v is None else fmt(v))
+
+        counter[0] += 1
+
+        yield ('\t'.join(values) + '\n').encode('utf-8')
+
+
+def _copy_escape(v):
+    """Escape a value for the text format of Postgres COPY"""
+    from six import text_type, binary_type
+
+    if isinstance(v, binary_type):
+        v = v.decode('utf-8')
+    elif not isinstance(v, text_type):
+        v = text_type(v)
+
+    return (v.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+class _CopyReader(object):
+    """File-like object for cursor.copy_expert() that reads from a generator of lines"""
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._buffer = b''
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+
+        while size < 0 or length < size:
+            try:
+                line = next(self._lines)
+            except StopIteration:
+                break
+
+            chunks.append(line)
+            length += len(line)
+
+        data = b''.join(chunks)
+
+        if size < 0:
+            size = len(data)
+
+        self._buffer = data[size:]
+        return data[:size]
+
+
 class BaseMigration(object):
     """ Base class for all migrations. """
 
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-'
+
+from ambry.orm.database import BaseMigration
+
+
+class Migration(BaseMigration):
+
+    def _migrate_sqlite(self, connection):
+        from ambry.orm import QueuedTask
+        self.create_table(QueuedTask, connection)
+
+    def _migrate_postgresql(self, connection):
+        from ambry.orm import QueuedTask
+        from ambry.orm.database import POSTGRES_SCHEMA_NAME
+        self.create_table(QueuedTask, connection, POSTGRES_SCHEMA_NAME)
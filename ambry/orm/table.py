@@ -149,7 +149,10 @@ class Table(Base, DictableMixin):
 
         except NotFoundError:
 
-            sequence_id = len(self.columns) + 1
+            # Column ids are allocated from the table's own counter, which is written with the table, so
+            # adding a column doesn't need a query. Tables from before the counter was kept have it at 1
+            sequence_id = max(self.c_sequence_id or 1, len(self.columns) + 1)
+            self.c_sequence_id = sequence_id + 1
 
             assert sequence_id
 
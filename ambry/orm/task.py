@@ -0,0 +1,65 @@
+"""Object-Relational Mapping classess, based on Sqlalchemy, for the tasks in the library build queue
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of the
+Revised BSD License, included in this distribution as LICENSE.txt
+"""
+__docformat__ = 'restructuredtext en'
+
+from sqlalchemy import event
+from sqlalchemy import Column as SAColumn, Integer, Float, PickleType
+from sqlalchemy import Text, String, ForeignKey
+
+from . import Base
+
+
+class QueuedTask(Base):
+    """A bundle operation, such as building one source, that is waiting for, or has been run by, a worker
+    on any host that shares the library database. See ambry.bundle.workqueue"""
+    __tablename__ = 'tasks'
+
+    id = SAColumn('tk_id', Integer, primary_key=True)
+
+    batch = SAColumn('tk_batch', String(32), index=True, doc='Identifies the tasks enqueued by one pool')
+
+    d_vid = SAColumn('tk_d_vid', String(13), ForeignKey('datasets.d_vid'), nullable=False, index=True)
+
+    s_vid = SAColumn('tk_s_vid', String(17), nullable=True, doc='Source the task processes, if any')
+
+    phase = SAColumn('tk_phase', Text, doc='Name of the task function, such as build_mp or ingest_mp')
+    stage = SAColumn('tk_stage', Integer)
+
+    function = SAColumn('tk_function', Text, doc='Module and name of the function to run')
+    args = SAColumn('tk_args', PickleType, doc='Arguments for the function, after the bundle vid')
+
+    state = SAColumn('tk_state', String(10), index=True, doc='queued, leased, done, failed or cancelled')
+
+    worker = SAColumn('tk_worker', Text, doc='Hostname and pid of the worker that leased the task')
+    attempts = SAColumn('tk_attempts', Integer, default=0, doc='Number of times the task has been leased')
+    heartbeat = SAColumn('tk_heartbeat', Float, doc='Last time the worker reported it was running the task')
+    expires = SAColumn('tk_expires', Float, doc='Time after which another worker can lease the task')
+
+    result = SAColumn('tk_result', PickleType)
+    exception_class = SAColumn('tk_ex_class', Text)
+    exception_trace = SAColumn('tk_ex_trace', Text)
+
+    created = SAColumn('tk_created', Float, doc='Creation date: time in seconds since the epoch.')
+    modified = SAColumn('tk_modified', Float, doc='Modification date: time in seconds since the epoch.')
+
+    def __repr__(self):
+        return '<QueuedTask {} {} {} {} {}>'.format(self.id, self.d_vid, self.phase, self.s_vid, self.state)
+
+    @staticmethod
+    def before_insert(mapper, conn, target):
+        from time import time
+        target.created = time()
+
+        QueuedTask.before_update(mapper, conn, target)
+
+    @staticmethod
+    def before_update(mapper, conn, target):
+        from time import time
+        target.modified = time()
+
+
+event.listen(QueuedTask, 'before_insert', QueuedTask.before_insert)
+event.listen(QueuedTask, 'before_update', QueuedTask.before_update)
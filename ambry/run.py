@@ -79,6 +79,7 @@ filesystem_defaults = {
     'downloads': '{root}/downloads',
     'cache': '{root}/cache',
     'extracts': '{root}/extracts',
+    'fingerprints': '{root}/fingerprints',
     'logs': '{root}/logs',
     'python': '{root}/python',
     'search': '{root}/search',
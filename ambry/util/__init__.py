@@ -933,6 +933,28 @@ def count_open_fds():
     return nprocs
 
 
+def process_rss(pid=None):
+    """Return the resident set size of a process, in bytes, or None if it can't be determined.
+
+    .. warning: will only work on Linux, or where psutil is installed.
+
+    """
+
+    pid = pid or os.getpid()
+
+    try:
+        with open('/proc/{}/statm'.format(pid)) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except Exception:
+        return None
+
+
 def parse_url_to_dict(url):
     """Parse a url and return a dict with keys for all of the parts.
 
@@ -0,0 +1,109 @@
+"""Column-at-a-time casting with NumPy
+
+The vectorized casters that ambry.etl.codegen generates for batch mode call vector_cast() once per column per batch,
+rather than calling a caster function for each value. Only the cells that NumPy can't convert are passed back to the
+per-value caster, so casting errors are reported exactly as they are for the row casters.
+
+NumPy is not a requirement of ambry, so this module should only be imported when it is installed.
+
+Copyright (c) 2015 Civic Knowledge. This file is licensed under the terms of
+the Revised BSD License, included in this distribution as LICENSE.txt
+
+"""
+
+import numpy as np
+
+# Python types that NumPy can convert a column into, with the function that converts one value the same way
+vector_types = {
+    'int': (np.int64, int),
+    'float': (np.float64, float),
+    'date': ('datetime64[D]', None)
+}
+
+# Transforms from ambry.valuetype.types that vector_cast() can handle, for each kind of column. The transforms
+# run after the datatype cast, so most of them don't change a value that was cast successfully.
+vector_transforms = {
+    'int': ('nullify', 'int_n', 'float_n', 'clean_int'),
+    'float': ('nullify', 'int_n', 'float_n'),
+    'date': ('nullify',)
+}
+
+ISO_DATE_LENGTH = len('2015-01-01')
+
+
+def _convert(a, notnull, kind):
+    """Convert the not-null cells of an object array. Returns the converted array and a boolean mask of the
+    cells that were converted. """
+
+    dtype, convert = vector_types[kind]
+
+    idx = np.flatnonzero(notnull)
+    values = a[idx]
+
+    out = np.zeros(len(a), dtype=dtype)
+    ok = np.zeros(len(a), dtype=bool)
+
+    if kind == 'date':
+        # NumPy will also parse partial dates, like '2015', which dateutil parses differently, so only
+        # handle columns that are entirely ISO dates.
+        if not np.all(np.frompyfunc(len, 1, 1)(values) == ISO_DATE_LENGTH):
+            return out, ok
+
+    try:
+        out[idx] = values.astype(dtype)
+        ok[idx] = True
+    except (ValueError, TypeError, OverflowError):
+        if convert is None:
+            return out, ok
+
+        # Find the cells that don't convert; those are left for the per-value caster.
+        for i, v in zip(idx, values):
+            try:
+                out[i] = convert(v)
+                ok[i] = True
+            except (ValueError, TypeError, OverflowError):
+                pass
+
+    return out, ok
+
+
+def vector_cast(kind, values, transforms, fallback):
+    """Cast a column of values, returning a list of the cast values.
+
+    :param kind: 'int', 'float' or 'date'. The column's datatype must be the same.
+    :param values: Sequence of source values for the column
+    :param transforms: Names of the column's transforms, which must all be in vector_transforms[kind]
+    :param fallback: Function that takes the index of a cell and returns the value from the column's per-value
+        caster. It is called for each cell that can't be converted, so these cells get the same values
+        and casting errors that they would in row mode.
+    :return: A list of values, the same length as values.
+    """
+
+    n = len(values)
+
+    res = np.empty(n, dtype=object)  # Initialized to None, which is the value for null cells
+
+    try:
+        a = np.empty(n, dtype=object)
+        a[:] = values
+
+        null = np.equal(a, None) | np.equal(a, '')
+
+        out, ok = _convert(a, ~null, kind)
+
+        if 'int_n' in transforms and kind == 'float':
+            # int(float(v)) fails for NaN and inf
+            ok &= np.isfinite(out)
+            out = np.trunc(out)
+
+        res[ok] = out[ok].tolist()
+
+    except (ValueError, TypeError, OverflowError):
+        # Some cells must be odd enough that NumPy won't treat them as scalars
+        null = np.zeros(n, dtype=bool)
+        ok = np.zeros(n, dtype=bool)
+
+    for i in np.flatnonzero(~(ok | null)).tolist():
+        res[i] = fallback(i)
+
+    return res.tolist()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+from multiprocessing import Process
+
+from test.proto import TestBase
+
+
+def queue_task(b, n):
+    """Task function for the workers, which must be importable by its module and name"""
+    return b.identity.vid, n, os.getpid()
+
+
+def failing_task(b, n):
+    raise ValueError('Task {} failed'.format(n))
+
+
+def slow_task(b, path):
+    time.sleep(30)
+
+    with open(path, 'w') as f:
+        f.write('finished')
+
+
+class Test(TestBase):
+
+    def test_lease(self):
+        from ambry.bundle.workqueue import BuildQueue
+
+        b = self.import_single_bundle('build.example.com/casters')
+        try:
+            q = BuildQueue(b.library.database)
+
+            ids = [q.enqueue('batch', queue_task, b.identity.vid, (n,)) for n in range(2)]
+
+            t1 = q.lease('w1', lease_seconds=60)
+            t2 = q.lease('w2', lease_seconds=-1)  # Expires immediately
+            self.assertEqual(ids, [t1.id, t2.id])
+            self.assertEqual((0,), t1.args)
+
+            # w2 missed its heartbeat, so w3 can take over the task, and w2 can't finish it
+            t3 = q.lease('w3')
+            self.assertEqual(t2.id, t3.id)
+            self.assertIsNone(q.lease('w4'))
+            self.assertEqual(2, t3.attempts)
+            self.assertFalse(q.finish(t2.id, 'w2', result=1))
+            self.assertFalse(q.heartbeat(t2.id, 'w2'))
+
+            self.assertTrue(q.heartbeat(t1.id, 'w1'))
+            self.assertTrue(q.finish(t1.id, 'w1', result=[1, 2]))
+            self.assertTrue(q.finish(t3.id, 'w3', exception=ValueError('bad')))
+
+            t1, t3 = q.tasks(batch='batch')
+            self.assertEqual(('done', [1, 2]), (t1.state, t1.result))
+            self.assertEqual(('failed', 'exceptions.ValueError'), (t3.state, t3.exception_class))
+
+        finally:
+            b.close()
+
+    def test_workers(self):
+        from ambry.bundle.workqueue import QueuePool, worker_process
+
+        b = self.import_single_bundle('build.example.com/casters')
+        b.sync_in()
+        b = b.cast_to_subclass()  # Creates the lib.py file record, so the workers don't race to create it
+        b.commit()
+
+        l = b.library
+        vid = b.identity.vid
+
+        workers = [Process(target=worker_process, args=(l.database.dsn, l._account_password),
+                           kwargs=dict(poll_interval=.1, idle_timeout=3)) for _ in range(2)]
+        try:
+            pool = QueuePool(l, 2)
+
+            r = pool.map_async(queue_task, [(vid, n) for n in range(10)])
+            f = pool.map_async(failing_task, [(vid, 10)])
+
+            for w in workers:
+                w.start()
+
+            results = r.get(timeout=60)
+
+            self.assertEqual([(vid, n) for n in range(10)], [res[:2] for res in results])
+
+            # Both of the workers ran tasks
+            self.assertEqual(set(w.pid for w in workers), set(res[2] for res in results))
+
+            with self.assertRaises(ValueError):
+                f.get(timeout=60)
+
+            for w in workers:
+                w.join(10)
+                self.assertFalse(w.is_alive())
+
+        finally:
+            for w in workers:
+                if w.is_alive():
+                    w.terminate()
+            b.close()
+
+    def test_lost_lease(self):
+        """A worker stops running a task when another worker takes over the task's lease"""
+        import tempfile
+        from sqlalchemy import and_
+        from ambry.bundle.workqueue import QueuePool, worker_process
+
+        b = self.import_single_bundle('build.example.com/casters')
+        b.sync_in()
+        b = b.cast_to_subclass()
+        b.commit()
+
+        l = b.library
+        path = os.path.join(tempfile.mkdtemp(), 'finished')
+
+        worker = Process(target=worker_process, args=(l.database.dsn, l._account_password),
+                         kwargs=dict(poll_interval=.1, idle_timeout=60, lease_seconds=3))
+        try:
+            pool = QueuePool(l, 1)
+            q = pool.queue
+
+            pool.map_async(slow_task, [(b.identity.vid, path)])
+
+            worker.start()
+
+            for _ in range(100):
+                task, = q.tasks(batch=pool.batch)
+                if task.state == 'leased':
+                    break
+                time.sleep(.1)
+
+            self.assertEqual('leased', task.state)
+
+            # Expire the lease, as if the worker had missed its heartbeats, and let another worker take the task
+            c = q._table.c
+            with q._connect() as conn:
+                conn.execute(q._table.update().where(and_(c.tk_id == task.id, c.tk_state == 'leased'))
+                             .values(tk_expires=time.time() - 1))
+
+            self.assertEqual(task.id, q.lease('w2').id)
+
+            worker.join(10)
+            self.assertFalse(worker.is_alive())
+            self.assertEqual(1, worker.exitcode)
+
+            task, = q.tasks(batch=pool.batch)
+            self.assertEqual(('leased', 'w2'), (task.state, task.worker))
+            self.assertFalse(os.path.exists(path))
+
+        finally:
+            if worker.is_alive():
+                worker.terminate()
+            b.close()
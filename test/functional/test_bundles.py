@@ -57,3 +57,388 @@ class Test(TestBase):
         finally:
             b.clean_all()
             b.close()
+
+    def test_schedule_sources(self):
+        from ambry.bundle.scheduler import DAGScheduler
+
+        b = self.import_single_bundle('build.example.com/sql')
+        try:
+            b.sync_in()
+
+            sources = {s.name: s for s in b.sources}
+
+            self.assertEqual(set(), b.source_inputs(sources['integers']))
+            self.assertEqual({'integers'}, b.source_inputs(sources['use_select']))
+            self.assertEqual({'integers'}, b.source_inputs(sources['use_view']))
+
+            sched = DAGScheduler()
+            b._schedule_sources(sched, list(b.sources), lambda s, shard: (list, ()),
+                                unify_task=lambda t, append=False: (list, ()))
+
+            unify = sched.tasks[('unify', 'integers', 2)]
+
+            # The SQL sources wait for the integers partitions to be unified, rather than for the stage
+            self.assertEqual({sources[n].vid for n in ('integers', 'integers2', 'integers3')}, unify.deps)
+            self.assertEqual({unify.key}, sched.tasks[sources['use_select'].vid].deps)
+            self.assertEqual(set(), sched.tasks[sources['integers2'].vid].deps)
+
+            # The integers table is unified again after all of its sources, including those in later stages
+            self.assertEqual({sources[n].vid for n in ('integers', 'integers2', 'integers3')} | {unify.key},
+                             sched.tasks[('unify', 'integers')].deps)
+
+            sched.run()
+
+            self.assertEqual(7, sched.counts['done'])
+
+            # When a bundle edits its pipelines, any source may write to any table
+            self.assertEqual({'integers'}, b.source_outputs(sources['integers']))
+            b._pipeline_editor = lambda pl: pl
+            self.assertIsNone(b.source_outputs(sources['integers']))
+
+            sched = DAGScheduler()
+            b._schedule_sources(sched, list(b.sources), lambda s, shard: (list, ()),
+                                unify_task=lambda t, append=False: (list, ()))
+
+            self.assertEqual({s.vid for s in sources.values()} | {('unify', 'integers', 2)},
+                             sched.tasks[('unify', 'integers')].deps)
+
+        finally:
+            b.clean_all()
+            b.close()
+
+    def test_schedule_multistage_unify(self):
+        """A table that is written in stages 1 and 3 and read in stage 2 keeps the rows of all of its sources"""
+        from collections import defaultdict
+        from ambry.bundle.scheduler import DAGScheduler
+
+        b = self.import_single_bundle('build.example.com/sql')
+        try:
+            b.sync_in()
+
+            sources = {s.name: s for s in b.sources}
+            sources['integers3'].stage = 3
+            b.commit()
+
+            # Simulate the partitions: each source writes a segment, and unifying a table moves its segments
+            # into the parent, replacing or appending to the parent's rows
+            segments = defaultdict(list)
+            parents = {}
+            read = {}
+
+            def build(source):
+                if source.name == 'use_select':
+                    read['integers'] = list(parents.get('integers', []))
+                segments[source.dest_table_name].append(source.name)
+
+            def unify(table, append):
+                parents[table] = (parents.get(table, []) if append else []) + segments.pop(table, [])
+
+            sched = DAGScheduler()
+            b._schedule_sources(sched, list(b.sources), lambda s, shard: (build, (s,)),
+                                unify_task=lambda t, append=False: (unify, (t, append)))
+
+            self.assertFalse(sched.tasks[('unify', 'integers', 2)].args[1])
+            self.assertTrue(sched.tasks[('unify', 'integers')].args[1])
+
+            sched.run()
+
+            self.assertEqual(['integers', 'integers2'], sorted(read['integers']))
+            self.assertEqual(['integers', 'integers2', 'integers3'], sorted(parents['integers']))
+
+        finally:
+            b.clean_all()
+            b.close()
+
+    def test_source_costs(self):
+        import time
+
+        b = self.import_single_bundle('build.example.com/sql')
+        try:
+            b.sync_in()
+
+            sources = {s.name: s for s in b.sources}
+
+            # Nothing has been built, so all of the sources get the default
+            self.assertEqual({1.0}, set(b.source_costs(list(b.sources), ('build', 'build_mp')).values()))
+
+            with b.progress.start('build_mp', 1, source=sources['integers']) as ps:
+                ps.add('Running source', source=sources['integers'], state='running')
+                time.sleep(.2)
+                ps.update('Finished source', state='done')
+
+            durations = b.source_durations(('build', 'build_mp'))
+            self.assertEqual([sources['integers'].vid], list(durations.keys()))
+            self.assertGreaterEqual(durations[sources['integers'].vid], .2)
+
+            costs = b.source_costs(list(b.sources), ('build', 'build_mp'))
+            self.assertEqual(durations[sources['integers'].vid], costs[sources['use_select'].vid])
+
+            self.assertEqual({}, b.source_durations(('ingest', 'ingest_mp')))
+
+        finally:
+            b.clean_all()
+            b.close()
+
+    def test_copy_segment_rows(self):
+        from itertools import count
+        from ambry.bundle import Bundle
+
+        class Reader(object):
+            def __init__(self, rows):
+                self.rows = iter(rows)
+
+        class Writer(object):
+            def __init__(self):
+                self.rows = []
+                self.insert_row = self.rows.append
+
+        w = Writer()
+        ids = count(1)
+
+        Bundle._copy_segment_rows(Reader([(0, 'a'), (1, 'b')]), w, ids)
+        Bundle._copy_segment_rows(Reader([]), w, ids)
+        Bundle._copy_segment_rows(Reader([(0, 'c')]), w, ids)
+
+        self.assertEqual([(1, 'a'), (2, 'b'), (3, 'c')], w.rows)
+
+    def test_caster_cache(self):
+        from fs.errors import FSError
+        from ambry.bundle import bundle as bundle_module
+        from ambry.etl import Pipe, codegen
+
+        b = self.import_single_bundle('build.example.com/casters')
+        try:
+            b.sync_in()
+            b = b.cast_to_subclass()
+
+            s = b.source('simple')
+            headers = [c.name for c in s.dest_table.columns]
+
+            key = b.caster_code_key(s, headers)
+            self.assertEqual(key, b.caster_code_key(s, headers))
+            self.assertNotEqual(key, b.caster_code_key(s, headers[1:]))
+            self.assertNotEqual(key, b.caster_code_key(s, headers, vectorize=True))
+
+            pipe = Pipe()
+            pipe.bundle = b
+
+            bundle_module._caster_code_cache.clear()
+            row_processors = b.build_caster_code(s, headers, pipe=pipe)
+
+            self.assertIn(key, bundle_module._caster_code_cache)
+            self.assertTrue(b.build_fs.exists('{}/{}.marshal'.format(bundle_module.CASTER_CACHE_DIR, key)))
+
+            # The code is written once, under the key, and the compiled code references that file
+            code_path = '/code/casters/{}.py'.format(key)
+            self.assertTrue(b.build_fs.exists(code_path))
+            self.assertEqual(b.build_fs.getsyspath(code_path), row_processors[0].__code__.co_filename)
+
+            # Another process would load the compiled code from the build directory
+            bundle_module._caster_code_cache.clear()
+            self.assertEqual(len(row_processors), len(b.build_caster_code(s, headers, pipe=pipe)))
+            self.assertIn(key, bundle_module._caster_code_cache)
+
+            # If the cache can't be read, the code is generated again
+            bundle_module._caster_code_cache.clear()
+            getcontents = b.build_fs.getcontents
+
+            def failing_getcontents(path, *args, **kwargs):
+                if path.endswith('.marshal'):
+                    raise FSError('Failed to read {}'.format(path))
+                return getcontents(path, *args, **kwargs)
+
+            b.build_fs.getcontents = failing_getcontents
+            try:
+                self.assertEqual(len(row_processors), len(b.build_caster_code(s, headers, pipe=pipe)))
+            finally:
+                del b.build_fs.getcontents
+
+            # Changes to the code generator change the key
+            version = codegen.CODE_VERSION
+            codegen.CODE_VERSION += 1
+            try:
+                self.assertNotEqual(key, b.caster_code_key(s, headers))
+            finally:
+                codegen.CODE_VERSION = version
+
+        finally:
+            b.clean_all()
+            b.close()
+
+    def test_vectorized_casts_multistage(self):
+        from datetime import date
+        from ambry.etl import CastColumns
+
+        b = self.import_single_bundle('build.example.com/casters')
+        try:
+            b.sync_in()
+            b = b.cast_to_subclass()
+
+            s = b.source('simple')
+
+            headers = ['uuid', 'index', 'index2', 'numcom', 'indexd3', 'categorical', 'removecodes', 'keepcodes',
+                       'date']
+            rows = [['u{}'.format(i), i, i * 2, str(i), i / 3.0, 'red', 1, 1, date(2000, i % 12 + 1, i % 28 + 1)]
+                    for i in range(20)]
+
+            def cast(batch_size):
+                pipe = CastColumns()
+                pipe.bundle = b
+                pipe._source = s
+                pipe.batch_size = batch_size
+                pipe.process_header(headers)
+
+                if batch_size:
+                    # The date column is vectorized, and the month and year columns read it in the second stage
+                    self.assertIsNotNone(pipe.batch_processor)
+                    return pipe.process_batch([list(row) for row in rows])
+                else:
+                    cast_row = pipe.fused_body()
+                    return [cast_row(list(row)) for row in rows]
+
+            expected = cast(None)
+            self.assertEqual(list(range(1, 13)) + list(range(1, 9)), [row[8] for row in expected])
+
+            self.assertEqual(expected, cast(len(rows)))
+
+        finally:
+            b.clean_all()
+            b.close()
+
+    def test_source_fingerprint(self):
+        from ambry.etl import Shard
+
+        b = self.import_single_bundle('build.example.com/sql')
+        try:
+            b.sync_in()
+            b = b.cast_to_subclass()
+
+            s = b.source('use_select')
+
+            fingerprint = b.source_fingerprint(s)
+            self.assertIsNotNone(fingerprint)
+            self.assertEqual(fingerprint, b.source_fingerprint(s))
+
+            # Shards have their own fingerprints, which can be computed from the fingerprint of the source
+            shard = Shard(1, 10, 20)
+            self.assertNotEqual(fingerprint, b.source_fingerprint(s, shard))
+            self.assertEqual(b.source_fingerprint(s, shard), b.source_fingerprint(s, shard, base=fingerprint))
+
+            # Changing the transforms of the destination table or the metadata changes the fingerprint
+            s.dest_table.columns[1].transform = '^int'
+            self.assertNotEqual(fingerprint, b.source_fingerprint(s))
+            fingerprint = b.source_fingerprint(s)
+
+            b.metadata.about.title = 'Another Title'
+            self.assertNotEqual(fingerprint, b.source_fingerprint(s))
+
+            # Generators could read anything
+            s.reftype = 'generator'
+            self.assertIsNone(b.source_fingerprint(s))
+
+            # Reuse is off by default
+            self.assertIsNone(b._build_fingerprint(b.source('use_view')))
+
+        finally:
+            b.clean_all()
+            b.close()
+
+    def test_build_reuses_fingerprinted_outputs(self):
+        b = self.import_single_bundle('build.example.com/classification')
+        try:
+            b.sync_in()
+            b = b.cast_to_subclass()
+            b.reuse_builds = True
+
+            self.assertTrue(b.ingest())
+            self.assertTrue(b.build())
+
+            counts = {p.name: p.count for p in b.partitions}
+            self.assertTrue(counts)
+
+            b.clean_build()
+
+            def pipeline(*args, **kwargs):
+                raise AssertionError('Should have reused the stored partitions')
+
+            b.pipeline = pipeline
+
+            self.assertTrue(b.build(force=True))
+
+            self.assertEqual(counts, {p.name: p.count for p in b.partitions})
+
+            for p in b.partitions:
+                self.assertTrue(p.local_datafile.exists)
+
+            # Without reuse, the source is built again
+            b.reuse_builds = False
+
+            with self.assertRaises(AssertionError):
+                b.build(force=True)
+
+        finally:
+            b.clean_all()
+            b.close()
+
+    def test_copy_dataset(self):
+        import os
+        from ambry.orm import Database, Column, Table, File, Config, DataSource, SourceTable
+
+        b = self.import_single_bundle('build.example.com/casters')
+        l = b.library
+        try:
+            self.assertEqual('sqlite', l.database.driver)
+
+            vid = b.identity.vid
+            tables = [Table, Column, File, DataSource, SourceTable, Config]
+
+            def dump(db):
+                return {tc.__tablename__: sorted(tuple(r) for r in db.connection.execute(
+                        tc.__table__.select().where(tc.d_vid == vid)))
+                        for tc in tables}
+
+            expected = dump(l.database)
+            self.assertTrue(expected['columns'])
+
+            # Packaging attaches the library database to the new one
+            db = Database('sqlite:///{}'.format(l.create_bundle_file(b)))
+            self.assertEqual(expected, dump(db))
+            path = db.path
+            db.close()
+
+            # If the fast copy fails, the ORM copy does the same thing
+            def failing_copy(*args, **kwargs):
+                raise Exception('Fast copy failed')
+
+            messages = []
+            db = Database('sqlite:///{}.orm.db'.format(path))
+            db.open()
+            db._copy_dataset_attach = failing_copy
+            db.copy_dataset(l.database.dataset(vid), cb=lambda m, n: messages.append(m))
+            orm_copy = dump(db)
+
+            # The ORM copy turns the empty data dicts of the sources into lists
+            del expected['datasources'], orm_copy['datasources']
+            self.assertEqual(expected, orm_copy)
+            self.assertIn('(orm)', messages[0])
+            db.close()
+            os.remove(path + '.orm.db')
+
+            # Check in the package, and record the time of the copy
+            l.remove(b)
+            l.database.commit()
+
+            b = l.checkin_bundle(path)
+            checked_in = dump(l.database)
+            del checked_in['datasources']
+            self.assertEqual(expected, checked_in)
+
+            messages = [p.message for p in b.progress.records if p.phase == 'checkin']
+            m = next(m for m in messages if 'columns records' in m)
+            self.assertTrue(m.startswith('Copied {} columns records'.format(len(expected['columns']))))
+            self.assertIn('(attach)', m)
+            self.assertTrue(any(m.startswith('Copied bundle') for m in messages))
+            os.remove(path)
+
+        finally:
+            b.close()
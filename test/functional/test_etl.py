@@ -3,7 +3,8 @@ import unittest
 
 from fs.opener import fsopendir
 
-from ambry.etl.pipeline import Pipeline, Pipe, PrintRows, Sample, Head, SelectRows, Slice
+from ambry.etl.pipeline import Pipeline, Pipe, PrintRows, Sample, Head, SelectRows, Slice, Add, Delete, \
+    Collect
 
 from test.proto import TestBase
 
@@ -205,6 +206,101 @@ class Test(TestBase):
             ['col0', 'col1', 'col2', 'col10', 'col11', 'col12', 'col9', 'col19'],
             pl[PrintRows].headers)
 
+    def test_batch_mode(self):
+
+        class Source(Pipe):
+            def __iter__(self):
+
+                yield ['col' + str(j) for j in range(5)]
+
+                for i in range(10000):
+                    yield [i + j for j in range(5)]
+
+        def make_pipeline(**kwargs):
+            return Pipeline(
+                source=Source(),
+                first=[Delete(["col2", "col3"]), Add({'x': lambda pipe, row, v: row[0] * 2})],
+                last=[Head(5000), Collect()],
+                **kwargs
+            )
+
+        pl = make_pipeline()
+        pl.run()
+        row_rows = pl[Collect].rows
+
+        pl = make_pipeline(batch_size=333)
+        pl.run()
+        batch_rows = pl[Collect].rows
+
+        self.assertEqual(5000, len(batch_rows))
+        self.assertEqual([0, 1, 4, 0], batch_rows[0])
+        self.assertEqual([4999, 5000, 5003, 9998], batch_rows[-1])
+        self.assertEqual(row_rows, batch_rows)
+        self.assertEqual(['col0', 'col1', 'col4', 'x'], pl[Collect].headers)
+
+    def test_batch_mode_errors(self):
+        from ambry.etl.pipeline import BadRowError, PipelineError, Expand
+
+        class Source(Pipe):
+            def __iter__(self):
+
+                yield ['col' + str(j) for j in range(5)]
+
+                for i in range(1000):
+                    yield [i + j for j in range(5)]
+
+        def expand(pipe, row, v):
+            return [1, 2] if row[0] != 500 else [1]
+
+        # Batch mode rejects the rows that row mode does
+        for kwargs in (dict(), dict(batch_size=100)):
+            pl = Pipeline(source=Source(), first=[Expand({('a', 'b'): expand})], last=[Collect()], **kwargs)
+
+            with self.assertRaises(BadRowError):
+                pl.run()
+
+        # Errors in the edit code report the code
+        for kwargs in (dict(), dict(batch_size=100)):
+            pl = Pipeline(source=Source(), first=[Add({'x': lambda pipe, row, v: row[0] / 0})], last=[Collect()],
+                          **kwargs)
+
+            with self.assertRaises(PipelineError) as cm:
+                pl.run()
+
+            self.assertIn('self.edit_functions', str(cm.exception))
+
+    def test_compiled(self):
+
+        class Source(Pipe):
+            def __iter__(self):
+
+                yield ['a', 'b']
+
+                for i in range(1000):
+                    yield [i, i * 2]
+
+        def make_pipeline(**kwargs):
+            return Pipeline(
+                source=Source(),
+                first=[SelectRows('row.a % 10 == 0'), Add({'c': lambda pipe, row, v: row.b + 1})],
+                last=[Collect()],
+                **kwargs
+            )
+
+        pl = make_pipeline()
+        pl.run()
+        row_rows = pl[Collect].rows
+
+        pl = make_pipeline(compiled=True)
+        pl.run()
+
+        self.assertEqual(100, len(pl[Collect].rows))
+        self.assertEqual([990, 1980, 1981], pl[Collect].rows[-1])
+        self.assertEqual(row_rows, pl[Collect].rows)
+
+        self.assertIn('fused_0: ambry.etl.pipeline.SelectRows, ambry.etl.pipeline.Add', pl.fused_report())
+        self.assertIn('def fused_0(rows, f_0=f_0, f_1=f_1)', pl[SelectRows].fused_in.code)
+
     def test_multi_source(self):
 
         class Source(Pipe):
@@ -248,3 +344,113 @@ class Test(TestBase):
             for row in islice(sp, 10):
                 rows.append(row)
             self.assertEqual(len(rows), 10)
+
+    def test_read_ahead(self):
+
+        class Source(Pipe):
+            read_ahead_ok = True
+
+            def __iter__(self):
+
+                yield ['a', 'b']
+
+                for i in range(10000):
+                    yield [i, i * 2]
+
+        def make_pipeline(**kwargs):
+            return Pipeline(
+                source=Source(),
+                first=[Add({'c': lambda pipe, row, v: row[1] + 1})],
+                last=[Collect()],
+                **kwargs
+            )
+
+        pl = make_pipeline()
+        pl.run()
+        row_rows = pl[Collect].rows
+        self.assertEqual('No read-ahead', pl.read_ahead_report())
+
+        for kwargs in (dict(), dict(batch_size=500), dict(compiled=True)):
+            pl = make_pipeline(read_ahead=2, read_ahead_batch_size=100, **kwargs)
+            pl.run()
+
+            self.assertEqual(row_rows, pl[Collect].rows)
+            self.assertEqual(100, pl.read_ahead_pipe.batches)
+            self.assertEqual(10000, pl.read_ahead_pipe.rows)
+            self.assertIn('100 batches, 10000 rows', pl.read_ahead_report())
+
+        # Errors in the reader thread are raised in the pipeline
+        class BadSource(Source):
+            def __iter__(self):
+                yield ['a', 'b']
+                yield [1, 2]
+                raise ValueError('bad row')
+
+        pl = make_pipeline(read_ahead=2)
+        pl['source'] = [BadSource()]
+
+        with self.assertRaises(ValueError):
+            pl.run()
+
+    def test_shards(self):
+        from ambry.etl.pipeline import make_shards, segment_sort_key, is_shard_segment
+
+        shards = make_shards(10001, 2500)
+
+        self.assertEqual(5, len(shards))
+        self.assertEqual(0, shards[0].start_row)
+        self.assertIsNone(shards[-1].end_row)
+
+        for s1, s2 in zip(shards, shards[1:]):
+            self.assertEqual(s1.end_row, s2.start_row)
+
+        self.assertEqual(1, len(make_shards(100, 2500)))
+
+        class SourceRecord(object):
+            sequence_id = 3
+
+        class Source(Pipe):
+            _source = SourceRecord()
+
+            def __iter__(self):
+                shard = self.pipeline.shard
+
+                yield ['a']
+
+                for i in islice(range(10001), shard.start_row if shard else 0, shard.end_row if shard else None):
+                    yield [i]
+
+        class Segment(Pipe):
+            def process_header(self, headers):
+                self.source_segment_ = self.source_segment
+                return headers
+
+        pl = Pipeline(source=Source(), first=[Segment()], last=[Collect()])
+        pl.run()
+
+        self.assertEqual(3, pl[Segment].source_segment_)
+        all_rows = pl[Collect].rows
+
+        segments = {}
+
+        for shard in reversed(shards):
+            pl = Pipeline(source=Source(), first=[Segment()], last=[Collect()])
+            pl.shard = shard
+            pl.run()
+
+            segments[pl[Segment].source_segment_] = pl[Collect].rows
+
+        self.assertEqual(5, len(segments))
+        self.assertNotIn(3, segments)
+
+        # Coalescing the segments in order produces the same rows as the whole source, and the
+        # shards sort after the segments of source 2 and before those of source 4.
+        rows = [row for seg in sorted(segments, key=segment_sort_key) for row in segments[seg]]
+
+        self.assertEqual(all_rows, rows)
+        self.assertEqual(sorted([2, 4] + list(segments), key=segment_sort_key),
+                         [2] + sorted(segments) + [4])
+
+        # Shard segments always have their ids renumbered when they are unified
+        self.assertTrue(all(is_shard_segment(seg) for seg in segments))
+        self.assertFalse(is_shard_segment(3))
@@ -90,3 +90,78 @@ class Test(TestBase):
         self.assertEquals(
             sorted([None, u'Intervals', u'More', u'here']),
             sorted(messages))
+
+    def test_progress_writer(self):
+        from ambry.bundle.process import ProcessLogger
+
+        b = self.import_single_bundle('build.example.com/casters')
+
+        pl = ProcessLogger(b.dataset, flush_interval=60)
+        try:
+            self.assertIsNotNone(pl._writer)
+            pl.clean()
+
+            ps = pl.start('write', 1, message='Writing')
+            ps.add('Add')
+
+            for i in range(1000):
+                ps.update('Update {}'.format(i), item_count=i)
+
+            # The updates are buffered, and written together when the records are read
+            self.assertEqual(0, pl._writer.n_flushes)
+            self.assertEqual(sorted([(u'Writing', None), (u'Update 999', 999)]),
+                             sorted((r.message, r.item_count) for r in pl.records if r.stage == 1))
+            self.assertEqual(1, pl._writer.n_flushes)
+
+            # Updates are written before the section's done records
+            with self.assertRaises(ValueError):
+                with pl.start('write', 2, message='Failing') as ps:
+                    ps.add('Add', item_count=1)
+                    ps.update(item_count=2)
+                    raise ValueError('Failed')
+
+            records = {r.message: r for r in pl.records if r.stage == 2}
+            self.assertEqual(2, records['Add'].item_count)
+            self.assertEqual('done', records['Add'].state)
+            self.assertIn('Failed', records)
+
+        finally:
+            pl.close()
+
+    def test_progress_writer_retry(self):
+        from ambry.bundle.process import ProcessLogger
+
+        b = self.import_single_bundle('build.example.com/casters')
+
+        pl = ProcessLogger(b.dataset, flush_interval=60)
+        try:
+            writer = pl._writer
+            pl.clean()
+
+            ps = pl.start('write', 1, message='Writing')
+            ps.add('Add')
+            ps.update('Update 1', item_count=1)
+
+            class FailingEngine(object):
+                def connect(self):
+                    raise IOError('Database went away')
+
+            engine, writer._engine = writer._engine, FailingEngine()
+
+            with self.assertRaises(IOError):
+                writer.flush()
+
+            self.assertEqual(0, writer.n_flushes)
+
+            # The failed updates are kept, and merged with the ones that come after them
+            ps.update(item_count=2)
+
+            writer._engine = engine
+            writer.flush()
+
+            self.assertEqual(1, writer.n_flushes)
+            self.assertEqual(sorted([(u'Writing', None), (u'Update 1', 2)]),
+                             sorted((r.message, r.item_count) for r in pl.records if r.stage == 1))
+
+        finally:
+            pl.close()
@@ -64,3 +64,84 @@ class Test(TestBase):
 
         self.assertEqual([u'int', u'float', u'string', u'time', u'date'],
                          [c.source_header for c in b.dataset.source_table('types1').columns])
+
+    def test_schema_file_update(self):
+        """Sync a changed schema file into a dataset that already has the tables"""
+
+        b = self.import_single_bundle('build.example.com/casters')
+        try:
+            simple = b.table('simple')
+            names = [c.name for c in simple.columns]
+            vids = [c.vid for c in simple.columns]
+
+            with b.source_fs.open('schema.csv', encoding='utf8') as f:
+                rows = list(csv.reader(f))
+
+            for row in rows:
+                if row[:2] == ['simple', 'uuid']:
+                    row[4] = 'A UUID'
+
+            rows += [['simple', 'extra', 'float', '', 'An extra column'],
+                     ['other', 'id', 'int', '', 'Another table'],
+                     ['other', 'value', 'str', 'doubleit', '']]
+
+            path = b.source_fs.getsyspath('schema.csv')
+            with open(path, 'w') as f:
+                w = csv.writer(f)
+                for row in rows:
+                    w.writerow(row)
+
+            b.sync_in(force=True)
+
+            simple = b.table('simple')
+
+            # The existing columns keep their ids, and the new one is added at the end
+            self.assertEqual(names + ['extra'], [c.name for c in simple.columns])
+            self.assertEqual(vids, [c.vid for c in simple.columns][:-1])
+            self.assertEqual(len(names) + 1, simple.column('extra').sequence_id)
+            self.assertEqual('A UUID', simple.column('uuid').description)
+
+            other = b.table('other')
+            self.assertEqual(['id', 'value'], [c.name for c in other.columns])
+            self.assertEqual('Another table', other.description)
+            self.assertEqual('doubleit', other.column('value').transform)
+            self.assertEqual(len(b.dataset.tables), other.sequence_id)
+
+            # Syncing again doesn't change anything
+            b.sync_in(force=True)
+            self.assertEqual(names + ['extra'], [c.name for c in b.table('simple').columns])
+
+        finally:
+            b.close()
+
+    def test_schema_loader_columns(self):
+        """Columns added by the schema loader match those added through the ORM"""
+        from ambry.bundle.files import SchemaLoader
+        from ambry.orm import Column
+
+        b = self.import_single_bundle('build.example.com/casters')
+        try:
+            loader = SchemaLoader(b.dataset)
+
+            with self.assertRaises(AttributeError):
+                loader.add_column('simple', 'extra', datatype='float', no_such_attribute=1)
+
+            loader.add_column('simple', 'extra', datatype='float', is_primary_key='')
+            loader.load()
+            b.commit()
+
+            orm_column = b.table('simple').add_column('orm_extra', datatype='float')
+            b.commit()
+
+            loaded = b.table('simple').column('extra')
+
+            for key in SchemaLoader._attrs(Column):
+                if key not in ('vid', 'id', 'sequence_id', 'name'):
+                    self.assertEqual(getattr(orm_column, key), getattr(loaded, key), key)
+
+            self.assertIsNone(loaded.altname)
+            self.assertIsNone(loaded.description)
+            self.assertFalse(loaded.is_primary_key)
+
+        finally:
+            b.close()
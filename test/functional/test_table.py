@@ -73,3 +73,50 @@ class Test(unittest.TestCase):
 
         for t in ds.tables:
             self.assertEqual(11, len(t.columns))  # 10 + id column
+
+    def test_sequence_blocks(self):
+        """Sequence ids are reserved in blocks, and unused ids are returned when the database is closed"""
+        import shutil
+        import tempfile
+        from os.path import join
+
+        d = tempfile.mkdtemp()
+        try:
+            dsn = 'sqlite:///' + join(d, 'library.db')
+
+            db = Database(dsn)
+            db.create()
+
+            ds = db.new_dataset(vid=self.dn[0], source='source', dataset='dataset')
+            vid = ds.vid
+
+            tables = [ds.new_table('table' + str(i)) for i in range(3)]
+            ds.commit()
+
+            self.assertEqual([1, 2, 3], [t.sequence_id for t in tables])
+
+            # One block was reserved for the three tables
+            t_seq, = db.connection.execute("SELECT d_t_sequence_id FROM datasets WHERE d_vid = ?", vid).fetchone()
+            self.assertEqual(1 + db.sequence_block_size, t_seq)
+
+            db.close()
+
+            t_seq, = db.connection.execute("SELECT d_t_sequence_id FROM datasets WHERE d_vid = ?", vid).fetchone()
+            self.assertEqual(4, t_seq)
+
+            ds = db.dataset(vid)
+            self.assertEqual(4, ds.new_table('table3').sequence_id)
+
+            p = ds.new_partition('table0')
+            self.assertEqual(1, p.sequence_id)
+
+            # After a reset, the numbering starts over
+            db.delete_tables_partitions(ds)
+            ds.t_sequence_id = 1
+            ds.commit()
+            self.assertEqual(1, ds.new_table('table4').sequence_id)
+
+            db.close()
+
+        finally:
+            shutil.rmtree(d)
@@ -288,3 +288,31 @@ class Test(TestBase):
         print vt.RateVT(0)
         print vt.RateVT(None)
 
+
+    def test_vector_cast(self):
+        from datetime import date
+        from ambry.valuetype import IntValue, cast_int
+
+        try:
+            from ambry.valuetype.vectors import vector_cast
+        except ImportError:
+            raise unittest.SkipTest('NumPy is not installed')
+
+        values = ['1', None, '', 3, 4.7, '1,234', ' ']
+        errors = {'a': set()}
+        failed = []
+
+        def fallback(i):
+            failed.append(i)
+            return cast_int(IntValue(values[i]), 'a', errors)
+
+        self.assertEqual([1, None, None, 3, 4, None, None], vector_cast('int', values, (), fallback))
+        self.assertEqual([5, 6], failed)  # Only the cells that NumPy can't convert
+        self.assertEqual(2, len(errors['a']))
+
+        self.assertEqual([1.5, None, 3.0], vector_cast('float', ['1.5', None, 3], (), None))
+        self.assertEqual([1.0, None], vector_cast('float', ['1.5', ''], ('int_n',), None))
+
+        # Partial dates go to the fallback, since dateutil and NumPy parse them differently
+        self.assertEqual([date(2015, 1, 2), None], vector_cast('date', ['2015-01-02', None], (), None))
+        self.assertEqual(['f', 'f'], vector_cast('date', ['2015-01-02', '2015'], (), lambda i: 'f'))
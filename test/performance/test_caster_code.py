@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from test.proto import TestBase
+
+N_SOURCES = 200
+
+
+class CasterCodeTest(TestBase):
+    """Time the caster code setup that every source does at the start of a build"""
+
+    def setUp(self):
+        super(CasterCodeTest, self).setUp()
+
+        b = self.import_single_bundle('build.example.com/casters')
+        b.sync_in()
+        self.bundle = b = b.cast_to_subclass()
+
+        dest_table = b.table('simple')
+
+        for i in range(N_SOURCES):
+            b.dataset.new_source('simple_{}'.format(i), dest_table_name=dest_table.name, reftype='generator',
+                                 ref='ExampleSourcePipe')
+        b.commit()
+
+        self.sources = [b.source('simple_{}'.format(i)) for i in range(N_SOURCES)]
+        self.headers = [c.name for c in dest_table.columns]
+
+    def tearDown(self):
+        self.bundle.clean_all()
+        self.bundle.close()
+        super(CasterCodeTest, self).tearDown()
+
+    def test_exec_context_and_caster_code(self):
+        from ambry.bundle import bundle as bundle_module
+        from ambry.etl import Pipe
+
+        b = self.bundle
+
+        pipe = Pipe()
+        pipe.bundle = b
+
+        t0 = time.time()
+        for s in self.sources:
+            b.exec_context(source=s, pipe=pipe)
+        exec_context_time = time.time() - t0
+
+        bundle_module._caster_code_cache.clear()
+
+        compiled = []
+
+        def counting_compile(*args):
+            compiled.append(args[1])
+            return compile(*args)
+
+        # Shadow the builtin in the module, to count the compilations
+        bundle_module.compile = counting_compile
+        try:
+            t0 = time.time()
+            row_processors = [b.build_caster_code(s, self.headers, pipe=pipe) for s in self.sources]
+            caster_code_time = time.time() - t0
+        finally:
+            del bundle_module.compile
+
+        print('exec_context: {:0.2f}ms per source, build_caster_code: {:0.2f}ms per source'.format(
+            exec_context_time * 1000 / N_SOURCES, caster_code_time * 1000 / N_SOURCES))
+
+        # All of the sources share the same compiled code, which is compiled once
+        self.assertEqual(1, len(bundle_module._caster_code_cache))
+        self.assertEqual(1, len(compiled))
+
+        (_, code_obj), = bundle_module._caster_code_cache.values()
+
+        for rps in row_processors[1:]:
+            self.assertIn(rps[0].__code__, code_obj.co_consts)
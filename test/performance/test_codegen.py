@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from ambry.orm.column import Column
+from ambry.orm.table import Table
+
+from test.proto import TestBase
+
+N_ESTIMATES = 150  # Each estimate has a margin column, so the table has 300 data columns
+N_ROWS = 2000
+
+
+class InlineCodegenTest(TestBase):
+    """Compare the row processors for a wide ACS-style table, with and without inlining the column casts"""
+
+    def setUp(self):
+        super(InlineCodegenTest, self).setUp()
+
+        self.table = t = Table(name='acs')
+
+        columns = [('id', 'int'), ('geoid', 'str'), ('stusab', 'str')]
+
+        for i in range(1, N_ESTIMATES + 1):
+            columns.append(('b01001{:03d}'.format(i), 'int'))
+            columns.append(('b01001{:03d}_m90'.format(i), 'float'))
+
+        for seq, (name, datatype) in enumerate(columns, 1):
+            t.columns.append(Column(name=name, sequence_id=seq, datatype=datatype))
+
+        self.headers = [c.name for c in t.columns][1:]
+
+        self.rows = [['14000US06073{:06d}'.format(n), 'ca'] + [str(n + i) for i in range(len(columns) - 3)]
+                     for n in range(N_ROWS)]
+
+    def _time_row_processors(self, inline):
+        from ambry.etl.codegen import make_row_processors
+        from ambry.bundle.bundle import _static_exec_context
+
+        env = dict(_static_exec_context())
+
+        code = make_row_processors(None, self.headers, self.table, env, inline=inline)
+
+        exec(compile(code, '<string>', 'exec'), env)
+
+        row_processors = env['row_processors']
+        errors = {h: set() for h in self.headers + [c.name for c in self.table.columns]}
+
+        t0 = time.time()
+
+        out = []
+        for row_n, row in enumerate(self.rows):
+            for proc in row_processors:
+                row = proc(row, row_n, errors, {}, {}, None, None, None)
+            out.append(row)
+
+        return time.time() - t0, out
+
+    def test_inline_row_processors(self):
+
+        func_time, func_rows = self._time_row_processors(inline=False)
+        inline_time, inline_rows = self._time_row_processors(inline=True)
+
+        print('{} columns, {} rows: column functions {:0.3f}s, inline {:0.3f}s'.format(
+            len(self.table.columns), N_ROWS, func_time, inline_time))
+
+        self.assertEqual(func_rows, inline_rows)
+        self.assertLess(inline_time, func_time)
@@ -96,3 +96,144 @@ class DbUsageTreeFromDatabaseTest(TestBase):
             'dataset retrieve',
             'all configs retrieve while cache building']
         self.assertEqual(len(expected_queries), len(queries))
+
+    def test_commits_deferred_writes_once(self):
+
+        d = {
+            'about': {'title': 'The title', 'summary': 'The summary', 'grain': 'hospital',
+                      'access': 'restricted', 'tags': ['one', 'two']},
+            'names': {'name': self.dataset.name, 'vname': self.dataset.vname},
+            'external_documentation': {
+                'dataset': {'url': 'http://example.com', 'title': 'Dataset'},
+                'download': {'url': 'http://example.com/download', 'title': 'Download'}}
+        }
+
+        def count_writes(deferred):
+            """Set the metadata and count the commits and the statements that write to the database"""
+            counts = dict(commits=0, statements=0)
+
+            def commit(conn):
+                counts['commits'] += 1
+
+            def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+                if not statement.startswith('SELECT'):
+                    counts['statements'] += 1
+
+            top = Top()
+            top.build_from_db(self.dataset)
+
+            event.listen(self.db.engine, 'commit', commit)
+            event.listen(self.db.engine, 'before_cursor_execute', before_cursor_execute)
+
+            try:
+                if deferred:
+                    with top.deferred_writes():
+                        top.set(d)
+                else:
+                    top.set(d)
+            finally:
+                event.remove(self.db.engine, 'commit', commit)
+                event.remove(self.db.engine, 'before_cursor_execute', before_cursor_execute)
+
+            return counts
+
+        def clear():
+            self.db.session.query(Config).filter(Config.type == 'metadata').delete()
+            self.db.session.commit()
+            self.dataset._sequence_ids.clear()
+
+        # Creating the records
+        immediate = count_writes(False)
+        clear()
+        deferred = count_writes(True)
+
+        print('Creating metadata, immediate writes: {}; deferred writes: {}'.format(immediate, deferred))
+
+        self.assertEqual(dict(commits=1, statements=1), deferred)  # One multi-row INSERT
+
+        # Updating every value
+        d['about']['title'] = 'Another title'
+        d['about']['summary'] = 'Another summary'
+        d['about']['tags'] = ['three']
+        d['names']['name'] = 'another-name'
+        d['external_documentation']['dataset']['url'] = 'http://example.com/another'
+
+        deferred = count_writes(True)
+
+        print('Updating metadata, deferred writes: {}'.format(deferred))
+
+        self.assertEqual(dict(commits=1, statements=1), deferred)  # One multi-row UPDATE
+
+        top = Top()
+        top.build_from_db(self.dataset)
+        self.assertEqual('Another title', top.about.title)
+        self.assertEqual(['three'], top.about.tags)
+        self.assertEqual('another-name', top.names.name)
+        self.assertEqual('http://example.com/another', top.external_documentation.dataset.url)
+        self.assertEqual('Download', top.external_documentation.download.title)
+
+    def test_reuses_snapshot_of_unchanged_configs(self):
+
+        self._create_db_tree([('about.access', 'restricted'), ('about.grain', 'hospital')])
+
+        top = Top()
+        top.build_from_db(self.dataset)
+
+        queries = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            queries.append((statement, parameters))
+        event.listen(self.db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        try:
+            top = Top()
+            top.build_from_db(self.dataset)
+        finally:
+            event.remove(self.db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        # The snapshot is from the same transaction
+        self.assertEqual(0, len(queries))
+        self.assertEqual('hospital', top.about.grain)
+
+        # Writing a value drops the snapshot
+        top.about.grain = 'county'
+
+        top = Top()
+        top.build_from_db(self.dataset)
+        self.assertEqual('county', top.about.grain)
+        self.assertEqual('restricted', top.about.access)
+
+        # Changes made by other processes don't fire the events that drop the snapshot, but later transactions
+        # see them. This one keeps the count and the modification time of the configs.
+        table = Config.__table__
+        self.db.session.execute(table.update()
+                                .where(table.c.co_d_vid == self.dataset.vid)
+                                .where(table.c.co_value == 'county')
+                                .values(co_value='state'))
+        self.db.session.commit()
+
+        top = Top()
+        top.build_from_db(self.dataset)
+        self.assertEqual('state', top.about.grain)
+
+    def test_bounds_snapshots(self):
+        from ambry.metadata import proptree
+
+        self._create_db_tree([('about.grain', 'hospital')])
+
+        session = self.db.session
+        # Make sure the snapshots are from the same transaction
+        session.query(Config).first()
+
+        for i in range(proptree.MAX_SNAPSHOTS + 10):
+            proptree._config_rows(session, 'd{}'.format(i), 'metadata')
+
+        proptree._config_rows(session, self.dataset.vid, 'metadata')
+
+        snapshots = proptree._snapshots[session]
+        self.assertEqual(proptree.MAX_SNAPSHOTS, len(snapshots))
+        self.assertEqual((self.dataset.vid, 'metadata'), list(snapshots)[-1])
+        self.assertNotIn(('d0', 'metadata'), snapshots)
+
+        session.commit()
+        self.assertNotIn(session, proptree._snapshots)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import time
+from multiprocessing import Event, Process, Queue
+
+from test.proto import TestBase
+
+N_SOURCES = 100
+N_PROCESSES = 4
+N_READERS = 2
+
+
+def reader(config, vid, ready, stop, results):
+    """Query the library, as the web UI does, until stopped, and report the number of queries and failures"""
+    from sqlalchemy.exc import OperationalError
+    from ambry.library import Library
+    from ambry.orm import Partition, Process as ProcessRecord
+
+    l = Library(config, read_only=True)
+    session = l.database.session
+
+    n = errors = 0
+    ready.set()
+
+    while not stop.is_set():
+        try:
+            session.query(Partition).filter(Partition.d_vid == vid).count()
+            session.query(ProcessRecord).filter(ProcessRecord.d_vid == vid).count()
+            l.dataset(vid).source_tables
+            n += 1
+        except OperationalError:
+            errors += 1
+        finally:
+            session.rollback()  # Don't hold the read transaction open
+            session.expire_all()
+
+    l.close()
+    results.put((n, errors))
+
+
+class ReadConcurrencyTest(TestBase):
+    """Measure the throughput of readers of a Sqlite library while a bundle builds with multiple processes"""
+
+    def tearDown(self):
+        self.config.library['read_concurrency'] = False
+        super(ReadConcurrencyTest, self).tearDown()
+
+    def _time_reads(self, read_concurrency):
+
+        self.config.library['read_concurrency'] = read_concurrency
+
+        b = self.import_single_bundle('build.example.com/casters')
+        b.sync_in()
+        b = b.cast_to_subclass()
+
+        dest_table = b.table('simple')
+
+        for i in range(N_SOURCES):
+            b.dataset.new_source('tiny_{}'.format(i), dest_table_name=dest_table.name, reftype='generator',
+                                 ref='ExampleSourcePipe')
+        b.commit()
+
+        b.library.processes = N_PROCESSES
+        b.multi = N_PROCESSES
+
+        stop = Event()
+        results = Queue()
+        readers = []
+
+        for _ in range(N_READERS):
+            ready = Event()
+            readers.append(Process(target=reader, args=(self.config, b.identity.vid, ready, stop, results)))
+            readers[-1].start()
+            ready.wait(30)
+
+        try:
+            t0 = time.time()
+            self.assertTrue(b.build(sources=['tiny_{}'.format(i) for i in range(N_SOURCES)], force=True))
+            dt = time.time() - t0
+        finally:
+            stop.set()
+
+        counts = [results.get(timeout=60) for _ in readers]
+
+        for r in readers:
+            r.join(10)
+
+        b.close()
+
+        return dt, sum(c[0] for c in counts), sum(c[1] for c in counts)
+
+    def test_read_concurrency(self):
+
+        for read_concurrency in (False, True):
+            dt, n, errors = self._time_reads(read_concurrency)
+
+            print('read_concurrency={}: build {:0.2f}s, {} readers made {:0.1f} queries/s, {} failed'.format(
+                read_concurrency, dt, N_READERS, n / dt, errors))
+
+            if read_concurrency:
+                self.assertEqual(0, errors)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import msgpack
+
+from test.proto import TestBase
+
+N_TABLES = 500
+N_COLUMNS = 100  # Per table, so 50K columns in all
+
+
+class SchemaLoadTest(TestBase):
+    """Time loading a schema file the size of those for the US Census"""
+
+    def setUp(self):
+        super(SchemaLoadTest, self).setUp()
+
+        self.bundle = self.import_single_bundle('build.example.com/casters')
+
+    def tearDown(self):
+        self.bundle.close()
+        super(SchemaLoadTest, self).tearDown()
+
+    def test_large_schema(self):
+        from ambry.orm import File
+
+        b = self.bundle
+
+        rows = [['table', 'column', 'datatype', 'description']]
+        for i in range(N_TABLES):
+            rows.append(['table_{}'.format(i), 'id', 'int', 'Table {}'.format(i)])
+            for j in range(N_COLUMNS - 1):
+                rows.append(['table_{}'.format(i), 'col_{}'.format(j), 'float', 'Column {} of table {}'.format(j, i)])
+
+        f = b.build_source_files.file(File.BSFILE.SCHEMA)
+        f.record.update_contents(msgpack.packb(rows), 'application/msgpack')
+
+        t0 = time.time()
+        f.record_to_objects()
+        b.commit()
+        load_time = time.time() - t0
+
+        # Load it again, with one change per table
+        for row in rows[1::N_COLUMNS]:
+            row[3] += ' (revised)'
+
+        f.record.update_contents(msgpack.packb(rows), 'application/msgpack')
+
+        t0 = time.time()
+        f.record_to_objects()
+        b.commit()
+        update_time = time.time() - t0
+
+        print('{} columns: load {:0.2f}s, update {:0.2f}s'.format(N_TABLES * N_COLUMNS, load_time, update_time))
+
+        t = b.table('table_{}'.format(N_TABLES - 1))
+        self.assertEqual(N_COLUMNS, len(t.columns))
+        self.assertEqual('Table {} (revised)'.format(N_TABLES - 1), t.column('id').description)
+
+        self.assertLess(load_time, 60)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from test.proto import TestBase
+
+N_SOURCES = 500
+N_PROCESSES = 4
+
+
+class WorkerPoolTest(TestBase):
+    """Compare the per-task overhead of workers that run one task and exit to workers that stay warm"""
+
+    def setUp(self):
+        super(WorkerPoolTest, self).setUp()
+
+        b = self.import_single_bundle('build.example.com/casters')
+        b.sync_in()
+        self.bundle = b = b.cast_to_subclass()
+
+        dest_table = b.table('simple')
+
+        for i in range(N_SOURCES):
+            b.dataset.new_source('tiny_{}'.format(i), dest_table_name=dest_table.name, reftype='generator',
+                                 ref='ExampleSourcePipe')
+        b.commit()
+
+        b.library.processes = N_PROCESSES
+
+    def tearDown(self):
+        self.bundle.clean_all()
+        self.bundle.close()
+        super(WorkerPoolTest, self).tearDown()
+
+    def _time_build(self, worker_mode):
+        b = self.bundle
+
+        b.library.config.library['worker_mode'] = worker_mode
+
+        b.clean_partitions()
+        b.commit()
+
+        b.multi = N_PROCESSES
+
+        t0 = time.time()
+        self.assertTrue(b.build(sources=['tiny_{}'.format(i) for i in range(N_SOURCES)], force=True))
+        return time.time() - t0
+
+    def test_warm_workers(self):
+
+        fresh_time = self._time_build('fresh')
+        warm_time = self._time_build('warm')
+
+        print('{} sources, {} processes: fresh workers {:0.2f}ms per task, warm workers {:0.2f}ms per task'.format(
+            N_SOURCES, N_PROCESSES, fresh_time * 1000 / N_SOURCES, warm_time * 1000 / N_SOURCES))
+
+        self.assertLess(warm_time, fresh_time)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import TestCase
+
+from ambry.bundle.fingerprints import FingerprintStore, file_hash, json_default
+
+
+class FakeDatafile(object):
+    def __init__(self, contents):
+        self.contents = contents
+
+    def open(self, mode='rb'):
+        return BytesIO(self.contents)
+
+
+class FingerprintStoreTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = FingerprintStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_put_and_get(self):
+        fingerprint = 'ab' * 20
+        manifest = {'source': 'source1', 'partitions': [{'file': '0.mpr'}]}
+
+        self.assertIsNone(self.store.get(fingerprint))
+
+        self.assertTrue(self.store.put(fingerprint, manifest, {'0.mpr': FakeDatafile(b'rows')}))
+        self.assertEqual(manifest, self.store.get(fingerprint))
+
+        with self.store.open(fingerprint, '0.mpr') as f:
+            self.assertEqual(b'rows', f.read())
+
+        # The first build to store a fingerprint wins
+        self.assertFalse(self.store.put(fingerprint, {}, {'0.mpr': FakeDatafile(b'other rows')}))
+        self.assertEqual(manifest, self.store.get(fingerprint))
+
+        self.store.remove(fingerprint)
+        self.assertIsNone(self.store.get(fingerprint))
+
+    def test_failed_put_leaves_no_entry(self):
+
+        class BrokenDatafile(object):
+            def open(self, mode='rb'):
+                raise IOError('Failed to open')
+
+        fingerprint = 'cd' * 20
+
+        with self.assertRaises(IOError):
+            self.store.put(fingerprint, {}, {'0.mpr': FakeDatafile(b'rows'), '1.mpr': BrokenDatafile()})
+
+        self.assertIsNone(self.store.get(fingerprint))
+        self.assertEqual([], os.listdir(os.path.dirname(self.store.path(fingerprint))))
+
+    def test_file_hash(self):
+        self.assertEqual(file_hash(BytesIO(b'rows' * 1000)), file_hash(BytesIO(b'rows' * 1000), block_size=7))
+        self.assertNotEqual(file_hash(BytesIO(b'rows')), file_hash(BytesIO(b'other rows')))
+
+    def test_prune(self):
+        for i, fingerprint in enumerate(('ef' * 20, '01' * 20, '23' * 20)):
+            self.store.put(fingerprint, {}, {'0.mpr': FakeDatafile(b'x' * 1000)})
+            os.utime(self.store.path(fingerprint), (i, i))
+
+        # Using an entry makes it the most recently used
+        self.store.get('ef' * 20)
+
+        self.assertEqual(['01' * 20], self.store.prune(2500))
+        self.assertEqual({'ef' * 20, '23' * 20}, {e[0] for e in self.store.entries()})
+
+        # Stores with a maximum size prune themselves
+        store = FingerprintStore(self.root, max_size=1500)
+        store.put('45' * 20, {}, {'0.mpr': FakeDatafile(b'x' * 1000)})
+        self.assertEqual({'45' * 20}, {e[0] for e in store.entries()})
+
+    def test_json_default(self):
+        self.assertEqual('["datetime.date", "2015-01-02"]',
+                         json.dumps([datetime.date, datetime.date(2015, 1, 2)], default=json_default))
+
+        # Objects don't have a representation that is the same in every process
+        with self.assertRaises(TypeError):
+            json.dumps([object()], default=json_default)
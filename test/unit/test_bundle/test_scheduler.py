@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+
+from ambry.bundle.scheduler import DAGScheduler
+from ambry.dbexceptions import BuildError, MemoryLimitError
+
+
+class FakeResult(object):
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        if isinstance(self.value, Exception):
+            raise self.value
+        return [self.value]
+
+
+class FakePool(object):
+    """Runs tasks when they are submitted, and records the tasks that were running at the time"""
+
+    _processes = 4
+    memory_budget = None
+
+    def __init__(self, sched):
+        self.sched = sched
+        self.log = []
+
+    def worker_rss(self):
+        return None
+
+    def map_async(self, f, iterable, chunksize, callback=None):
+        args = list(iterable)[0]
+        running = sorted(t.key for t in self.sched.tasks.values() if t.state == 'running' and t.key != args[0])
+        self.log.append((args[0], running))
+
+        try:
+            return FakeResult(f(*args))
+        except Exception as e:
+            return FakeResult(e)
+
+
+class TestDAGScheduler(TestCase):
+
+    def test_run_order(self):
+        log = []
+
+        sched = DAGScheduler(before_stage=lambda s: log.append(('before', s)),
+                             after_stage=lambda s: log.append(('after', s)))
+
+        sched.add('a', log.append, ['a'], stage=1)
+        sched.add('c', log.append, ['c'], deps=['u'], stage=2)
+        sched.add('d', log.append, ['d'], stage=2)
+        sched.add('b', log.append, ['b'], stage=1)
+        sched.add('u', log.append, ['u'], deps=['a', 'b'])
+
+        # d doesn't have to wait for stage 1
+        self.assertEqual(dict(blocked=2, queued=3, running=0, done=0, failed=0), sched.counts)
+
+        sched.run()
+
+        # Ready tasks run in order of stage, and tasks without a stage go first
+        self.assertEqual([('before', 1), 'a', 'b', ('after', 1), 'u', ('before', 2), 'c', 'd', ('after', 2)], log)
+        self.assertEqual(5, sched.counts['done'])
+
+    def test_check(self):
+        sched = DAGScheduler()
+        sched.add('a', list, [], deps=['b'])
+        sched.add('b', list, [], deps=['a'])
+
+        with self.assertRaises(BuildError):
+            sched.run()
+
+        sched = DAGScheduler()
+        sched.add('a', list, [], deps=['x'])
+
+        with self.assertRaises(BuildError):
+            sched.check()
+
+        with self.assertRaises(BuildError):
+            sched.add('a', list, [])
+
+    def test_longest_first(self):
+        log = []
+
+        sched = DAGScheduler()
+
+        for key, cost in (('a', 1), ('b', 10), ('c', None), ('d', 4), ('e', 3)):
+            sched.add(key, log.append, [key], stage=1, cost=cost)
+
+        sched.add('f', log.append, ['f'], stage=2, cost=100)
+
+        self.assertEqual(['b', 'd', 'e', 'a', 'c', 'f'], [t.key for t in sched.ready()])
+
+        sched.processes = 2
+
+        # b runs alone, while d, e and a share the other process
+        self.assertEqual(10, sched.predicted_makespan(1))
+        self.assertIsNone(sched.makespan(1))
+
+        sched.run()
+
+        self.assertEqual(['b', 'd', 'e', 'a', 'c', 'f'], log)
+        self.assertEqual(18, sched.predicted_makespan(1))
+        self.assertGreaterEqual(sched.makespan(1), 0)
+
+    def test_memory_admission(self):
+        sched = DAGScheduler()
+        pool = FakePool(sched)
+        pool.memory_budget = 100
+
+        for key, memory in (('a', 60), ('b', 30), ('c', 20), ('d', None)):
+            sched.add(key, list, [], stage=1, memory=memory)
+
+        for k in 'ab':
+            sched.tasks[k].state = 'running'
+
+        running = ['a', 'b']
+
+        self.assertFalse(sched._admit(sched.tasks['c'], running, pool))
+        self.assertTrue(sched._admit(sched.tasks['d'], running, pool))
+
+        # The workers use more memory than the estimates
+        pool.worker_rss = lambda: 101
+        self.assertFalse(sched._admit(sched.tasks['d'], running, pool))
+
+        # The first task always starts, but a task that runs alone waits for the others to finish
+        self.assertTrue(sched._admit(sched.tasks['c'], [], pool))
+        sched.tasks['c'].alone = True
+        self.assertFalse(sched._admit(sched.tasks['c'], ['a'], pool))
+        self.assertFalse(sched._admit(sched.tasks['d'], ['c'], pool))
+
+    def test_retry_alone(self):
+        attempts = []
+
+        def run(key):
+            attempts.append(key)
+            if key == 'big' and attempts.count(key) == 1:
+                raise MemoryLimitError('Too big')
+            return key
+
+        sched = DAGScheduler()
+        sched.poll_interval = .01
+        pool = FakePool(sched)
+
+        sched.add('big', run, ['big'], stage=1, cost=10)
+        sched.add('small', run, ['small'], stage=1, cost=1)
+
+        sched.run(pool)
+
+        self.assertEqual(['big', 'small', 'big'], attempts)
+        self.assertEqual(2, sched.counts['done'])
+        self.assertTrue(sched.tasks['big'].alone)
+
+        # The retry started after the small task was done.
+        self.assertEqual(('big', []), pool.log[-1])
+
+    def test_local_task_behind_full_pool(self):
+        log = []
+
+        sched = DAGScheduler()
+        sched.poll_interval = .01
+        pool = FakePool(sched)
+        pool._processes = 1
+
+        sched.add('a', log.append, ['a'], stage=1)
+        sched.add('b', log.append, ['b'], stage=1)
+        sched.add('finish', log.append, ['finish'], stage=2, local=True)
+
+        # When a is running, the pool is full, so b has to wait, but the local task doesn't
+        sched.run(pool)
+
+        self.assertEqual(['finish', 'a', 'b'], log)
+        self.assertEqual(3, sched.counts['done'])
+
+    def test_memory_watchdog(self):
+        from ambry.bundle.concurrent import MemoryWatchdog
+        from ambry.util import process_rss
+
+        if process_rss() is None:
+            self.skipTest("Can't measure memory on this platform")
+
+        exceeded = []
+
+        # The limit applies to the memory the task adds to the process, not to what the process already had
+        w = MemoryWatchdog(limit=20 * 2 ** 20, on_exceed=exceeded.append)
+        self.assertGreater(w.base, 20 * 2 ** 20)
+
+        self.assertTrue(w.sample())
+        self.assertLess(w.peak, 20 * 2 ** 20)
+
+        data = b'x' * (40 * 2 ** 20)
+
+        self.assertFalse(w.sample())
+        self.assertEqual([w.peak], exceeded)
+        self.assertGreaterEqual(w.peak, 30 * 2 ** 20)
+
+        del data
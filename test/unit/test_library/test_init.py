@@ -3,7 +3,7 @@
 from ambry.orm import Partition
 from ambry.orm.exc import NotFoundError
 
-from test.factories import PartitionFactory
+from test.factories import DatasetFactory, PartitionFactory
 from test.proto import TestBase
 
 
@@ -56,3 +56,48 @@ class LibraryTest(TestBase):
     def test_raises_NotFoundError_if_partition_not_found(self):
         with self.assertRaises(NotFoundError):
             self.my_library.partition('no-such-partition')
+
+    def test_caches_partition_references(self):
+        from sqlalchemy import event
+
+        PartitionFactory._meta.sqlalchemy_session = self.my_library.database.session
+        DatasetFactory._meta.sqlalchemy_session = self.my_library.database.session
+        l = self.my_library
+        partition = PartitionFactory()
+        l.database.commit()
+
+        for ref in (partition.vid, partition.id):
+            self.assertEqual(partition.vid, l.partition(ref).vid)
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(l.database.engine, 'before_cursor_execute', count)
+        try:
+            # The vid is in the cache, and the partition in the identity map
+            self.assertEqual(partition.vid, l.partition(partition.vid).vid)
+            self.assertEqual([], statements)
+
+            # The id is in the cache, and the latest revision was checked recently
+            self.assertEqual(partition.vid, l.partition(partition.id).vid)
+            self.assertEqual([], statements)
+        finally:
+            event.remove(l.database.engine, 'before_cursor_execute', count)
+
+        # A new revision of the dataset takes over the id, but not the vid, as soon as the library creates it
+        self.assertEqual(partition.d_vid, l.bundle(partition.dataset.id).identity.vid)
+
+        b = l.new_bundle(id=partition.dataset.id, revision=2, source=partition.dataset.source,
+                         dataset=partition.dataset.dataset)
+        self.assertEqual(b.identity.vid, l.bundle(partition.dataset.id).identity.vid)
+
+        partition2 = PartitionFactory(dataset=b.dataset, sequence_id=partition.sequence_id)
+        l.database.commit()
+
+        self.assertEqual(partition2.vid, l.partition(partition.id).vid)
+        self.assertEqual(partition.vid, l.partition(partition.vid).vid)
+
+        l.remove(l.bundle(partition2.d_vid))
+        self.assertEqual(partition.vid, l.partition(partition.id).vid)